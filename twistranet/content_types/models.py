@@ -3,10 +3,13 @@ Default content types for twistranet
 """
 import mimetypes
 from django.db import models
+from django.db.models import F
+from django.db.models.signals import post_delete
 from twistranet.twistapp.lib import permissions   
 from twistranet.twistapp.lib.utils import formatbytes
 from twistranet.twistapp.models.content import Content
 from twistranet.twistapp.models import fields
+from twistranet.twistapp.signals import content_created
 
 class StatusUpdate(Content):
     """
@@ -51,7 +54,10 @@ class Comment(StatusUpdate):
         self.publisher = self.root_content.publisher
 
         # Ok; regular saving otherwise
+        creation = not self.id
         super(Comment, self).save(*args, **kw)
+        if creation:
+            Content.objects.__booster__.filter(id = self.root_content_id).update(comment_count = F("comment_count") + 1)
         
         # Additional notifications for comments (we don't care about checking if we're
         # in the creation mode, as comments should never be edited).
@@ -62,6 +68,7 @@ class Comment(StatusUpdate):
             for l in [ current.owner, ]:
                 if not l.id in listener_ids and not l.id in additional_listeners:
                     additional_listeners.append(l)
+            current = current.object.in_reply_to
         if additional_listeners:
             content_created.send(
                 sender = self.__class__, 
@@ -74,6 +81,14 @@ class Comment(StatusUpdate):
     class Meta:
         app_label = 'twistapp'
 
+def comment_post_delete(sender, instance, **kw):
+    """
+    Maintain Content.comment_count, including when comments are deleted in cascade.
+    """
+    Content.objects.__booster__.filter(id = instance.root_content_id).update(comment_count = F("comment_count") - 1)
+
+post_delete.connect(comment_post_delete, sender = Comment)
+
 class Document(Content):
     """
     A document is a (possibly long) text/html content associated with resource,
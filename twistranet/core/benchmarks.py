@@ -0,0 +1,361 @@
+"""
+Performance benchmarks for twistranet.
+
+Those are meant to be run against a populated database (see fixtures/heavy_load.py)
+with the 'twistranet_benchmark' management command, eg.:
+
+    ./manage.py twistranet_benchmark auth_context
+
+Each benchmark is a function taking the command options and printing its results.
+"""
+from __future__ import with_statement
+import time
+
+from django.conf import settings
+
+from twistranet.twistapp.lib.auth_context import as_account
+
+BENCHMARKS = {}
+
+def benchmark(func):
+    """
+    Register a benchmark function under its name
+    """
+    BENCHMARKS[func.__name__] = func
+    return func
+
+def _timeit(func, *args, **kw):
+    """
+    Return (result, elapsed seconds) for the given call.
+    """
+    start = time.time()
+    ret = func(*args, **kw)
+    return ret, time.time() - start
+
+def _report(label, count, elapsed, unit = "ops"):
+    print "%-40s %8d %s in %7.3fs => %10.1f %s/s" % (label, count, unit, elapsed, count / max(elapsed, 1e-6), unit)
+
+def _sample_account():
+    """
+    Return a regular (non-admin) user account to run benchmarks with.
+    """
+    from twistranet.twistapp.models import SystemAccount, UserAccount
+    with as_account(SystemAccount.get()):
+        for account in UserAccount.objects.order_by("-id")[:20]:
+            if not account.is_admin:
+                return account
+    raise RuntimeError("No regular user account found. Please load fixtures/heavy_load.py first.")
+
+
+@benchmark
+def auth_context(options):
+    """
+    Permission checks per second, with a bound account vs. digging the stack.
+    The stack fallback is measured with 'depth' extra frames, to emulate a view/template call stack.
+    """
+    from twistranet.twistapp.models import Content
+    n_objects = options.get("objects", 100)
+    depth = options.get("depth", 30)
+    repeat = options.get("repeat", 10)
+    account = _sample_account()
+    with as_account(account):
+        objects = list(Content.objects.order_by("-id")[:n_objects])
+    
+    def check_all():
+        for i in range(repeat):
+            for obj in objects:
+                obj.can_view
+                obj.can_list
+        return len(objects) * 2 * repeat
+        
+    def nested(level):
+        if level:
+            return nested(level - 1)
+        return check_all()
+        
+    # Explicit context
+    with as_account(account):
+        count, elapsed = _timeit(nested, depth)
+    _report("Bound context (as_account)", count, elapsed, "checks")
+    
+    # Stack-walking fallback
+    fallback = getattr(settings, "TWISTRANET_AUTH_STACK_FALLBACK", False)
+    settings.TWISTRANET_AUTH_STACK_FALLBACK = True
+    try:
+        __account__ = account
+        count, elapsed_fallback = _timeit(nested, depth)
+    finally:
+        settings.TWISTRANET_AUTH_STACK_FALLBACK = fallback
+    _report("Stack walking (depth=%d)" % depth, count, elapsed_fallback, "checks")
+    print "Speedup: x%.1f" % (elapsed_fallback / max(elapsed, 1e-6))
+
+
+def _explain(qs):
+    """
+    Return the query plan of the given queryset as a list of strings.
+    """
+    from django.db import connection
+    sql, params = qs.query.get_compiler(qs.db).as_sql()
+    if "sqlite" in settings.DATABASES["default"]["ENGINE"]:
+        sql = "EXPLAIN QUERY PLAN %s" % sql
+    else:
+        sql = "EXPLAIN %s" % sql
+    cursor = connection.cursor()
+    cursor.execute(sql, params)
+    return [ " ".join([ unicode(c) for c in row ]) for row in cursor.fetchall() ]
+
+def _compare_settings(setting, label, func, repeat):
+    """
+    Run func() 'repeat' times with setting = False (legacy) then True. Report timings.
+    """
+    def run():
+        for i in range(repeat):
+            func()
+        return repeat
+        
+    backup = getattr(settings, setting, True)
+    try:
+        for value, name in ((False, "legacy"), (True, "indexed")):
+            setattr(settings, setting, value)
+            count, elapsed = _timeit(run)
+            _report("%s (%s)" % (label, name), count, elapsed, "queries")
+    finally:
+        setattr(settings, setting, backup)
+
+@benchmark
+def access_index(options):
+    """
+    Secured listings with the legacy 4-way OR join vs. the access index semi-join.
+    """
+    from twistranet.twistapp.models import Content, Account, AnonymousAccount
+    repeat = options.get("repeat", 10)
+    page = options.get("objects", 100)
+    account = _sample_account()
+    
+    def first_page():
+        return list(Content.objects.get_query_set(__account__ = account).order_by("-id")[:page].values_list("id", flat = True))
+    def count():
+        return Content.objects.get_query_set(__account__ = account).count()
+    def accounts():
+        return list(Account.objects.get_query_set(__account__ = account).order_by("-id")[:page].values_list("id", flat = True))
+    def anonymous():
+        return list(Content.objects.get_query_set(__account__ = AnonymousAccount()).order_by("-id")[:page].values_list("id", flat = True))
+        
+    backup = getattr(settings, "TWISTRANET_ACCESS_INDEX", True)
+    try:
+        for value, name in ((False, "legacy"), (True, "indexed")):
+            settings.TWISTRANET_ACCESS_INDEX = value
+            print "--- %s query plan ---" % name
+            for line in _explain(Content.objects.get_query_set(__account__ = account).order_by("-id")[:page]):
+                print "   ", line
+    finally:
+        settings.TWISTRANET_ACCESS_INDEX = backup
+    
+    _compare_settings("TWISTRANET_ACCESS_INDEX", "Content first page", first_page, repeat)
+    _compare_settings("TWISTRANET_ACCESS_INDEX", "Content count", count, repeat)
+    _compare_settings("TWISTRANET_ACCESS_INDEX", "Account first page", accounts, repeat)
+    _compare_settings("TWISTRANET_ACCESS_INDEX", "Anonymous first page", anonymous, repeat)
+
+
+@benchmark
+def permissions(options):
+    """
+    Permission flags for a page of content: one has_permission() per object
+    vs. one has_permission_many() per permission. The role cache is cleared before each run.
+    """
+    from twistranet.twistapp.models import Content, Account, UserAccount
+    from twistranet.twistapp.lib import permissions as perms
+    n_objects = options.get("objects", 100)
+    repeat = options.get("repeat", 10)
+    sample = _sample_account()
+    with as_account(sample):
+        objects = list(Content.objects.order_by("-id").select_related("publisher")[:n_objects])
+    checked = (perms.can_view, perms.can_edit, perms.can_delete, )
+    
+    def one_by_one():
+        for i in range(repeat):
+            Account._role_cache.clear()
+            account = UserAccount.objects.__booster__.get(id = sample.id)
+            for permission in checked:
+                for obj in objects:
+                    account.has_permission(permission, obj)
+        return len(objects) * len(checked) * repeat
+        
+    def batch():
+        for i in range(repeat):
+            Account._role_cache.clear()
+            account = UserAccount.objects.__booster__.get(id = sample.id)
+            for permission in checked:
+                account.has_permission_many(permission, objects)
+        return len(objects) * len(checked) * repeat
+    
+    count, elapsed = _timeit(one_by_one)
+    _report("has_permission()", count, elapsed, "checks")
+    count, elapsed_batch = _timeit(batch)
+    _report("has_permission_many()", count, elapsed_batch, "checks")
+    print "Speedup: x%.1f" % (elapsed / max(elapsed_batch, 1e-6))
+
+
+@benchmark
+def permission_storage(options):
+    """
+    Insert throughput and listing latency with the current permissions storage mode
+    (see TWISTRANET_PACKED_PERMISSIONS and the 'twistranet_pack_permissions' command).
+    Inserted objects are rolled back.
+    """
+    from django.db import transaction
+    from twistranet.twistapp.models import Content, twistable
+    from twistranet.content_types.models import StatusUpdate
+    n_objects = options.get("objects", 100)
+    repeat = options.get("repeat", 10)
+    account = _sample_account()
+    print "Packed permissions: %s" % (twistable.PACKED_PERMISSIONS and "yes" or "no", )
+    
+    def insert():
+        for i in range(n_objects):
+            StatusUpdate.objects.create(description = "Benchmark status #%d" % i, permissions = "public")
+        return n_objects
+        
+    transaction.enter_transaction_management()
+    transaction.managed(True)
+    try:
+        with as_account(account):
+            count, elapsed = _timeit(insert)
+    finally:
+        transaction.rollback()
+        transaction.leave_transaction_management()
+    _report("Insert StatusUpdate", count, elapsed, "objects")
+    
+    def first_page():
+        return list(Content.objects.get_query_set(__account__ = account).order_by("-id")[:n_objects].values_list("id", flat = True))
+    for line in _explain(Content.objects.get_query_set(__account__ = account).order_by("-id")[:n_objects]):
+        print "   ", line
+    _compare_settings("TWISTRANET_ACCESS_INDEX", "Content first page", first_page, repeat)
+
+
+@benchmark
+def slugs(options):
+    """
+    Creating documents with the same title: slug counter vs. probing each suffix in turn.
+    Run it with '--objects 10000'. Inserted objects are rolled back.
+    """
+    from django.db import transaction
+    from twistranet.twistapp.models import Twistable, SlugCounter
+    from twistranet.content_types.models import Document
+    n_objects = options.get("objects", 100)
+    repeat = options.get("repeat", 10)
+    account = _sample_account()
+    title = "Benchmark meeting notes"
+    
+    def insert():
+        for i in range(n_objects):
+            Document.objects.create(title = title, text = "Hello")
+        return n_objects
+        
+    def probe(slug):
+        # Former Twistable.save() behaviour
+        root, num = slug, 0
+        while Twistable.objects.__booster__.filter(slug = slug).exists():
+            num += 1
+            slug = "%s_%i" % (root, num, )
+        return num + 1
+        
+    transaction.enter_transaction_management()
+    transaction.managed(True)
+    try:
+        with as_account(account):
+            count, elapsed = _timeit(insert)
+            _report("Insert Document (slug counter)", count, elapsed, "objects")
+            slug = Document.objects.filter(title = title).order_by("id")[0].slug
+            
+            # Allocating one more slug, with both methods
+            n_probes, elapsed_probe = _timeit(lambda: sum([ probe(slug) for i in range(repeat) ]))
+            _report("Probing allocation (next slug)", n_probes, elapsed_probe, "queries")
+            slugs, elapsed_counter = _timeit(lambda: [ SlugCounter.objects.allocate(slug) for i in range(repeat) ])
+            _report("Counter allocation (next slug)", repeat, elapsed_counter, "slugs")
+            print "Speedup for the next slug: x%.1f" % (elapsed_probe / max(elapsed_counter, 1e-6))
+            
+            # The probing loop costs n(n+1)/2 probes for n documents
+            per_probe = elapsed_probe / max(n_probes, 1)
+            print "Estimated probing time for %d documents: %.1fs" % (n_objects, per_probe * n_objects * (n_objects + 1) / 2)
+    finally:
+        transaction.rollback()
+        transaction.leave_transaction_management()
+
+
+@benchmark
+def bulk_create(options):
+    """
+    Importing documents: one save() per document vs. Twistable.objects.bulk_create_secured().
+    Inserted objects are rolled back.
+    """
+    from django.db import transaction
+    from twistranet.twistapp.models import Twistable
+    from twistranet.content_types.models import Document
+    n_objects = options.get("objects", 100)
+    account = _sample_account()
+    
+    def documents():
+        return [ Document(title = "Benchmark import", text = "Document #%d" % i) for i in range(n_objects) ]
+    def save():
+        for doc in documents():
+            doc.save()
+        return n_objects
+    def bulk():
+        return len(Twistable.objects.bulk_create_secured(documents(), as_account = account))
+        
+    transaction.enter_transaction_management()
+    transaction.managed(True)
+    try:
+        with as_account(account):
+            count, elapsed = _timeit(save)
+        _report("Document.save()", count, elapsed, "objects")
+        transaction.rollback()
+        count, elapsed_bulk = _timeit(bulk)
+        _report("bulk_create_secured()", count, elapsed_bulk, "objects")
+    finally:
+        transaction.rollback()
+        transaction.leave_transaction_management()
+    print "Speedup: x%.1f" % (elapsed / max(elapsed_bulk, 1e-6))
+
+
+@benchmark
+def activity_feed(options):
+    """
+    First page of an activity feed as the wall grows: OR-ed DISTINCT query vs. UNION of indexed branches
+    (see ContentManager.getActivityFeed). The wall grows by '--objects' statuses 4 times. Inserted objects are rolled back.
+    """
+    from django.db import transaction
+    from twistranet.twistapp.models import Twistable, Content
+    from twistranet.content_types.models import StatusUpdate
+    n_objects = options.get("objects", 100)
+    repeat = options.get("repeat", 10)
+    page = settings.TWISTRANET_CONTENT_PER_PAGE
+    account = _sample_account()
+    
+    def or_distinct():
+        for i in range(repeat):
+            list(Content.objects.getActivityFeed(account).order_by("-id").values_list("id", flat = True)[:page])
+        return repeat
+    def union():
+        for i in range(repeat):
+            list(Content.objects.getActivityFeed(account, limit = page).values_list("id", flat = True))
+        return repeat
+        
+    transaction.enter_transaction_management()
+    transaction.managed(True)
+    try:
+        with as_account(account):
+            for step in range(5):
+                if step:
+                    Twistable.objects.bulk_create_secured([
+                        StatusUpdate(description = "Benchmark status #%d" % i) for i in range(n_objects)
+                    ], as_account = account)
+                size = Content.objects.__booster__.filter(publisher__id = account.id).count()
+                count, elapsed = _timeit(or_distinct)
+                _report("OR + DISTINCT (%d on wall)" % size, count, elapsed, "pages")
+                count, elapsed_union = _timeit(union)
+                _report("UNION (%d on wall)" % size, count, elapsed_union, "pages")
+    finally:
+        transaction.rollback()
+        transaction.leave_transaction_management()
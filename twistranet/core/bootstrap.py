@@ -4,6 +4,7 @@ plus some tools to check and repair your DB.
 
 See doc/DESIGN.txt for caveats about database
 """
+from __future__ import with_statement
 import traceback
 import os
 import shutil
@@ -21,6 +22,8 @@ import twistranet
 from twistranet.twistapp.models import *
 from twistranet.twistapp.lib import permissions
 from twistranet.twistapp.lib.slugify import slugify
+from twistranet.twistapp.lib.auth_context import as_account
+from twistranet.twistapp.lib.python_fixture import apply_fixtures
 from twistranet.twistapp.lib.log import *
 
 from django.conf import settings
@@ -36,14 +39,13 @@ def repair():
     Will not erase data it doesn't know how to handle.
     """
     # Login
-    __account__ = SystemAccount.objects.get()
-    
-    # Put all Django admin users inside the first admin community
-    django_admins = UserAccount.objects.filter(user__is_superuser = True)
-    admin_community = AdminCommunity.objects.get()
-    for user in django_admins:
-        if not admin_community in user.communities:
-            admin_community.join(user, is_manager = True)
+    with as_account(SystemAccount.objects.get()):
+        # Put all Django admin users inside the first admin community
+        django_admins = UserAccount.objects.filter(user__is_superuser = True)
+        admin_community = AdminCommunity.objects.get()
+        for user in django_admins:
+            if not admin_community in user.communities:
+                admin_community.join(user, is_manager = True)
 
 
 def bootstrap():
@@ -55,7 +57,7 @@ def bootstrap():
     """
     try:
         # Let's log in.
-        __account__ = SystemAccount.objects.__booster__.get()
+        system = SystemAccount.objects.__booster__.get()
     except SystemAccount.DoesNotExist:
         log.info("No SystemAccount available. That means this instance has never been bootstraped, so let's do it now.")
         raise RuntimeError("Please sync your databases with 'manage.py syncdb' before bootstraping.")
@@ -64,7 +66,18 @@ def bootstrap():
         log.info("DatabaseError while bootstraping. Your tables are probably not created yet.")
         traceback.print_exc()
         return
+    with as_account(system):
+        _load_initial_data(system)
 
+def _load_initial_data(system):
+    """
+    Actually load initial data. Must be called as SystemAccount.
+    """
+    # Objects loaded by syncdb or created before the access index existed don't have their access tokens yet
+    if not AccessToken.objects.exists():
+        log.info("Building the access index")
+        AccessToken.objects.rebuild()
+        
     # Now create the bootstrap / default / help fixture objects.
     # Import your fixture there, if you don't do so they may not be importable.
     from twistranet.fixtures.bootstrap import FIXTURES as BOOTSTRAP_FIXTURES
@@ -79,7 +92,7 @@ def bootstrap():
         log.info("twistrans not installed, translations are not installed.")
     
     # Load fixtures
-    for obj in BOOTSTRAP_FIXTURES:          obj.apply()
+    apply_fixtures(BOOTSTRAP_FIXTURES)
 
     # Special treatment for bootstrap: Set the GlobalCommunity owner = AdminCommunity
     glob = GlobalCommunity.objects.get()
@@ -119,11 +132,11 @@ def bootstrap():
         break   # XXX We don't handle subdirs yet.
     
     # Set SystemAccount picture (which is a way to check if things are working properly).
-    __account__.picture = Resource.objects.get(slug = "default_tn_picture")
-    __account__.save()
+    system.picture = Resource.objects.get(slug = "default_tn_picture")
+    system.save()
 
     # Install HELP fixture.
-    for obj in HELP_EN_FIXTURES:            obj.apply()
+    apply_fixtures(HELP_EN_FIXTURES)
         
     # Have we got an admin account? If not, we generate one now.
     django_admins = UserAccount.objects.filter(user__is_superuser = True)
@@ -146,8 +159,7 @@ def bootstrap():
     if settings.TWISTRANET_IMPORT_SAMPLE_DATA:
         from twistranet.fixtures import sample
         sample.create_users()
-        for obj in sample.get_fixtures():
-            obj.apply()
+        apply_fixtures(sample.get_fixtures())
         
         # Add relations bwn sample users
         # A <=> admin
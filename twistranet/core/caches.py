@@ -1,7 +1,17 @@
 """
 Various caching help functions and classes.
 """
+from __future__ import with_statement
+import sys
+import time
+import random
+import hashlib
+import threading
+import array
+import bisect
+from collections import OrderedDict
 from django.core.cache import cache
+from django.conf import settings
 
 DEFAULT_CACHE_DELAY = 60 * 60           # Default cache delay is 1hour. It's quite long.
 USERACCOUNT_CACHE_DELAY = 60 * 3        # 3 minutes here. This is used to know if a user is online or not.
@@ -51,3 +61,355 @@ class UserAccountCache(_AbstractCache):
         
 
 
+
+#                                                       #
+#           Version-stamped role cache                  #
+#                                                       #
+
+VERSION_CACHE_DELAY = DEFAULT_CACHE_DELAY * 24      # Version stamps are kept 1 day.
+ROLE_CACHE_SIZE = 10000                             # Default number of role entries kept in process memory.
+
+def _new_version():
+    """
+    Return a fresh version number. We use random numbers instead of starting from 0
+    to make sure that an expired version never matches an older stamp.
+    """
+    return random.randint(1, sys.maxint)
+
+def get_versions(*twistable_ids, **kw):
+    """
+    Return the current version of each twistable id, as a tuple.
+    Versions are stored in the shared cache so that all processes agree on them.
+    Use the 'namespace' keyword to get versions which are bumped independently (eg. "summary").
+    """
+    keys = [ "tn_%s#%s" % (kw.get("namespace", "version"), i) for i in twistable_ids ]
+    versions = cache.get_many(keys)
+    ret = []
+    for key in keys:
+        v = versions.get(key, None)
+        if v is None:
+            v = _new_version()
+            if not cache.add(key, v, VERSION_CACHE_DELAY):
+                v = cache.get(key, v)
+        ret.append(v)
+    return tuple(ret)
+
+def bump_versions(*twistable_ids, **kw):
+    """
+    Invalidate everything cached about the given twistable ids (in the given 'namespace').
+    """
+    for i in twistable_ids:
+        if i is None:
+            continue
+        key = "tn_%s#%s" % (kw.get("namespace", "version"), i)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, _new_version(), VERSION_CACHE_DELAY)
+
+LOCAL_CACHE_BACKENDS = ("locmem", "dummy", )           # Backends which are not shared between processes
+
+def process_cache_enabled():
+    """
+    Return True if data validated by version stamps may be kept in process memory.
+    Stamps are bumped in the Django cache: if each process has its own (eg. "locmem:///"),
+    other processes never see the bumps and would keep serving stale data.
+    So unless TWISTRANET_PROCESS_CACHE says otherwise, this is only True with a shared backend (eg. memcached).
+    """
+    enabled = getattr(settings, "TWISTRANET_PROCESS_CACHE", None)
+    if enabled is None:
+        scheme = settings.CACHE_BACKEND.split(":", 1)[0]
+        enabled = scheme not in LOCAL_CACHE_BACKENDS
+    return enabled
+
+class RoleCache(object):
+    """
+    Bounded LRU cache of has_role() results, keyed by (account_id, object_id, role).
+    
+    Each entry is stamped with the versions of both the account and the object;
+    bump_versions() on either of them is enough to invalidate it, in all processes.
+    Nothing is kept in process memory unless process_cache_enabled().
+    If 'shared' is True, results are stored in the shared Django cache as well.
+    """
+    def __init__(self, size = ROLE_CACHE_SIZE, shared = False):
+        self.size = size
+        self.shared = shared
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        
+    def stamp(self, *twistable_ids):
+        """
+        Return the current stamp for the given ids. Get it BEFORE computing a value you want to set().
+        """
+        return get_versions(*twistable_ids)
+        
+    def _shared_key(self, key, stamp):
+        return "tn_role#%s" % "#".join([ str(k) for k in key + stamp ])
+        
+    def get(self, key, stamp):
+        """
+        Return the cached value or None.
+        """
+        if process_cache_enabled():
+            with self._lock:
+                entry = self._data.pop(key, None)
+                if entry is not None and entry[0] == stamp:
+                    self._data[key] = entry
+                    self.hits += 1
+                    return entry[1]
+        if self.shared:
+            value = cache.get(self._shared_key(key, stamp), None)
+            if value is not None:
+                self._set_local(key, stamp, value)
+                self.hits += 1
+                return value
+        self.misses += 1
+        return None
+        
+    def set(self, key, stamp, value):
+        self._set_local(key, stamp, value)
+        if self.shared:
+            cache.set(self._shared_key(key, stamp), value, DEFAULT_CACHE_DELAY)
+            
+    def _set_local(self, key, stamp, value):
+        if not process_cache_enabled():
+            return
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (stamp, value)
+            while len(self._data) > self.size:
+                self._data.popitem(last = False)
+                
+    def clear(self, ):
+        with self._lock:
+            self._data.clear()
+        self.hits = self.misses = 0
+
+
+
+#                                                       #
+#           Shared sets of account ids                  #
+#                                                       #
+
+ID_SET_CACHE_DELAY = DEFAULT_CACHE_DELAY * 24       # Id sets are explicitly invalidated, keep them 1 day.
+ID_SET_KINDS = ("network", "community", "followed", )
+
+class SortedIds(object):
+    """
+    An immutable set of integer ids stored as a sorted array.
+    This takes 4 bytes per id (instead of ~30 for a python int in a list or set)
+    and membership tests are done by bisection.
+    """
+    __slots__ = ("_ids", )
+    
+    def __init__(self, ids = ()):
+        self._ids = array.array("i", sorted(set(ids)))
+        
+    @classmethod
+    def unpack(cls, packed):
+        ret = cls()
+        ret._ids.fromstring(packed)
+        return ret
+        
+    def pack(self):
+        return self._ids.tostring()
+        
+    def __contains__(self, id_):
+        if id_ is None:
+            return False
+        i = bisect.bisect_left(self._ids, id_)
+        return i < len(self._ids) and self._ids[i] == id_
+        
+    def __iter__(self):
+        return iter(self._ids)
+        
+    def __len__(self):
+        return len(self._ids)
+        
+    def __repr__(self):
+        return "<SortedIds %s>" % list(self._ids)
+
+def _id_set_key(kind, account_id):
+    return "tn_ids#%s#%s" % (kind, account_id)
+
+def get_id_set(kind, account_id, compute):
+    """
+    Return the 'kind' SortedIds of the given account from the shared cache.
+    On cache miss, compute() is called and must return an iterable of ids.
+    """
+    key = _id_set_key(kind, account_id)
+    packed = cache.get(key, None)
+    if packed is not None:
+        return SortedIds.unpack(packed)
+    ret = SortedIds(compute())
+    cache.set(key, ret.pack(), ID_SET_CACHE_DELAY)
+    return ret
+
+def invalidate_id_sets(*account_ids):
+    """
+    Forget all cached id sets for the given accounts. None ids are ignored.
+    """
+    keys = [ _id_set_key(kind, i) for i in account_ids if i is not None for kind in ID_SET_KINDS ]
+    if keys:
+        cache.delete_many(keys)
+
+
+
+#                                                       #
+#           Rendered fragments                          #
+#                                                       #
+
+FRAGMENT_CACHE_DELAY = DEFAULT_CACHE_DELAY * 24     # Fragment keys hold versions: outdated ones just expire.
+
+class FragmentCache(object):
+    """
+    Rendered HTML fragments in the shared cache.
+    
+    Keys are tuples which must identify everything the fragment depends on
+    (usually including get_versions() stamps, so that bump_versions() invalidates them).
+    Hits and misses are counted in this process and in the shared cache, see stats().
+    """
+    def __init__(self, name, delay = FRAGMENT_CACHE_DELAY):
+        self.name = name
+        self.delay = delay
+        self.hits = 0
+        self.misses = 0
+        
+    def _key(self, key):
+        return "tn_fragment#%s#%s" % (self.name, "#".join([ str(k) for k in key ]))
+        
+    def _stats_key(self, counter):
+        return "tn_fragment_stats#%s#%s" % (self.name, counter)
+        
+    def _count(self, hits, misses):
+        """
+        Add hits and misses to the counters. Shared counters are updated with one incr() each.
+        """
+        self.hits += hits
+        self.misses += misses
+        for counter, value in (("hits", hits), ("misses", misses)):
+            if not value:
+                continue
+            key = self._stats_key(counter)
+            try:
+                cache.incr(key, value)
+            except ValueError:
+                if not cache.add(key, value, self.delay):
+                    cache.incr(key, value)
+        
+    def get_many(self, keys):
+        """
+        Return a {key: html} dict of the cached fragments among the given keys, with one cache round-trip.
+        """
+        keys = list(keys)
+        shared_keys = dict([ (self._key(key), key) for key in keys ])
+        found = cache.get_many(shared_keys.keys())
+        ret = dict([ (shared_keys[k], v) for k, v in found.items() ])
+        self._count(len(ret), len(keys) - len(ret))
+        return ret
+        
+    def get(self, key):
+        return self.get_many([ key, ]).get(key, None)
+        
+    def set(self, key, html):
+        cache.set(self._key(key), html, self.delay)
+        
+    def stats(self, ):
+        """
+        Return the shared hits / misses counters and the hit rate (between 0 and 1, None if there's no request yet).
+        """
+        counters = cache.get_many([ self._stats_key("hits"), self._stats_key("misses"), ])
+        hits = counters.get(self._stats_key("hits"), 0)
+        misses = counters.get(self._stats_key("misses"), 0)
+        hit_rate = None
+        if hits + misses:
+            hit_rate = float(hits) / (hits + misses)
+        return {
+            "hits":     hits,
+            "misses":   misses,
+            "hit_rate": hit_rate,
+        }
+        
+    def reset_stats(self, ):
+        cache.delete_many([ self._stats_key("hits"), self._stats_key("misses"), ])
+        self.hits = self.misses = 0
+
+# Content summaries, see ContentManager.prefetch_summaries() and the 'summary_fragment' template tag.
+summary_cache = FragmentCache("summary")
+
+
+
+#                                                       #
+#           Anonymous pages                             #
+#                                                       #
+
+ANONYMOUS_PAGE_DELAY = 60 * 5                       # Pages are fresh for 5 minutes (unless invalidated)...
+ANONYMOUS_PAGE_STALE_DELAY = DEFAULT_CACHE_DELAY    # ...and can be served stale for 1 hour while they're recomputed.
+ANONYMOUS_PAGE_LOCK_DELAY = 30                      # A recomputation taking longer than this can be started again.
+
+class PageCache(object):
+    """
+    Whole pages in the shared cache, with stale-while-revalidate semantics.
+    
+    invalidate() makes all pages stale at once (with a generation number).
+    When a page is stale, only one caller recomputes it; the others are served the stale page meanwhile.
+    Values are stored as is: store the response content, not the response object.
+    """
+    def __init__(self, name, delay = ANONYMOUS_PAGE_DELAY, stale_delay = ANONYMOUS_PAGE_STALE_DELAY, lock_delay = ANONYMOUS_PAGE_LOCK_DELAY):
+        self.name = name
+        self.delay = delay
+        self.stale_delay = stale_delay
+        self.lock_delay = lock_delay
+        
+    def _key(self, key):
+        return "tn_page#%s#%s" % (self.name, hashlib.md5(repr(key)).hexdigest())
+        
+    def _generation(self, ):
+        key = "tn_page_generation#%s" % self.name
+        ret = cache.get(key, None)
+        if ret is None:
+            ret = _new_version()
+            if not cache.add(key, ret, VERSION_CACHE_DELAY):
+                ret = cache.get(key, ret)
+        return ret
+        
+    def invalidate(self, ):
+        """
+        Mark all pages as stale.
+        """
+        key = "tn_page_generation#%s" % self.name
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, _new_version(), VERSION_CACHE_DELAY)
+        
+    def get(self, key):
+        """
+        Return (value, stamp). value is the cached page (possibly stale) or None.
+        If stamp is None, value can be served as is. Else, the caller must compute the page
+        and store it with set(key, stamp, value). If value is not None, the other callers get it meanwhile.
+        """
+        shared_key = self._key(key)
+        generation = self._generation()
+        entry = cache.get(shared_key, None)
+        if entry is None:
+            return None, generation
+        entry_generation, created, value = entry
+        if entry_generation == generation and created + self.delay > time.time():
+            return value, None
+        if cache.add("%s#lock" % shared_key, 1, self.lock_delay):
+            return value, generation
+        return value, None
+        
+    def set(self, key, stamp, value):
+        shared_key = self._key(key)
+        cache.set(shared_key, (stamp, time.time(), value), self.stale_delay)
+        cache.delete("%s#lock" % shared_key)
+
+# Full pages seen by anonymous visitors, see BaseView.get_anonymous_cache_key().
+anonymous_page_cache = PageCache(
+    "anonymous",
+    delay = getattr(settings, "TWISTRANET_ANONYMOUS_CACHE_DELAY", ANONYMOUS_PAGE_DELAY),
+)
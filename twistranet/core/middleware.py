@@ -5,6 +5,7 @@ from django.conf import settings
 from django.core import signals
 from django.core.urlresolvers import get_script_prefix
 from twistranet.twistapp.lib.log import *
+from twistranet.twistapp.lib import auth_context
 
 def set_runtime_paths(sender,**kwds):
     """Dynamically adjust path settings based on runtime configuration.
@@ -53,3 +54,35 @@ class RuntimePathsMiddleware:
 
 
 
+
+AUTH_CONTEXT_MIDDLEWARE = "twistranet.core.middleware.AuthContextMiddleware"
+_auth_context_checked = False
+
+def check_auth_context_middleware():
+    """
+    Log an error (once) if AuthContextMiddleware is not in MIDDLEWARE_CLASSES,
+    which is the case of projects created before it existed.
+    Twistranet views still bind their request, but other views will only see an anonymous account.
+    """
+    global _auth_context_checked
+    if _auth_context_checked:
+        return
+    _auth_context_checked = True
+    if AUTH_CONTEXT_MIDDLEWARE not in settings.MIDDLEWARE_CLASSES:
+        log.error(
+            "%s is missing from your MIDDLEWARE_CLASSES setting. Add it right after "
+            "django.contrib.auth.middleware.AuthenticationMiddleware." % AUTH_CONTEXT_MIDDLEWARE
+        )
+
+class AuthContextMiddleware(object):
+    """
+    Bind the current request to the authentication context so that the security model
+    doesn't have to dig the stack to find the authenticated account.
+    Must be placed AFTER django's AuthenticationMiddleware.
+    """
+    def process_request(self, request):
+        auth_context.bind_request(request)
+
+    def process_response(self, request, response):
+        auth_context.unbind_request()
+        return response
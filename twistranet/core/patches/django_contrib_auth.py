@@ -1,15 +1,20 @@
 # Ok, I know this is ugly, but we have to hotfix django's authenticate() method.
 # We do so to allow auth backends to access profiles.
 # In fact, we only 'twistauthenticate' SystemAccount during this step.
+from __future__ import with_statement
 from django.contrib import auth
 from twistranet.twistapp.models import account
+from twistranet.twistapp.lib.auth_context import as_account
 from twistranet.twistapp.lib.log import *
 
 def authenticate(**credentials):
     """
     If the given credentials are valid, return a User object.
     """
-    __account__ = account.SystemAccount.get()           # This is what we just add.
+    with as_account(account.SystemAccount.get()):           # This is what we just add.
+        return _authenticate(**credentials)
+
+def _authenticate(**credentials):
     for backend in auth.get_backends():
         try:
             user = backend.authenticate(**credentials)
@@ -9,6 +9,7 @@ from django.core.urlresolvers import reverse
 from django.core.exceptions import ValidationError
 from django.core.cache import cache
 from django.utils.translation import ugettext as _
+from django.utils import translation
 from django.utils.http import urlquote
 from django.utils.safestring import mark_safe
 from django.contrib.auth import REDIRECT_FIELD_NAME
@@ -20,7 +21,7 @@ from django.shortcuts import get_object_or_404
 from twistranet.twistapp.models import *
 from twistranet.twistapp.forms import form_registry
 from twistranet.twistapp.lib.log import *
-from twistranet.twistapp.lib import utils
+from twistranet.twistapp.lib import utils, permissions, auth_context
 from twistranet.core import caches
 from twistranet.content_types.forms import CommentForm
 
@@ -44,14 +45,29 @@ class AsPublicView(object):
         """
         Save arguments for later use
         """
+        from twistranet.core.middleware import check_auth_context_middleware
         self.view_instance_class = view_instance_class
         self.args = args
         self.kw = kw
+        check_auth_context_middleware()
         
     def has_access(self, request):
         return True         # Can always access a public view
         
     def __call__(self, request, *args, **kw):
+        """
+        Bind the request to the authentication context (unless AuthContextMiddleware did) and call the view.
+        """
+        if auth_context.get_request() is request:
+            return self.call_view(request, *args, **kw)
+        previous = auth_context.get_request()
+        auth_context.bind_request(request)
+        try:
+            return self.call_view(request, *args, **kw)
+        finally:
+            auth_context.bind_request(previous)
+        
+    def call_view(self, request, *args, **kw):
         """
         This generates the actual view instance.
         """
@@ -65,8 +81,20 @@ class AsPublicView(object):
             # Instanciate the actual view class with global view arguments
             # and call its view() method with request-specific arguments
             instance_view = self.view_instance_class(request, *self.args, **self.kw)
+            
+            # Anonymous visitors all get the same page: serve it from the cache if we can
+            cache_key = instance_view.get_anonymous_cache_key()
+            if cache_key:
+                page, stamp = caches.anonymous_page_cache.get(cache_key)
+                if page is not None and stamp is None:
+                    content, content_type = page
+                    return HttpResponse(content, content_type = content_type)
+                    
             instance_view.prepare_view(*args, **kw)
-            return instance_view.render_view()
+            response = instance_view.render_view()
+            if cache_key and response.status_code == 200:
+                caches.anonymous_page_cache.set(cache_key, stamp, (response.content, response["Content-Type"], ))
+            return response
             
         except MustRedirect:
             # Here we redirect if necessary
@@ -105,6 +133,7 @@ class BaseView(object):
     ]
     view_template = None
     comment_form = None
+    anonymous_cache = False     # Set this to True if the page is the same for all anonymous visitors (see get_anonymous_cache_key)
     available_actions = []      # List of either Action objects or BaseView classes (that will be instanciated and called with view.as_action() method)
     name = None                 # The name that this will be mapped to in url.py. But you can of course override this in url.py.
     # category = GLOBAL_ACTIONS   # Override this if you want to give another default category to this view.
@@ -166,6 +195,20 @@ class BaseView(object):
     #                                           Misc. stuff                                         #
     #                                                                                               #        
 
+    def get_anonymous_cache_key(self,):
+        """
+        Return the key of this page in the anonymous pages cache (see caches.anonymous_page_cache),
+        or None if it must not be cached: authenticated account, POST request, pending messages...
+        Cached pages are invalidated whenever a public object is saved or deleted.
+        """
+        if not self.anonymous_cache or not getattr(settings, "TWISTRANET_ANONYMOUS_CACHE", True):
+            return None
+        if not self.auth.is_anonymous or self.request.method != "GET":
+            return None
+        if len(messages.get_messages(self.request)):
+            return None
+        return (translation.get_language(), self.request.is_ajax(), self.request.get_full_path(), )
+
     def get_site_domain(self,):
         """
         We use this method to save site domain while we know it.
@@ -505,16 +548,26 @@ class BaseObjectActionView(BaseIndividualView):
         
 class BaseWallView(BaseIndividualView):
     """
-    A wall has a latest_content_list parameter
+    A wall has a latest_content_list parameter.
+    
+    Walls are paginated with a cursor: the 'before' GET parameter is the id of the last content
+    of the previous page, and next_cursor the one of the current page (None if it's the last one).
+    Unlike an OFFSET, this stays fast on large walls and stable when new content arrives.
+    Ajax requests with a cursor ("load more") only get the summaries and the next link.
     """
     template_variables = BaseIndividualView.template_variables + [
         "content_forms",
         "latest_content_list",
+        "next_cursor",
     ]
+    summaries_template = "content/summaries.ajax.part.html"
+    cursor = None
+    next_cursor = None
 
     select_related_summary_fields = (
         "owner",
         "publisher",
+        "_owner_for_display",
     )
 
     def get_inline_forms(self, publisher = None):
@@ -570,13 +623,49 @@ class BaseWallView(BaseIndividualView):
         # Return the forms
         return forms
     
+    def get_page(self, queryset):
+        """
+        Return the content of the current page, newest first.
+        queryset must already be restricted to ids lower than self.cursor (if any).
+        We fetch one more id to know if there's a next page.
+        """
+        per_page = settings.TWISTRANET_CONTENT_PER_PAGE
+        ids = list(queryset.order_by("-id").values_list('id', flat = True)[:per_page + 1])
+        self.next_cursor = len(ids) > per_page and ids[per_page - 1] or None
+        return Content.objects.__booster__.filter(id__in = ids[:per_page]).select_related(*self.select_related_summary_fields).order_by("-id")
+
+    @property
+    def is_next_page(self,):
+        """
+        True if we're asked for the summaries of a next page ("load more" link).
+        """
+        return self.cursor is not None and self.request.is_ajax()
+
     def prepare_view(self, value = None):
         """
         Fetch the individual object, plus its latest content.
         """
         super(BaseWallView, self).prepare_view(value)
+        before = self.request.GET.get("before", "")
+        self.cursor = before.isdigit() and int(before) or None
         # if self.object:
-        self.latest_content_list = self.get_recent_content_list()
+        self.latest_content_list = list(self.get_recent_content_list())
+        
+        # Fetch actual content types, permissions and comments used by summaries once for the whole list
+        Twistable.objects.dereference(self.latest_content_list)
+        self.latest_content_list = Twistable.objects.annotate_permissions(
+            self.latest_content_list, (permissions.can_edit, permissions.can_delete, ), request = self.request,
+        )
+        Twistable.objects.annotate_permissions(
+            [ content.publisher for content in self.latest_content_list ], (permissions.can_publish, ), request = self.request,
+        )
+        Content.objects.prefetch_comments(self.latest_content_list, request = self.request)
+        Content.objects.prefetch_summaries(self.latest_content_list)
         self.content_forms = self.get_inline_forms(self.object)
 
+    def render_view(self, ):
+        if self.is_next_page:
+            self.template = self.summaries_template
+        return super(BaseWallView, self).render_view()
+
         
@@ -2,8 +2,11 @@
 """
 Some sample data in there.
 """
+from __future__ import with_statement
 from twistranet import *
-from twistranet.twistapp.lib.python_fixture import Fixture
+from twistranet.twistapp.lib.python_fixture import Fixture, apply_fixtures
+from twistranet.twistapp.lib.relation_import import import_relations
+from twistranet.twistapp.lib.auth_context import as_account
 from django.contrib.auth.models import User
 import random
 
@@ -154,23 +157,22 @@ for i in range(N_STATUS_UPDATES):
     )
 
 # Apply fixtures.
-__account__ = SystemAccount.objects.get()
-for obj in FIXTURES:    obj.apply()
-
-# Let users join communities. Each community can have 1-N_USERS/10 members
-print "importing back communities"
-for c in COMMUNITIES:
-    community = Community.objects.get(slug = c)
-    for n in range(random.randrange(0, N_USERS / 10)):
-        u = UserAccount.objects.get(slug = random.choice(USERNAMES))
-        # print "User %s joins %s" % (u, community)
-        community.join(u)
-
-# Admin should be friend with everybody
-print "Make admin friend with everybody"
-admin = UserAccount.objects.get(slug = "admin")
-for u in USERNAMES:
-    user = UserAccount.objects.get(slug = u)
-    user.follow(admin)
-    admin.follow(user)
+with as_account(SystemAccount.objects.get()):
+    apply_fixtures(FIXTURES)
+
+    def relations():
+        # Let users join communities. Each community can have 1-N_USERS/10 members
+        for c in COMMUNITIES:
+            for n in range(random.randrange(0, N_USERS / 10)):
+                u = random.choice(USERNAMES)
+                yield (u, c, False, )
+                yield (c, u, False, )
+
+        # Admin should be friend with everybody
+        for u in USERNAMES:
+            yield (u, "admin", False, )
+            yield ("admin", u, False, )
+
+    print "Importing relations"
+    import_relations(relations())
 
@@ -3,14 +3,12 @@ from twistranet.twistapp.models import *
 from twistranet.content_types.models import *
 from twistranet.twistapp.lib.python_fixture import Fixture
 
-__account__ = SystemAccount.get()
-
 FIXTURES = [
     Fixture(
         Document,
         force_update = True,
         slug = "help",
-        publisher = GlobalCommunity.objects.get_query_set(),
+        publisher = GlobalCommunity.objects.get_query_set(__account__ = SystemAccount.get()),
         title_en = "twistranet Help",
         title_fr = "Aide en ligne de twistranet",
         description_en = "twistranet is a social network "
@@ -132,7 +130,7 @@ Travailler avec twistranet, c'est aussi facile que cela&nbsp;!
         Document,
         force_update = True,
         slug = "help_communities",
-        publisher = GlobalCommunity.objects.get_query_set(),
+        publisher = GlobalCommunity.objects.get_query_set(__account__ = SystemAccount.get()),
         title_en = "twistranet Help: Communities",
         title_fr = "Aide de twistranet : Les Communautés",
         description_en = "Communities are a simple way to organize "
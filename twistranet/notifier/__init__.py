@@ -65,6 +65,27 @@ invite_community.connect(
     weak = False,
 )
 
+join_community_many.connect(
+    handlers.NotificationHandler(
+        owner_arg = "community",
+        publisher_arg = "community",
+        message = _(u"""New members joined %(community)s."""),
+    ),
+    weak = False,
+)
+
+invite_community_many.connect(
+    handlers.BatchNotificationHandler(
+        batch_arg = "targets",
+        item_arg = "target",
+        owner_arg = "target",
+        publisher_arg = "target",
+        permissions = "private",
+        message = _(u"""You are invited in %(community)s community"""),
+    ),
+    weak = False,
+)
+
 #                                       #
 #           Network Signals             #
 #                                       #
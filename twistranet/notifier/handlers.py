@@ -6,6 +6,7 @@ We use classes instead of functions to allow inheritance between handlers.
 
 Don't forget to connect to your signals with 'weak = False' !!
 """
+from __future__ import with_statement
 import logging
 import traceback
 import re
@@ -21,6 +22,7 @@ from django.db.models.query import QuerySet
 
 from twistranet.twistapp.lib.log import log
 from twistranet.twistapp.lib import utils
+from twistranet.twistapp.lib.auth_context import as_account
 
 SUBJECT_REGEX = re.compile(r"^[\s]*Subject:[ \t]?([^\n$]*)\n", re.IGNORECASE | re.DOTALL)
 EMPTY_LINE_REGEX = re.compile(r"\n\n+", re.DOTALL)
@@ -65,12 +67,11 @@ class NotificationHandler(NotifierHandler):
         self.message = message
         self.permissions = permissions
 
-    def __call__(self, sender, **kwargs):
+    def build(self, system, kwargs):
         """
-        We add the Notification object on behalf of SystemAccount.
+        Return the (unsaved) Notification object.
         """
         from twistranet.twistapp.models import Twistable
-        from twistranet.twistapp.models import SystemAccount
         from twistranet.notifier.models import Notification
 
         # Prepare the message dict.
@@ -80,12 +81,9 @@ class NotificationHandler(NotifierHandler):
             if isinstance(value, Twistable):
                 message_dict[param] = value.id
 
-        # We force __account__ to fake user login.
-        system = SystemAccount.get()
-        __account__ = system
         owner = kwargs.get(self.owner_arg, system)
         publisher = kwargs.get(self.publisher_arg, owner.publisher)
-        n = Notification(
+        return Notification(
             publisher = publisher,
             owner = owner,
             title = "",
@@ -93,7 +91,42 @@ class NotificationHandler(NotifierHandler):
             parameters = message_dict,
             permissions = self.permissions,
         )
-        n.save()
+
+    def __call__(self, sender, **kwargs):
+        """
+        We add the Notification object on behalf of SystemAccount.
+        """
+        from twistranet.twistapp.models import SystemAccount
+
+        # We act as SystemAccount to fake user login.
+        system = SystemAccount.get()
+        with as_account(system):
+            self.build(system, kwargs).save()
+
+class BatchNotificationHandler(NotificationHandler):
+    """
+    Same as NotificationHandler, for signals sent once per batch (eg. invite_community_many):
+    one Notification is created for each item of the batch_arg list, which is passed as item_arg.
+    They're all created at once with Twistable.objects.bulk_create_secured().
+    """
+    def __init__(self, batch_arg, item_arg, owner_arg, publisher_arg, message, permissions = "public"):
+        super(BatchNotificationHandler, self).__init__(owner_arg, publisher_arg, message, permissions)
+        self.batch_arg = batch_arg
+        self.item_arg = item_arg
+
+    def __call__(self, sender, **kwargs):
+        from twistranet.twistapp.models import Twistable
+        from twistranet.twistapp.models import SystemAccount
+
+        items = kwargs.pop(self.batch_arg, None) or ()
+        system = SystemAccount.get()
+        with as_account(system):
+            notifications = []
+            for item in items:
+                kwargs[self.item_arg] = item
+                notifications.append(self.build(system, kwargs))
+            if notifications:
+                Twistable.objects.bulk_create_secured(notifications)
 
 class MailHandler(NotifierHandler):
     """
@@ -124,14 +157,20 @@ class MailHandler(NotifierHandler):
         self.managers_only = managers_only
         
     def __call__(self, sender, **kwargs):
+        """
+        Fake-Login with SystemAccount so that everybody can be notified,
+        even users this current user can't list.
+        """
+        from twistranet.twistapp.models import SystemAccount
+        with as_account(SystemAccount.get()):
+            return self.send(sender, **kwargs)
+
+    def send(self, sender, **kwargs):
         """
         Generate the message itself.
         XXX TODO: Handle translation correctly (not from the request only)
         """
-        # Fake-Login with SystemAccount so that everybody can be notified,
-        # even users this current user can't list.
-        from twistranet.twistapp.models import SystemAccount, Account, UserAccount, Community, Twistable
-        __account__ = SystemAccount.get()
+        from twistranet.twistapp.models import Account, UserAccount, Community, Twistable
         from_email = settings.SERVER_EMAIL
         host = settings.EMAIL_HOST
         if not host:
@@ -145,6 +184,7 @@ class MailHandler(NotifierHandler):
         to_list = []
         if not isinstance(recipients, (list, tuple, QuerySet, )):
             recipients = (recipients, )
+        Twistable.objects.dereference([ r for r in recipients if isinstance(r, Twistable) ])
         for recipient in recipients:
             if isinstance(recipient, Twistable):
                 recipient = recipient.object
@@ -60,11 +60,12 @@ class Notification(Content):
         XXX HEAVILY CACHE THIS !!!
         """
         n_dict = {}
-        try:
-            for k,v in self.parameters.items():
-                n_dict[k] = Twistable.objects.get(id = v).html_link
-        except Twistable.DoesNotExist:
-            return None
+        parameters = self.parameters
+        objects = Twistable.objects.in_bulk(parameters.values())
+        for k,v in parameters.items():
+            if v not in objects:
+                return None
+            n_dict[k] = objects[v].html_link
             
         return _(self.description) % n_dict
     
@@ -2,6 +2,7 @@
 """
 Sample building script for the COGIP example.
 """
+from __future__ import with_statement
 import csv
 import os
 
@@ -9,6 +10,7 @@ from twistranet.twistapp.models import *
 from twistranet.content_types.models import *
 from twistranet.twistapp.lib.python_fixture import Fixture
 from twistranet.twistapp.lib.slugify import slugify
+from twistranet.twistapp.lib.auth_context import as_account
 from twistranet.twistapp.lib.log import *
 from twistranet.tagging.models import *
 from django.contrib.auth.models import User
@@ -42,8 +44,10 @@ def load_cogip():
     We didn't bother testing it with a pre-populated one as it doesn't make that much sense.
     """
     # Just to be sure, we log as system account
-    __account__ = SystemAccount.get()
+    with as_account(SystemAccount.get()):
+        _load_cogip()
 
+def _load_cogip():
     # Create tags
 
     # Import the whole file, creating all needed fixtures, including Service as communities.
@@ -143,13 +147,12 @@ def load_cogip():
                     approved = True
                 log.debug("Put '%s' and '%s' in their network." % (username, friend))
                 current_account = UserAccount.objects.get(slug = username)
-                __account__ = UserAccount.objects.get(slug = username)
                 friend_account = UserAccount.objects.get(slug = friend)
-                friend_account.add_to_my_network()
+                with as_account(current_account):
+                    friend_account.add_to_my_network()
                 if approved:
-                    __account__ = UserAccount.objects.get(slug = friend)
-                    current_account.add_to_my_network()
-                __account__ = SystemAccount.objects.get()
+                    with as_account(friend_account):
+                        current_account.add_to_my_network()
 
     # Create communities and join ppl from there
     f = open(os.path.join(HERE_COGIP, "communities.csv"), "rU")
@@ -183,36 +186,35 @@ def load_cogip():
     contents = csv.DictReader(f, delimiter = ';', fieldnames = ['type', 'owner', 'publisher', 'permissions', 'text', 'filename', 'tags', ])
     for content in contents:
         log.debug("Importing %s" % content)
-        __account__ = UserAccount.objects.get(slug = content['owner'])
-        if content['type'].lower() == "status":
-            log.debug("Publisher: %s" % content['publisher'])
-            status = StatusUpdate(
-                publisher = Account.objects.get(slug = content['publisher']),
-                permissions = content['permissions'],
-                description = content['text'],
-            )
-            status.save()
-            log.debug("Adding status update: %s" % status)
-        elif content['type'].lower() == 'document':
-            source_fn = os.path.join(HERE_COGIP, "documents", content['filename'])
-            file_content = ""
-            if os.path.isfile(source_fn):
-                f = open(source_fn, 'rU')
-                file_content = f.read()
-            article = Document.objects.create(
-                slug = slugify(content['filename']),
-                title = content['text'],
-                publisher = Account.objects.get(slug = content['publisher']),
-                permissions = content['permissions'],
-                text = file_content or "(empty file)",
-            )
-            for tag in generate_tags(content['tags']):
-                article.tags.add(tag)
-        elif content['type'].lower() == "comment":
-            comment = Comment.objects.create(in_reply_to = status, description = content['text'], )
-        else:
-            raise ValueError("Invalid content type: %s" % content['type'])
-        __account__ = SystemAccount.get()
+        with as_account(UserAccount.objects.get(slug = content['owner'])):
+            if content['type'].lower() == "status":
+                log.debug("Publisher: %s" % content['publisher'])
+                status = StatusUpdate(
+                    publisher = Account.objects.get(slug = content['publisher']),
+                    permissions = content['permissions'],
+                    description = content['text'],
+                )
+                status.save()
+                log.debug("Adding status update: %s" % status)
+            elif content['type'].lower() == 'document':
+                source_fn = os.path.join(HERE_COGIP, "documents", content['filename'])
+                file_content = ""
+                if os.path.isfile(source_fn):
+                    f = open(source_fn, 'rU')
+                    file_content = f.read()
+                article = Document.objects.create(
+                    slug = slugify(content['filename']),
+                    title = content['text'],
+                    publisher = Account.objects.get(slug = content['publisher']),
+                    permissions = content['permissions'],
+                    text = file_content or "(empty file)",
+                )
+                for tag in generate_tags(content['tags']):
+                    article.tags.add(tag)
+            elif content['type'].lower() == "comment":
+                comment = Comment.objects.create(in_reply_to = status, description = content['text'], )
+            else:
+                raise ValueError("Invalid content type: %s" % content['type'])
 
     # Special stuff
     cogip_menu = MenuItem.objects.get(slug = "cogip_menu")
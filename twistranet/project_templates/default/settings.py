@@ -120,6 +120,7 @@ _MIDDLEWARE_CLASSES = (
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'twistranet.core.middleware.AuthContextMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.transaction.TransactionMiddleware',
     'twistranet.core.middleware.RuntimePathsMiddleware',
@@ -150,9 +151,27 @@ TWISTRANET_STATIC_PATH = os.path.join(HERE, 'www', 'static')
 TINYMCE_JS_URL = "/static/js/tiny_mce/tiny_mce.js"
 TINYMCE_JS_ROOT = "%s/static/tiny_mce" % HERE
 
-# Cache tuning
+# Cache tuning.
+# If you run several processes (eg. several wsgi workers), CACHE_BACKEND MUST be shared between them,
+# eg. "memcached://127.0.0.1:11211/": caches are invalidated by version stamps stored in there.
+# With a per-process backend ("locmem:///", "dummy:///"), role results and relations are not kept in process memory.
 CACHE_BACKEND = "locmem:///"
+TWISTRANET_PROCESS_CACHE = None         # Keep role results and relations in process memory. None: only with a shared CACHE_BACKEND
 TWISTRANET_CACHE_USER = 60*5            # User-centric data stored for xx second
+TWISTRANET_ROLE_CACHE_SIZE = 10000      # Number of has_role() results kept in each process
+TWISTRANET_ROLE_CACHE_SHARED = False    # Also store has_role() results in the shared cache
+TWISTRANET_FOLLOW_FILTER_MAX_IDS = 500  # Above this number of followed accounts, the timeline uses a join instead of an IN clause
+TWISTRANET_FOLLOW_UNION_MAX_BRANCHES = 200 # Above this number of followed accounts, followed content is read with a single query instead of a UNION
+TWISTRANET_TIMELINE_DEPTH = 200         # Number of content ids kept in each materialized timeline
+TWISTRANET_TIMELINE_INACTIVE_DAYS = 7   # Timelines not read for that long are rebuilt when read again
+TWISTRANET_TIMELINE_FANOUT_LIMIT = 1000 # Content of publishers with more followers is merged when reading timelines
+TWISTRANET_SUMMARY_CACHE = True         # Keep rendered content summaries in the shared cache
+TWISTRANET_ANONYMOUS_CACHE = True       # Keep pages seen by anonymous visitors in the shared cache...
+TWISTRANET_ANONYMOUS_CACHE_DELAY = 60*5 # ...for xx seconds, unless a public object changes
+TWISTRANET_NETWORK_GRAPH = True         # Keep an in-memory index of relations in each process (members, network, pending requests)
+TWISTRANET_SUGGESTIONS_TOP_K = 20       # Number of "people you may know" suggestions stored per account
+TWISTRANET_SUGGESTIONS_MAX_COMMUNITY_SIZE = 500 # Members of larger communities are not suggested to each other
+TWISTRANET_SUGGESTIONS_REFRESH_ON_READ = False  # Compute stale suggestions when they're read, not only with 'twistranet_suggestions --stale'
 
 # Twistranet default settings.
 
@@ -160,9 +179,29 @@ TWISTRANET_CACHE_USER = 60*5            # User-centric data stored for xx second
 # The following section is the most likely to be changed.
 # XXXXXXXXXXXX
 
+# Authentication context. If True, the security model digs the stack to find
+# an undeclared '__account__' or 'request' variable. This is slow and deprecated,
+# use twistranet.twistapp.lib.auth_context.as_account() instead.
+TWISTRANET_AUTH_STACK_FALLBACK = False
+
+# Use the materialized access index (AccessToken table) to secure listings.
+# Run './manage.py twistranet_access_index' to build it if you upgrade an existing site.
+TWISTRANET_ACCESS_INDEX = True
+
+# When an account or community changes its visibility, objects depending on it are updated
+# immediately if there are up to this number of them. Otherwise, they're hidden until
+# './manage.py twistranet_propagate' (run it from cron) processes them. None means never defer.
+TWISTRANET_ACCESS_PROPAGATION_SYNC_LIMIT = 1000
+
+# Packed permissions storage: only _p_can_list is indexed and permission checks read roles
+# from a single packed column. This changes the DB schema: on an existing site,
+# run './manage.py twistranet_pack_permissions --drop-indexes' after setting it.
+TWISTRANET_PACKED_PERMISSIONS = False
+
 # Number of friends or communities displayed in a box
 TWISTRANET_NETWORK_IN_BOXES = 6
 TWISTRANET_FRIENDS_IN_BOXES = 9
+TWISTRANET_SUGGESTIONS_IN_BOXES = 6
 TWISTRANET_CONTENT_PER_PAGE = 25
 TWISTRANET_COMMUNITIES_PER_PAGE = 25
 TWISTRANET_DISPLAYED_COMMUNITY_MEMBERS = 9
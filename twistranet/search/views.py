@@ -11,6 +11,7 @@ from django.http import Http404
 from django.core.paginator import Paginator, InvalidPage
 from twistranet.core.views import BaseView, MustRedirect
 from twistranet.twistapp.lib.utils import truncate
+from twistranet.twistapp.models import Twistable
 
 try:
     #python 2.6
@@ -69,6 +70,20 @@ class TwistraNetSearchView(BaseView):
         except InvalidPage:
             raise Http404("No such page of results!")
 
+        # Fetch actual objects at once, as summaries need them.
+        # We match them by pk: result.object would fetch those load_all() didn't load one by one.
+        objects = {}
+        pks = [ result.pk for result in page.object_list if str(result.pk).isdigit() ]
+        for obj in Twistable.objects.dereference(Twistable.objects.filter(id__in = pks)):
+            objects[obj.id] = obj
+        object_list = []
+        for result in page.object_list:
+            obj = str(result.pk).isdigit() and objects.get(int(result.pk)) or None
+            if obj is not None:
+                result.object = obj
+                object_list.append(result)
+        page.object_list = object_list
+
         self.form = form
         self.page = page
         self.paginator = paginator
@@ -47,9 +47,8 @@ loadComments = function(ID, html) {
 }
 
 
-jq(function() 
-{
-  jq(".view_comments").click(function() 
+initViewComments = function(container) {
+  jq(".view_comments", container).click(function() 
   {
     var ID = jq(this).attr("id");
     
@@ -64,5 +63,10 @@ jq(function()
     });
     return false;
   });
+}
+
+jq(function() 
+{
+  initViewComments(document);
 });
 
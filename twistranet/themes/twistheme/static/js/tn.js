@@ -338,6 +338,7 @@ var twistranet = {
         this.showCommentsActions();
         this.initCommentForms();
         this.initconfirmdialogs();
+        this.initLoadMore();
         this.initformserrors();
         this.formsautofocus();
         this.setEmptyCols(); 
@@ -471,6 +472,36 @@ var twistranet = {
             } );       
         }
     },
+    initLoadMore: function(e) {
+        /* "load more" link at the bottom of walls: append the next page of summaries */
+        jq('a.load_more').live('click', function(e){
+            e.preventDefault();
+            var loadmore = jq(this).parents('.load-more');
+            jq.ajax({
+              type: "GET",
+              url: jq(this).attr('href'),
+              cache: false,
+              success: function(html){
+                var page = jq('<div class="load-more-page"></div>').html(html);
+                loadmore.replaceWith(page);
+                jq('.post', page).bind('mouseenter', function(){
+                  jq(this).addClass('activepost');
+                });
+                jq('.post', page).bind('mouseleave', function(){
+                  jq(this).removeClass('activepost');
+                });
+                initViewComments(page);
+                jq('.comments-container', page).each(function(){
+                    commentOnSubmit(this, jq(this).attr('id').replace('view_comments',''));
+                });
+                jq('a.confirmbefore', page).click(function(e){
+                   e.preventDefault();
+                   initConfirmBox(this);
+                } );
+              }
+            });
+        });
+    },
     initformserrors: function(e) {
       jq('.fieldWrapper .errorlist').each(function(){
           jq(jq(this).parent()).addClass('fieldWrapperWithError');
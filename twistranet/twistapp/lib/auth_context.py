@@ -0,0 +1,71 @@
+"""
+Request-scoped authentication context.
+
+The security model needs to know which account is currently authenticated
+for every permission check. Instead of digging into the interpreter stack,
+we bind it explicitly:
+
+- AuthContextMiddleware binds the current request for the duration of the request ;
+- the as_account() context manager temporarily logs in as a given account, eg.:
+
+    with as_account(SystemAccount.get()):
+        community.join(account)
+
+Accounts bound with as_account() always have precedence over the request,
+exactly like the former '__account__' local variable did.
+"""
+import threading
+
+__all__ = ["as_account", "bind_request", "unbind_request", "get_account", "get_request", ]
+
+class _AuthContext(threading.local):
+    """
+    Thread-local holder for the request and the stack of explicitly bound accounts.
+    """
+    def __init__(self):
+        self.request = None
+        self.accounts = []
+
+_context = _AuthContext()
+
+def bind_request(request):
+    """
+    Bind the given request to the current thread.
+    """
+    _context.request = request
+
+def unbind_request():
+    """
+    Forget about the current request.
+    """
+    _context.request = None
+
+def get_request():
+    """
+    Return the currently bound request or None.
+    """
+    return _context.request
+
+def get_account():
+    """
+    Return the innermost account bound with as_account(), or None.
+    """
+    if _context.accounts:
+        return _context.accounts[-1]
+    return None
+
+class as_account(object):
+    """
+    Context manager used to act on behalf of the given account.
+    Calls can be nested, the innermost account wins.
+    """
+    def __init__(self, account):
+        self.account = account
+
+    def __enter__(self):
+        _context.accounts.append(self.account)
+        return self.account
+
+    def __exit__(self, exc_type, exc_value, tb):
+        _context.accounts.pop()
+        return False
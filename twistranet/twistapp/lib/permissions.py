@@ -12,6 +12,46 @@ can_leave = "can_leave"
 can_create = "can_create"
 can_delete = "can_delete"
 
+# Packed storage of the roles (see Twistable._p_packed).
+# Each role is stored as its level (1 = public ... 5 = system, 0 = unknown) on 3 bits.
+# NEVER reorder this tuple, as it's the storage format. Only append to it.
+packed_permissions = (
+    can_view,
+    can_edit,
+    can_list,
+    can_list_members,
+    can_publish,
+    can_join,
+    can_leave,
+    can_create,
+)
+_role_levels = (public, network, manager, owner, system, )
+
+def pack_roles(role_dict):
+    """
+    Return the packed integer of the roles given as a {permission: role} dict.
+    """
+    packed = 0
+    for i, permission in enumerate(packed_permissions):
+        role = role_dict.get(permission)
+        if role in _role_levels:
+            packed |= (_role_levels.index(role) + 1) << (3 * i)
+    return packed
+
+def unpack_role(packed, permission):
+    """
+    Return the role stored for the given permission in a packed integer,
+    or None if it's not stored.
+    """
+    try:
+        i = packed_permissions.index(permission)
+    except ValueError:
+        return None
+    level = (packed >> (3 * i)) & 7
+    if not level:
+        return None
+    return _role_levels[level - 1]
+
 # Special role arrangements
 class PermissionTemplate:
     """
@@ -1,6 +1,13 @@
+from __future__ import with_statement
+import time
+from django.db import transaction
 from django.db.models.query import QuerySet
 from twistranet.twistapp.models import Twistable
 from  twistranet.twistapp.lib.log import log
+from twistranet.twistapp.lib.auth_context import as_account
+
+# Number of fixtures applied per transaction by FixtureLoader
+FIXTURE_CHUNK_SIZE = 200
 
 class Fixture(object):
     """
@@ -19,10 +26,10 @@ class Fixture(object):
     def apply(self,):
         """
         Create / update model. Use the 'slug' attribute to define unicity of the content.
+        To apply many fixtures, use FixtureLoader instead: it's much faster.
         """
         from twistranet.twistapp.models import Account
         slug = self.dict.get('slug', None)
-        obj = None
         log.debug("Trying to import %s" % slug)
         
         # Check if slug is given. Mandatory.
@@ -31,24 +38,37 @@ class Fixture(object):
         
         # Set auth if necessary
         if self.logged_account:
-            __account__ = Account.objects.get(slug = self.logged_account)
+            with as_account(Account.objects.get(slug = self.logged_account)):
+                return self._apply(self._get_existing(slug))
+        return self._apply(self._get_existing(slug))
         
-        # Create/get object
+    def _get_existing(self, slug):
+        """
+        Return the existing object with the given slug, or None.
+        """
         if slug:
             obj_q = Twistable.objects.__booster__.filter(slug = slug)
             if obj_q.exists():
-                obj = obj_q.get().object
-                if not self.force_update:
-                    # Object already exists and we don't want to update. Keep it that way.
-                    return obj
-        if not obj:
+                return obj_q.get().object
+        return None
+
+    def _apply(self, obj, resolve = None):
+        """
+        Actually create / update the object, as the current authenticated account.
+        obj is the existing object (or None).
+        resolve(queryset) is used to get the value of QuerySet attributes, if given.
+        """
+        if obj is not None and not self.force_update:
+            # Object already exists and we don't want to update. Keep it that way.
+            return obj
+        if obj is None:
             obj = self.model()
             
         # Set properties & save
         for k, v in self.dict.items():
             # print self.model, k, v
             if isinstance(v, QuerySet):
-                v = v.get()
+                v = resolve and resolve(v) or v.get()
             setattr(obj, k, v)
         try:
             obj.save()
@@ -57,3 +77,125 @@ class Fixture(object):
             raise
         
         return obj
+
+
+class FixtureLoader(object):
+    """
+    Apply a list of fixtures in a batch:
+    - existing slugs are loaded upfront (one query, plus one per model to get the actual objects) ;
+    - logged_account and QuerySet attributes are resolved once per distinct value ;
+    - fixtures are applied chunk_size at a time, each chunk in its own transaction
+      (unless the caller already manages the transaction) ;
+    - timings are collected per model, see report().
+
+    Fixtures are applied in order, as later fixtures may refer to objects created by earlier ones.
+    """
+    def __init__(self, chunk_size = None):
+        self.chunk_size = chunk_size or FIXTURE_CHUNK_SIZE
+        self.timings = {}           # Model name: [number of fixtures, seconds]
+        self._existing = {}         # slug: object
+        self._accounts = {}         # slug: account
+        self._resolved = {}         # (model, SQL): object
+
+    def _preload(self, slugs):
+        """
+        Load the existing objects with one of the given slugs.
+        """
+        slugs = list(set(slugs))
+        bases = []
+        for i in range(0, len(slugs), self.chunk_size):
+            bases.extend(Twistable.objects.__booster__.filter(slug__in = slugs[i:i + self.chunk_size]))
+        for obj in Twistable.objects.dereference(bases):
+            self._existing[obj.slug] = obj
+
+    def _get_account(self, slug):
+        from twistranet.twistapp.models import Account
+        if not self._accounts.has_key(slug):
+            self._accounts[slug] = Account.objects.get(slug = slug)
+        return self._accounts[slug]
+
+    def _resolve(self, qs):
+        key = (qs.model, unicode(qs.query), )
+        if not self._resolved.has_key(key):
+            self._resolved[key] = qs.get()
+        return self._resolved[key]
+
+    def _apply(self, fixture):
+        slug = fixture.dict['slug']
+        log.debug("Trying to import %s" % slug)
+        existing = slug and self._existing.get(slug) or None
+        if fixture.logged_account:
+            with as_account(self._get_account(fixture.logged_account)):
+                obj = fixture._apply(existing, self._resolve)
+        else:
+            obj = fixture._apply(existing, self._resolve)
+        if slug:
+            self._existing[slug] = obj
+        return obj
+
+    def _apply_chunk(self, fixtures):
+        """
+        Apply the given fixtures, grouping consecutive fixtures of the same model for timing purposes.
+        """
+        ret = []
+        start = 0
+        while start < len(fixtures):
+            model = fixtures[start].model
+            end = start
+            while end < len(fixtures) and fixtures[end].model is model:
+                end += 1
+            t0 = time.time()
+            for fixture in fixtures[start:end]:
+                ret.append(self._apply(fixture))
+            timing = self.timings.setdefault(model.__name__, [0, 0.0, ])
+            timing[0] += end - start
+            timing[1] += time.time() - t0
+            start = end
+        return ret
+
+    def load(self, fixtures):
+        """
+        Apply the given fixtures. Return the list of created / existing objects.
+        """
+        fixtures = list(fixtures)
+        for fixture in fixtures:
+            if not fixture.dict.has_key('slug'):
+                raise ValueError("You can't apply this fixture without a slug attribute. This is so to avoid duplicates.")
+        self._preload([ fixture.dict['slug'] for fixture in fixtures if fixture.dict['slug'] ])
+
+        ret = []
+        managed = transaction.is_managed()
+        for i in range(0, len(fixtures), self.chunk_size):
+            if not managed:
+                transaction.enter_transaction_management()
+                transaction.managed(True)
+            try:
+                try:
+                    ret.extend(self._apply_chunk(fixtures[i:i + self.chunk_size]))
+                    if not managed:
+                        transaction.commit()
+                except:
+                    if not managed:
+                        transaction.rollback()
+                    raise
+            finally:
+                if not managed:
+                    transaction.leave_transaction_management()
+        return ret
+
+    def report(self,):
+        """
+        Log timings per model.
+        """
+        for name, (count, elapsed) in sorted(self.timings.items(), key = lambda t: -t[1][1]):
+            log.info("Fixtures: %d %s in %.2fs" % (count, name, elapsed, ))
+
+def apply_fixtures(fixtures, chunk_size = None):
+    """
+    Apply the given fixtures with a FixtureLoader and log timings.
+    Return the list of created / existing objects.
+    """
+    loader = FixtureLoader(chunk_size)
+    ret = loader.load(fixtures)
+    loader.report()
+    return ret
@@ -0,0 +1,158 @@
+"""
+Bulk import of relations (Network objects), to seed or migrate large graphs.
+
+RelationImporter streams (client, target[, is_manager]) edges where accounts are given by slug or id,
+and creates them with Network.objects.bulk_add(): relations which already exist are skipped,
+rows are inserted in chunks, one transaction per chunk.
+
+Notification signals are NOT sent unless send_signals is True. Then, for each chunk:
+- accept_in_network / request_add_to_network are sent for relations between users ;
+- join_community_many / invite_community_many are sent for community memberships and invitations.
+"""
+from __future__ import with_statement
+import csv
+import time
+from  twistranet.twistapp.lib.log import log
+
+# Number of relations created per transaction by RelationImporter
+RELATION_CHUNK_SIZE = 1000
+
+def is_manager_flag(value):
+    """
+    Return the is_manager flag of an edge: booleans are kept as is,
+    strings are True if they're "1", "true" or "yes" (case insensitive).
+    """
+    if isinstance(value, basestring):
+        return value.strip().lower() in ("1", "true", "yes", )
+    return bool(value)
+
+def read_edges(f, delimiter = ","):
+    """
+    Yield (client, target, is_manager) tuples from a CSV file object.
+    Each line is 'client,target[,is_manager]' (slugs or ids). Empty lines and lines starting with '#' are skipped.
+    """
+    for row in csv.reader(f, delimiter = delimiter):
+        if not row or not row[0].strip() or row[0].startswith("#"):
+            continue
+        yield (row[0].strip(), row[1].strip(), len(row) > 2 and is_manager_flag(row[2]), )
+
+class RelationImporter(object):
+    """
+    Create relations set-wise and keep statistics: read, created and unknown (unresolved) edges,
+    and elapsed time.
+    """
+    def __init__(self, chunk_size = None, send_signals = False):
+        self.chunk_size = chunk_size or RELATION_CHUNK_SIZE
+        self.send_signals = send_signals
+        self.read = 0
+        self.created = 0
+        self.unknown = 0
+        self.elapsed = 0.0
+        self._ids = None
+        self._known_ids = None
+
+    def _account_id(self, value):
+        """
+        Return the id of the account with the given id (or slug), or None if there's no such account.
+        Numeric values are ids if such an account exists, else slugs. Slugs and ids are all loaded at once on first use.
+        """
+        from twistranet.twistapp.models import Account
+        if self._ids is None:
+            self._ids = dict(Account.objects.__booster__.values_list("slug", "id").iterator())
+            self._known_ids = set(self._ids.values())
+        if isinstance(value, (int, long, )):
+            return value in self._known_ids and value or None
+        if value.isdigit() and int(value) in self._known_ids:
+            return int(value)
+        return self._ids.get(value)
+
+    def edges(self, rows):
+        """
+        Resolve the (client, target[, is_manager]) rows into (client_id, target_id, is_manager) edges.
+        String flags are parsed like read_edges() does.
+        """
+        for row in rows:
+            self.read += 1
+            client_id, target_id = self._account_id(row[0]), self._account_id(row[1])
+            if client_id is None or target_id is None:
+                self.unknown += 1
+                log.debug("Unknown account in relation %s => %s" % (row[0], row[1], ))
+                continue
+            yield (client_id, target_id, len(row) > 2 and is_manager_flag(row[2]), )
+
+    def _notify(self, created):
+        """
+        Send the notification signals for a chunk of created relations.
+        """
+        from twistranet.twistapp.models import Twistable, Account, UserAccount, Community, Network, SystemAccount
+        from twistranet.twistapp.signals import accept_in_network, request_add_to_network
+        from twistranet.twistapp.signals import join_community_many, invite_community_many
+        from twistranet.twistapp.models.network import _chunks, SQL_CHUNK
+        from twistranet.twistapp.lib.auth_context import as_account
+        ids = set([ c for c, t, m in created ]) | set([ t for c, t, m in created ])
+        bases = []
+        for chunk in _chunks(ids, SQL_CHUNK):
+            bases.extend(Account.objects.__booster__.filter(id__in = chunk))
+        accounts = dict([ (a.id, a) for a in Twistable.objects.dereference(bases) ])
+        reverse = Network.objects.existing_pairs([ (t, c) for c, t, m in created ])
+        joins, invites = {}, {}
+        with as_account(SystemAccount.get()):
+            for client_id, target_id, is_manager in created:
+                client, target = accounts.get(client_id), accounts.get(target_id)
+                if client is None or target is None:
+                    continue
+                mutual = (target_id, client_id) in reverse
+                if isinstance(client, UserAccount) and isinstance(target, UserAccount):
+                    signal = mutual and accept_in_network or request_add_to_network
+                    signal.send(sender = client.__class__, client = client, target = target)
+                elif isinstance(target, Community) and mutual:
+                    joins.setdefault(target_id, []).append(client)
+                elif isinstance(client, Community) and isinstance(target, UserAccount):
+                    (mutual and joins or invites).setdefault(client_id, []).append(target)
+            for community_id, clients in joins.items():
+                community = accounts[community_id]
+                join_community_many.send(sender = community.__class__, clients = clients, community = community)
+            for community_id, targets in invites.items():
+                community = accounts[community_id]
+                invite_community_many.send(sender = community.__class__, targets = targets, community = community)
+
+    def load(self, rows, progress = None):
+        """
+        Create the relations given as (client, target[, is_manager]) rows. rows can be any iterable:
+        it's consumed one chunk at a time. progress(importer) is called after each chunk.
+        Return the number of created relations.
+        """
+        from twistranet.twistapp.models import Network
+        t0 = time.time()
+        def batch_done(batch):
+            self.created += len(batch)
+            self.elapsed = time.time() - t0
+            if self.send_signals and batch:
+                self._notify(batch)
+            if progress:
+                progress(self)
+        ret = Network.objects.bulk_add(self.edges(rows), batch_size = self.chunk_size, batch_done = batch_done)
+        self.elapsed = time.time() - t0
+        return ret
+
+    @property
+    def throughput(self):
+        """
+        Number of edges processed per second.
+        """
+        return self.elapsed and self.read / self.elapsed or 0.0
+
+    def report(self,):
+        log.info("Relations: %d read, %d created, %d unknown in %.2fs (%.0f edges/s)" % (
+            self.read, self.created, self.unknown, self.elapsed, self.throughput,
+        ))
+
+def import_relations(rows, chunk_size = None, send_signals = False):
+    """
+    Create the given (client, target[, is_manager]) relations with a RelationImporter and log statistics.
+    Return the number of created relations.
+    """
+    importer = RelationImporter(chunk_size, send_signals)
+    ret = importer.load(rows)
+    importer.report()
+    return ret
@@ -1,3 +1,4 @@
+from __future__ import with_statement
 from django.core.cache import cache
 from django.conf import settings
 
@@ -11,13 +12,11 @@ def _get_site_name_or_baseline(return_baseline = False):
     baseline = d.get("baseline", None)
     if site_name is None or baseline is None:
         from twistranet.twistapp.models import SystemAccount, GlobalCommunity
-        __account__ = SystemAccount.get()
-        try:
+        from twistranet.twistapp.lib.auth_context import as_account
+        with as_account(SystemAccount.get()):
             glob = GlobalCommunity.get()
             site_name = glob.site_name
             baseline = glob.baseline
-        finally:
-            del __account__
         cache.set('twistranet_site_name', site_name)
         cache.set("twistranet_baseline", baseline)
     if return_baseline:
@@ -0,0 +1,30 @@
+"""
+Check or rebuild the access index.
+"""
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+
+class Command(BaseCommand):
+    args = ''
+    help = """Rebuild the access index used to secure listings (including the anonymous visibility flags).
+Missing columns and indexes are created. Use --check to only report inconsistencies."""
+    option_list = BaseCommand.option_list + (
+        make_option('--check', action = 'store_true', dest = 'check', default = False,
+            help = 'Only check the access index consistency, do not write anything'),
+    )
+
+    def handle(self, *args, **options):
+        from twistranet.twistapp.models import AccessToken, indexes
+        if not options.get('check'):
+            for column in ("_access_token", "_is_anonymous_visible", ):
+                if indexes.add_column(column):
+                    print "Added the %s column." % column
+            for name in indexes.create_composite_indexes():
+                print "Created index %s." % name
+            AccessToken.objects.rebuild()
+            print "Access index rebuilt."
+        errors = AccessToken.objects.check()
+        for k, v in errors.items():
+            print "%-30s %d" % (k, v)
+        if options.get('check') and sum(errors.values()):
+            raise CommandError("Access index is inconsistent. Run this command without --check to rebuild it.")
@@ -0,0 +1,30 @@
+"""
+Run performance benchmarks.
+Use this against a populated database (see fixtures/heavy_load.py).
+"""
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+
+class Command(BaseCommand):
+    args = '<benchmark benchmark ...>'
+    help = 'Run twistranet performance benchmarks. Run without argument to list available benchmarks.'
+    option_list = BaseCommand.option_list + (
+        make_option('--objects', action = 'store', type = 'int', dest = 'objects', default = 100,
+            help = 'Number of objects to work with'),
+        make_option('--repeat', action = 'store', type = 'int', dest = 'repeat', default = 10,
+            help = 'Number of times each measure is repeated'),
+        make_option('--depth', action = 'store', type = 'int', dest = 'depth', default = 30,
+            help = 'Stack depth to emulate when digging the stack'),
+    )
+
+    def handle(self, *args, **options):
+        from twistranet.core.benchmarks import BENCHMARKS
+        if not args:
+            for name in sorted(BENCHMARKS.keys()):
+                print "%-30s %s" % (name, (BENCHMARKS[name].__doc__ or "").strip().split("\n")[0])
+            return
+        for name in args:
+            if not BENCHMARKS.has_key(name):
+                raise CommandError("Unknown benchmark: %s" % name)
+            print "=== %s ===" % name
+            BENCHMARKS[name](options)
@@ -0,0 +1,27 @@
+"""
+Report the hit rate of the shared fragment caches.
+"""
+from optparse import make_option
+from django.core.management.base import BaseCommand
+
+class Command(BaseCommand):
+    args = ''
+    help = """Print hits, misses and hit rate of the rendered fragments caches (content summaries),
+as counted by all processes sharing the cache. Use --reset to start counting again."""
+    option_list = BaseCommand.option_list + (
+        make_option('--reset', action = 'store_true', dest = 'reset', default = False,
+            help = 'Reset the counters after printing them'),
+    )
+
+    def handle(self, *args, **options):
+        from twistranet.core import caches
+        for fragments in (caches.summary_cache, ):
+            stats = fragments.stats()
+            if stats["hit_rate"] is None:
+                print "%-10s no request yet." % fragments.name
+            else:
+                print "%-10s %8d hits %8d misses => %5.1f%% hit rate" % (
+                    fragments.name, stats["hits"], stats["misses"], stats["hit_rate"] * 100,
+                )
+            if options.get('reset'):
+                fragments.reset_stats()
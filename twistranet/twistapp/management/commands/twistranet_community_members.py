@@ -0,0 +1,68 @@
+"""
+Make the accounts listed in a CSV file join (or be invited in) a community.
+"""
+from __future__ import with_statement
+import csv
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+
+class Command(BaseCommand):
+    args = '<community slug> <csv file>'
+    help = """Make the accounts listed in the first column of a CSV file join a community, in batches.
+Accounts are given by username or email. Current members are skipped."""
+    option_list = BaseCommand.option_list + (
+        make_option('--invite', action = 'store_true', dest = 'invite', default = False,
+            help = 'Invite the accounts instead of making them join'),
+        make_option('--manager', action = 'store_true', dest = 'manager', default = False,
+            help = 'Accounts join as community managers'),
+        make_option('--batch-size', action = 'store', type = 'int', dest = 'batch_size', default = None,
+            help = 'Number of accounts added in each transaction'),
+    )
+
+    def handle(self, *args, **options):
+        from twistranet.twistapp.models import Community, UserAccount, SystemAccount
+        from twistranet.twistapp.models.network import _chunks, SQL_CHUNK
+        from twistranet.twistapp.lib.auth_context import as_account
+        if len(args) != 2:
+            raise CommandError("Usage: twistranet_community_members %s" % self.args)
+        slug, filename = args
+        verbosity = int(options.get('verbosity', 1))
+
+        names = []
+        with open(filename, "rb") as f:
+            for row in csv.reader(f):
+                if row and row[0].strip() and not row[0].startswith("#"):
+                    names.append(row[0].strip().decode("utf-8"))
+
+        with as_account(SystemAccount.get()):
+            try:
+                community = Community.objects.get(slug = slug)
+            except Community.DoesNotExist:
+                raise CommandError("Community '%s' doesn't exist." % slug)
+
+            # Resolve accounts set-wise, by username then by email
+            accounts = {}
+            for chunk in _chunks(set(names), SQL_CHUNK):
+                for account in UserAccount.objects.__booster__.filter(user__username__in = chunk).select_related("user"):
+                    accounts[account.user.username] = account
+                missing = [ name for name in chunk if name not in accounts ]
+                if missing:
+                    for account in UserAccount.objects.__booster__.filter(user__email__in = missing).select_related("user"):
+                        accounts[account.user.email] = account
+            unknown = [ name for name in names if name not in accounts ]
+            found = [ accounts[name] for name in names if name in accounts ]
+
+            if options.get('invite'):
+                added = community.invite_many(found, batch_size = options.get('batch_size'))
+                action = "invited in"
+            else:
+                added = community.join_many(found, is_manager = options.get('manager'), batch_size = options.get('batch_size'))
+                action = "joined"
+
+        if verbosity > 1:
+            for name in unknown:
+                print "Unknown account: %s" % name.encode("utf-8")
+        if verbosity:
+            print "%d accounts %s %s, %d skipped, %d unknown." % (
+                len(added), action, slug, len(set([ a.id for a in found ])) - len(added), len(unknown),
+            )
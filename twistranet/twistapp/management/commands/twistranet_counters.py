@@ -0,0 +1,31 @@
+"""
+Check or repair the relationship and comment counters.
+"""
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+
+class Command(BaseCommand):
+    args = ''
+    help = """Recount network, followers, community members and managers from the relations table,
+and comments of each content, and repair the counters which drifted.
+Missing columns are created. Use --check to only report them."""
+    option_list = BaseCommand.option_list + (
+        make_option('--check', action = 'store_true', dest = 'check', default = False,
+            help = 'Only count drifted counters, do not write anything'),
+    )
+
+    def handle(self, *args, **options):
+        from twistranet.twistapp.models import RelationCounters, Content, indexes
+        from twistranet.twistapp.models.counters import rebuild_comment_counts
+        check = options.get('check')
+        if not check:
+            if indexes.add_column("comment_count", Content):
+                print "Added the comment_count column."
+        drifted = RelationCounters.objects.rebuild(check = check)
+        drifted_comments = rebuild_comment_counts(check = check)
+        if check:
+            print "%d relation counters and %d comment counts drifted." % (drifted, drifted_comments, )
+            if drifted or drifted_comments:
+                raise CommandError("Counters are inconsistent. Run this command without --check to repair them.")
+        else:
+            print "%d relation counters and %d comment counts repaired." % (drifted, drifted_comments, )
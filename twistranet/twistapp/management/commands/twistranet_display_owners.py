@@ -0,0 +1,29 @@
+"""
+Compute the stored author to display of contents.
+"""
+from optparse import make_option
+from django.core.management.base import BaseCommand
+
+class Command(BaseCommand):
+    args = ''
+    help = """Compute the stored author to display of the contents which don't have one
+(new contents of an upgraded site, contents whose owner joined or left the publisher community).
+Missing columns are created. Run this regularly (eg. from cron)."""
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', action = 'store', type = 'int', dest = 'chunk_size', default = 500,
+            help = 'Number of contents updated in each transaction'),
+        make_option('--max-chunks', action = 'store', type = 'int', dest = 'max_chunks', default = None,
+            help = 'Stop after this number of chunks. Remaining work is resumed on next run.'),
+    )
+
+    def handle(self, *args, **options):
+        from twistranet.twistapp.models import Content, indexes
+        verbosity = int(options.get('verbosity', 1))
+        if indexes.add_column("_owner_for_display", Content) and verbosity:
+            print "Added the _owner_for_display column."
+        def progress(last_id, n_updated):
+            if verbosity > 1:
+                print "%d contents updated (last id: %d)" % (n_updated, last_id, )
+        n = Content.objects.update_owners_for_display(options.get('chunk_size'), options.get('max_chunks'), progress)
+        if verbosity:
+            print "%d contents updated." % (n, )
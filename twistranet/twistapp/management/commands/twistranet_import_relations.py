@@ -0,0 +1,40 @@
+"""
+Import relations (follows, network, community memberships) from a CSV file.
+"""
+import sys
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+
+class Command(BaseCommand):
+    args = '<csv file>'
+    help = """Create the relations listed in a CSV file ('-' reads the standard input), in chunks.
+Each line is 'client,target[,is_manager]', accounts being given by slug or id.
+Relations which already exist are skipped. Notifications are not sent unless --notify is given."""
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', action = 'store', type = 'int', dest = 'chunk_size', default = None,
+            help = 'Number of relations created in each transaction'),
+        make_option('--delimiter', action = 'store', dest = 'delimiter', default = ',',
+            help = 'CSV field delimiter'),
+        make_option('--notify', action = 'store_true', dest = 'notify', default = False,
+            help = 'Send the network and community signals (notifications, emails)'),
+    )
+
+    def handle(self, *args, **options):
+        from twistranet.twistapp.lib.relation_import import RelationImporter, read_edges
+        if len(args) != 1:
+            raise CommandError("Usage: twistranet_import_relations %s" % self.args)
+        verbosity = int(options.get('verbosity', 1))
+        def progress(importer):
+            if verbosity > 1:
+                print "%d relations read, %d created (%.0f edges/s)" % (importer.read, importer.created, importer.throughput, )
+
+        importer = RelationImporter(options.get('chunk_size'), options.get('notify'))
+        if args[0] == "-":
+            importer.load(read_edges(sys.stdin, options.get('delimiter')), progress)
+        else:
+            with open(args[0], "rb") as f:
+                importer.load(read_edges(f, options.get('delimiter')), progress)
+        if verbosity:
+            print "%d relations read, %d created, %d with unknown accounts, in %.2fs (%.0f edges/s)." % (
+                importer.read, importer.created, importer.unknown, importer.elapsed, importer.throughput,
+            )
@@ -0,0 +1,25 @@
+"""
+Migrate an existing database to packed permissions and composite indexes.
+"""
+from optparse import make_option
+from django.core.management.base import BaseCommand
+
+class Command(BaseCommand):
+    args = ''
+    help = """Add and fill the packed permissions column (_p_packed) and create composite indexes.
+Safe to run several times. Use --drop-indexes once TWISTRANET_PACKED_PERMISSIONS is set."""
+    option_list = BaseCommand.option_list + (
+        make_option('--drop-indexes', action = 'store_true', dest = 'drop_indexes', default = False,
+            help = 'Also drop the single-column permission indexes, which are useless in packed mode'),
+    )
+
+    def handle(self, *args, **options):
+        from twistranet.twistapp.models import indexes
+        if indexes.add_column("_p_packed"):
+            print "Added the _p_packed column."
+        print "Packed permissions of %d objects." % indexes.pack_permission_columns()
+        for name in indexes.create_composite_indexes():
+            print "Created index %s." % name
+        if options.get('drop_indexes'):
+            for name in indexes.drop_unused_indexes():
+                print "Dropped index %s." % name
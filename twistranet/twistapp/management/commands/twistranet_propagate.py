@@ -0,0 +1,26 @@
+"""
+Process pending access network propagations.
+"""
+from optparse import make_option
+from django.core.management.base import BaseCommand
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Process pending access network propagations. Run this regularly (eg. from cron).'
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', action = 'store', type = 'int', dest = 'chunk_size', default = 500,
+            help = 'Number of objects updated in each transaction'),
+        make_option('--max-chunks', action = 'store', type = 'int', dest = 'max_chunks', default = None,
+            help = 'Stop after this number of chunks. Remaining work is resumed on next run.'),
+    )
+
+    def handle(self, *args, **options):
+        from twistranet.twistapp.models import AccessPropagation
+        verbosity = int(options.get('verbosity', 1))
+        def progress(job):
+            if verbosity > 1:
+                print "Propagation from %s: %d objects updated (last id: %d)" % (job.source_id, job.processed, job.last_id, )
+        n = AccessPropagation.objects.process(options.get('chunk_size'), options.get('max_chunks'), progress)
+        pending = AccessPropagation.objects.count()
+        if verbosity:
+            print "%d objects updated, %d propagations still pending." % (n, pending, )
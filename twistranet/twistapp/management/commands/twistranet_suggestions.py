@@ -0,0 +1,37 @@
+"""
+Compute the "people you may know" suggestions of all accounts.
+"""
+import time
+from optparse import make_option
+from django.core.management.base import BaseCommand
+
+class Command(BaseCommand):
+    args = ''
+    help = """Score the suggestions of every user account from the relations table (shared network members
+and communities) and store the best ones. Run it regularly, eg. from cron, and after importing relations.
+With --stale, only the accounts whose relations changed since are scored again (run it more often)."""
+    option_list = BaseCommand.option_list + (
+        make_option('--top-k', action = 'store', type = 'int', dest = 'top_k', default = None,
+            help = 'Number of suggestions stored per account'),
+        make_option('--stale', action = 'store_true', dest = 'stale', default = False,
+            help = 'Only score the accounts whose relations changed'),
+    )
+
+    def handle(self, *args, **options):
+        from twistranet.twistapp.models import Suggestion
+        verbosity = int(options.get('verbosity', 1))
+        def batch_done(accounts, stored):
+            if verbosity > 1:
+                print "%d accounts done, %d suggestions stored" % (accounts, stored, )
+        t0 = time.time()
+        if options.get('stale'):
+            def stale_done(accounts):
+                if verbosity > 1:
+                    print "%d accounts done" % accounts
+            accounts = Suggestion.objects.refresh_stale(top_k = options.get('top_k'), batch_done = stale_done)
+            if verbosity:
+                print "%d accounts refreshed in %.2fs." % (accounts, time.time() - t0, )
+            return
+        stored = Suggestion.objects.rebuild(top_k = options.get('top_k'), batch_done = batch_done)
+        if verbosity:
+            print "%d suggestions stored in %.2fs." % (stored, time.time() - t0, )
@@ -10,7 +10,13 @@ from resource import Resource
 # Higher level stuff
 from account import UserAccount, SystemAccount
 from community import GlobalCommunity, AdminCommunity
-from network import Network
+from network import Network, AccessToken
+from propagation import AccessPropagation
+from slug import SlugCounter
+from counters import RelationCounters
+from timeline import Timeline, TimelineEntry
+from suggestion import Suggestion, StaleSuggestion
+import indexes          # Composite indexes are created after syncdb
 
 # Menu / Taxonomy management
 from menu import Menu, MenuItem
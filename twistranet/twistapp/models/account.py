@@ -1,3 +1,4 @@
+from __future__ import with_statement
 from django.db import models
 from django.db.models import Q
 from django.core.cache import cache
@@ -8,6 +9,8 @@ from django.conf import settings
 import twistable
 from resource import Resource
 from twistranet.twistapp.lib import permissions, roles, languages, slugify
+from twistranet.twistapp.lib.auth_context import as_account
+from twistranet.core import caches
 from twistranet.twistapp.signals import request_add_to_network, accept_in_network
 from  twistranet.twistapp.lib.log import log
 
@@ -33,7 +36,11 @@ class Account(twistable.Twistable):
     type_summary_view = "account/summary.part.html"
     is_account = True
     
-    _role_cache = {}
+    # Process-wide has_role() cache. See twistranet.core.caches.RoleCache.
+    _role_cache = caches.RoleCache(
+        size = getattr(settings, "TWISTRANET_ROLE_CACHE_SIZE", caches.ROLE_CACHE_SIZE),
+        shared = getattr(settings, "TWISTRANET_ROLE_CACHE_SHARED", False),
+    )
     
     # Other shortcuts
     @property
@@ -93,23 +100,32 @@ class Account(twistable.Twistable):
     def has_role(self, role, obj = None, ):
         """
         Return if SELF account has the given role on the given object.
-        XXX TODO Heavily uses caching and optimize queries
-        XXX TODO Make only one query for db-dependant roles?
         
-        Warning: This method can return different results when called
-        from the authenticated user or not. We should only cache calls made
-        from currently authenticated user.
+        Results are cached across requests in _role_cache, stamped with the versions
+        of both self and obj. Those are bumped whenever the account's network,
+        the object's permissions or its access network change.
         
         If a user has a role on an object, that doesn't means he has a permision...
+        """
+        if obj is None:
+            obj = self
+        if not self.id or not obj.id or isinstance(self, SystemAccount):
+            return self._has_role(role, obj)
+        key = (self.id, obj.id, role, )
+        stamp = self._role_cache.stamp(self.id, obj.id)
+        ret = self._role_cache.get(key, stamp)
+        if ret is None:
+            ret = self._has_role(role, obj)
+            self._role_cache.set(key, stamp, ret)
+        return ret
         
-        You can pass either an obj or a twistable id (to avoid dereferencing the
-        underlying object if we can, for performance reasons).
-        
+    def _has_role(self, role, obj, network_ids = None, ):
+        """
+        Actually compute has_role(), without caching.
+        network_ids can be given as a set to avoid querying it (see has_permission_many()).
         XXX TODO: Oh, BTW, we should check if the role actually exists!
         """
         auth = self
-        if obj is None:
-            obj = self
                 
         # System Account is allowed to do anything.
         if isinstance(auth, SystemAccount):
@@ -118,7 +134,6 @@ class Account(twistable.Twistable):
             return False
         
         # Owner has all roles lower than owner.
-        nwk = auth.network_ids
         if (obj.id == auth.id) or (obj.owner_id == auth.id):
             if role <= roles.owner:
                 return True
@@ -144,7 +159,9 @@ class Account(twistable.Twistable):
         else:
             # XXX Maybe we could avoid this unncessary query, though I doubt so
             pub = obj.publisher_id
-        if pub in nwk:
+        if network_ids is None:
+            network_ids = auth.network_ids
+        if pub in network_ids:
             if role <= roles.network:
                 return True
         elif role == roles.network:
@@ -154,41 +171,100 @@ class Account(twistable.Twistable):
         raise RuntimeError("Unexpected role (%s) asked for object '%s' (%s)" % (role, obj and obj.__class__.__name__, obj and obj.id))
 
 
-    def has_permission(self, permission, obj):
+    def _get_permission_role(self, permission, obj, model_class = None):
         """
-        Return true if authenticated user has been granted the given permission on obj.
+        Return the role required for the given permission on obj, or None if obj's
+        permission template is invalid.
+        'Intelligent' (callable) roles are resolved against obj.
+        In packed permissions mode, roles resolved at save-time are read from obj._p_packed.
         """
-        # Check roles, strongest first to optimize caching.
+        if twistable.PACKED_PERMISSIONS and obj._p_packed:
+            role = permissions.unpack_role(obj._p_packed, permission)
+            if role is not None:
+                return role
+        if model_class is None:
+            model_class = obj.model_class
         try:
-            p_template = obj.model_class.permission_templates.get(obj.permissions)
+            role = model_class.permission_templates.get(obj.permissions)[permission]
         except KeyError:
             # XXX Perm template is invalid or incomplete... Should do something here...
+            log.warning("Invalid permission template: '%s' on %s" % (obj.permissions, model_class, ))
+            return None
+        if callable(role):
+            role = role(obj)
+        return role
+
+    def has_permission(self, permission, obj):
+        """
+        Return true if authenticated user has been granted the given permission on obj.
+        """
+        role = self._get_permission_role(permission, obj)
+        if role is None:
             # But if we're on the system account, let's pass
-            if issubclass(self.model_class, SystemAccount):
-                return True
-            log.warning("Invalid permission template: '%s' on %s" % (obj.permissions, obj.model_class, ))
-        if self.has_role(p_template[permission], obj):
-            return True
-        
-        # Didn't find, we disallow
-        return False
+            return issubclass(self.model_class, SystemAccount)
+        return self.has_role(role, obj)
+        
+    def has_permission_many(self, permission, objects):
+        """
+        Batch version of has_permission(): return a {obj.id: bool} dict for the given objects.
+        
+        Permission templates, model classes, the admin status and the network ids
+        are resolved only once for the whole list (and only if actually needed),
+        so that the cost doesn't grow with the number of objects.
+        Unsaved objects are ignored.
+        """
+        ret = {}
+        objects = [ obj for obj in objects if obj.id is not None ]
+        if not objects:
+            return ret
+        if isinstance(self, SystemAccount):
+            for obj in objects:
+                ret[obj.id] = True
+            return ret
+        
+        model_classes = {}
+        network_ids = None
+        for obj in objects:
+            model_class = model_classes.get(obj.model_name)
+            if model_class is None:
+                model_class = model_classes[obj.model_name] = obj.model_class
+            role = self._get_permission_role(permission, obj, model_class)
+            if role is None:
+                ret[obj.id] = False
+                continue
+            
+            # Only fetch network ids if one object actually requires it
+            if network_ids is None and role <= roles.network \
+                    and role != roles.public and obj.owner_id != self.id and obj.id != self.id \
+                    and not self.is_admin:
+                network_ids = set(self.network_ids)
+            ret[obj.id] = self._has_role(role, obj, network_ids or ())
+        return ret
 
     @property
     def is_admin(self):
         """
-        Return True if current user is in the admin community or is System.
-        We cache this value.
+        Return True if this account is in the admin community or is System.
+        We cache this value on the instance and in the role cache.
         """
         v = getattr(self, '_is_admin', None)
         if v is not None:
             return v
+        if not self.id:
+            return False
         import community
-        try:
-            self._is_admin = community.AdminCommunity.objects.__booster__.get().is_member
-        except community.AdminCommunity.DoesNotExist:
-            # No admin community? Strange but possible at boostrap-time.
-            self._is_admin = False
-        return self._is_admin
+        key = (self.id, None, "is_admin", )
+        stamp = self._role_cache.stamp(self.id)
+        v = self._role_cache.get(key, stamp)
+        if v is None:
+            try:
+                v = community.AdminCommunity.objects.__booster__.get().isMember(self)
+            except community.AdminCommunity.DoesNotExist:
+                # No admin community? Strange but possible at boostrap-time. Don't cache that.
+                return False
+            self._role_cache.set(key, stamp, v)
+        self._is_admin = v
+        return v
 
 
     #                                           #
@@ -200,25 +276,35 @@ class Account(twistable.Twistable):
         """
         Return this user's network, that is UserAccount with only APPROVED relations.
         """
-        return UserAccount.objects.filter(
-            targeted_network__target__id = self.id,
-            requesting_network__client__id = self.id,
-        ).exclude(id = self.id)
+        from network import Network
+        return UserAccount.objects.filter(id__in = list(Network.graph.mutual_ids(self.id))).exclude(id = self.id)
         
     @property
     def network_ids(self,):
         """
-        Return networks available for queries AAAND myself.
-        XXX TODO: Cache this!
+        Return networks available for queries AAAND myself, as a caches.SortedIds.
+        This is kept in the shared cache and invalidated when a Network object changes.
         """
         if hasattr(self, "_c_network_ids"):
             return self._c_network_ids
         
-        ids = Account.objects.__booster__.filter(
-            Q(targeted_network__target__id = self.id) | Q(id = self.id)
-            ).values_list("id", flat = True)
+        from network import Network
+        ids = caches.get_id_set("network", self.id, lambda: list(Network.graph.follower_ids(self.id)) + [ self.id, ])
         self._c_network_ids = ids
         return ids
+        
+    @property
+    def followed_ids(self,):
+        """
+        Return ids of the accounts I follow (whether they approved or not), as a caches.SortedIds.
+        Shared-cached like network_ids.
+        """
+        if hasattr(self, "_c_followed_ids"):
+            return self._c_followed_ids
+        from network import Network
+        ids = caches.get_id_set("followed", self.id, lambda: Network.graph.following_ids(self.id))
+        self._c_followed_ids = ids
+        return ids
 
     @property
     def content(self):
@@ -252,7 +338,33 @@ class Account(twistable.Twistable):
         
     @property
     def community_ids(self,):
-        return self.communities.values_list("id", flat = True)
+        """
+        Return ids of the communities I'm a member of, as a caches.SortedIds.
+        Shared-cached like network_ids. Unlike communities, this doesn't depend on the authenticated account.
+        """
+        if hasattr(self, "_c_community_ids"):
+            return self._c_community_ids
+        from community import Community
+        ids = caches.get_id_set("community", self.id, lambda: Community.objects.__booster__.filter(
+            targeted_network__target__id = self.id,
+            requesting_network__client__id = self.id,
+            ).values_list("id", flat = True))
+        self._c_community_ids = ids
+        return ids
+
+    @property
+    def counters(self,):
+        """
+        Return the RelationCounters of this account (network size, followers, community members...).
+        Those are raw counts maintained from Network changes: they don't depend on the authenticated account.
+        """
+        if hasattr(self, "_c_counters"):
+            return self._c_counters
+        from counters import RelationCounters
+        if not self.id:
+            return RelationCounters()       # Anonymous
+        self._c_counters = RelationCounters.objects.get_for(self.id)
+        return self._c_counters
 
     @property
     def communities_for_display(self,):
@@ -327,10 +439,9 @@ class UserAccount(Account):
         # XXX Maybe this has to be done BEFORE calling super() ?
         if creation:
             glob = community.GlobalCommunity.objects.get()
-            __account__ = SystemAccount.objects.get()
-            glob.join(self)
-            self.follow(self)
-            del __account__
+            with as_account(SystemAccount.objects.get()):
+                glob.join(self)
+                self.follow(self)
             
         log.debug("Saved %s (title = %s)" % (self, self.title, ))
         return ret
@@ -460,23 +571,13 @@ class UserAccount(Account):
     def get_pending_network_requests(self, returned_model = None):
         """
         List pending nwk user requests, ie. requests I yet have to approve.
-        XXX MORE THAN SUBOPTIMAL !!!
         You can use the 'returned_model' parameter to restrict invitations to a specific model.
         Default is to return only UserAccount requests
         """
         if not returned_model:
             returned_model = UserAccount
         from twistranet.twistapp.models.network import Network
-        requested_ids = Network.objects.filter(target = self).values_list("client__id", flat = True)
-        accepted_ids = Network.objects.filter(client = self).values_list("target__id", flat = True)
-        
-        unvalidated_ids = []
-        for i in requested_ids:
-            if i in accepted_ids:
-                continue
-            unvalidated_ids.append(i)
-            
-        return returned_model.objects.filter(id__in = unvalidated_ids)
+        return returned_model.objects.filter(id__in = list(Network.graph.pending_ids(self.id)))
         
     def get_pending_network_request_ids(self, returned_model = None):
         return self.get_pending_network_requests(returned_model).values_list("id", flat = True)
@@ -508,17 +609,17 @@ class UserAccount(Account):
     def followers(self,):
         """
         Return people following me
-        XXX TODO: Cache this
         """
-        return UserAccount.objects.filter(targeted_network__target__id = self.id)
+        from network import Network
+        return UserAccount.objects.filter(id__in = list(Network.graph.follower_ids(self.id)))
 
     @property
     def following(self,):
         """
         Return ppl I follow
-        XXX TODO: Cache this
         """
-        return UserAccount.objects.filter(requesting_network__client__id = self.id)
+        from network import Network
+        return UserAccount.objects.filter(id__in = list(Network.graph.following_ids(self.id)))
 
 class AnonymousAccount(UserAccount):
     """
@@ -561,15 +662,14 @@ def create_profile(sender, instance, created, *args, **kw):
             return
             
         # We consider we're the SystemAccount now.
-        __account__ = SystemAccount.get()
-        
-        # Actually create profile
-        log.info("Automatic creation of a UserAccount for %s" % instance)
-        profile = UserAccount(
-            user = instance,
-            slug = slugify.slugify(instance.username),
-        )
-        profile.save()
+        with as_account(SystemAccount.get()):
+            # Actually create profile
+            log.info("Automatic creation of a UserAccount for %s" % instance)
+            profile = UserAccount(
+                user = instance,
+                slug = slugify.slugify(instance.username),
+            )
+            profile.save()
     
 post_save.connect(create_profile, sender = User)
         
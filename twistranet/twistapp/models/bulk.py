@@ -0,0 +1,268 @@
+"""
+Bulk creation of content.
+
+Content.save() does a lot of work for each object: it resolves the authenticated account,
+checks publishing rights, allocates a slug, validates the object against the database,
+computes its access network and sends signals which end up sending emails.
+That's fine for a web request, way too slow for importing thousands of documents.
+
+bulk_create() does the same work set-wise, for a whole batch at once:
+- publishing rights are checked once per distinct publisher ;
+- slugs are allocated with one query per batch, plus one counter reservation per duplicated title ;
+- objects are validated in memory (foreign keys and slug unicity are left to the database) ;
+- access networks are computed once per distinct publisher ;
+- rows are inserted with multi-row INSERT statements, table by table ;
+- one twistables_created signal is sent per batch instead of the per-object signals.
+
+Per-object notifications (content_created) are NOT sent.
+Use it through Twistable.objects.bulk_create_secured().
+"""
+from __future__ import with_statement
+from django.db import connection, transaction
+from django.db.models import AutoField, ForeignKey
+from django.core.exceptions import PermissionDenied
+from django.conf import settings
+
+from twistranet.twistapp.lib import roles, permissions, auth_context
+from twistranet.twistapp.lib.slugify import slugify
+from twistranet.twistapp.signals import twistables_created
+from twistable import Twistable
+
+BULK_BATCH_SIZE = 500
+SQLITE_MAX_VARIABLES = 999          # SQLite's default SQLITE_MAX_VARIABLE_NUMBER
+
+def _model_chain(model):
+    """
+    Return the list of concrete models model inherits from, root (Twistable) first.
+    """
+    ret = []
+    while model:
+        ret.insert(0, model)
+        parents = model._meta.parents.keys()
+        model = parents and parents[0] or None
+    return ret
+
+def _mysql_id_step(cursor):
+    """
+    Return the difference between the ids MySQL allocates to the rows of a multi-row INSERT,
+    or None if they may not be consecutive: with innodb_autoinc_lock_mode = 2 ("interleaved"),
+    concurrent statements get interleaved ids.
+    """
+    cursor.execute("SELECT @@innodb_autoinc_lock_mode, @@auto_increment_increment")
+    lock_mode, increment = cursor.fetchone()
+    if lock_mode is None or int(lock_mode) >= 2:
+        return None
+    return int(increment)
+
+def _insert_rows(model, objects, return_ids):
+    """
+    Insert the local fields of the given objects into model's table with multi-row INSERT statements.
+    If return_ids is True, return the list of the generated primary keys, in order.
+    """
+    qn = connection.ops.quote_name
+    engine = settings.DATABASES["default"]["ENGINE"]
+    fields = [ f for f in model._meta.local_fields if not isinstance(f, AutoField) ]
+    rows = []
+    for obj in objects:
+        rows.append([ f.get_db_prep_save(f.pre_save(obj, True), connection = connection) for f in fields ])
+
+    # SQLite limits the number of parameters of a single statement
+    per_statement = len(rows)
+    if "sqlite" in engine:
+        per_statement = max(1, SQLITE_MAX_VARIABLES // len(fields))
+
+    ids = []
+    cursor = connection.cursor()
+    step = 1
+    if return_ids and "mysql" in engine:
+        step = _mysql_id_step(cursor)
+        if step is None:
+            # Ids may be interleaved with those of concurrent statements: insert rows one by one
+            step, per_statement = 1, 1
+    placeholders = "(%s)" % ", ".join([ "%s" ] * len(fields))
+    for i in range(0, len(rows), per_statement):
+        chunk = rows[i:i + per_statement]
+        sql = "INSERT INTO %s (%s) VALUES %s" % (
+            qn(model._meta.db_table),
+            ", ".join([ qn(f.column) for f in fields ]),
+            ", ".join([ placeholders ] * len(chunk)),
+        )
+        params = []
+        for row in chunk:
+            params.extend(row)
+        if not return_ids:
+            cursor.execute(sql, params)
+        elif "postgresql" in engine:
+            cursor.execute("%s RETURNING %s" % (sql, qn(model._meta.pk.column)), params)
+            ids.extend([ row[0] for row in cursor.fetchall() ])
+        else:
+            # A single INSERT statement allocates consecutive ids (see _mysql_id_step() for MySQL).
+            # MySQL gives us the first one, SQLite the last one.
+            cursor.execute(sql, params)
+            if "mysql" in engine:
+                ids.extend(range(cursor.lastrowid, cursor.lastrowid + len(chunk) * step, step))
+            else:
+                ids.extend(range(cursor.lastrowid - len(chunk) + 1, cursor.lastrowid + 1))
+    return ids
+
+def _access_network(obj, publisher, chains):
+    """
+    Return the access network of a new content published on publisher.
+    This must match Twistable._update_access_network(). chains memoizes the public publishers walk.
+    """
+    _p_can_list = max(obj._p_can_list, publisher._p_can_view)
+    if _p_can_list == roles.owner:
+        return None
+    if _p_can_list == roles.network:
+        return publisher
+    if _p_can_list != roles.public:
+        raise ValueError("Unexpected can_list role found: %d on object %s" % (_p_can_list, obj))
+    if not chains.has_key(publisher.id):
+        ret = None
+        current = publisher
+        while current:
+            if current._p_can_list == roles.public:
+                if current.publisher_id == current.id:
+                    break
+                current = current.publisher
+            elif current._p_can_list in (roles.owner, roles.network, ):
+                ret = current
+                break
+            else:
+                raise ValueError("Unexpected can_list role found: %d on object %s" % (current._p_can_list, current))
+        chains[publisher.id] = ret
+    return chains[publisher.id]
+
+def _allocate_slugs(objects):
+    """
+    Give a unique slug to each object, with one query to check the wanted slugs
+    plus one counter reservation per slug wanted several times or already taken.
+    """
+    from slug import SlugCounter
+    wanted = {}
+    for obj in objects:
+        wanted.setdefault(obj.slug, []).append(obj)
+    taken = set(Twistable.objects.__booster__.filter(slug__in = wanted.keys()).values_list("slug", flat = True))
+    reserved = []
+    for slug, objs in wanted.items():
+        if slug not in taken:
+            objs = objs[1:]
+        if objs:
+            for obj, new_slug in zip(objs, SlugCounter.objects.reserve(slug, len(objs))):
+                obj.slug = new_slug
+                reserved.append(obj)
+
+    # The counters may be behind slugs which were given explicitly
+    if reserved:
+        taken = set(Twistable.objects.__booster__.filter(slug__in = [ obj.slug for obj in reserved ]).values_list("slug", flat = True))
+        for obj in reserved:
+            if obj.slug in taken:
+                obj.slug = SlugCounter.objects.allocate(obj.slug)
+
+def _prepare(objects, auth):
+    """
+    Set the twistable columns of the given (unsaved) objects, check publishing rights and validate them.
+    """
+    from account import Account, SystemAccount
+    from content import Content, compute_owners_for_display
+
+    for obj in objects:
+        if obj.id is not None:
+            raise ValueError("%s is already saved." % (obj, ))
+        if not isinstance(obj, Content) or obj.__class__ is Content:
+            raise ValueError("Only actual content types can be bulk-created, not %s." % (obj.__class__.__name__, ))
+        if obj.__class__.save.im_func is not Content.save.im_func:
+            raise ValueError("%s has its own save() method and can't be bulk-created." % (obj.__class__.__name__, ))
+        if obj.owner_id and not isinstance(auth, SystemAccount):
+            raise PermissionDenied("You're not allowed to set the content owner by yourself.")
+
+    # Publishing rights, once per distinct publisher
+    for obj in objects:
+        if not obj.publisher_id:
+            obj.publisher = obj.getDefaultPublisher()
+    publishers = Account.objects.__booster__.in_bulk(list(set([ obj.publisher_id for obj in objects ])))
+    allowed = auth.has_permission_many(permissions.can_publish, publishers.values())
+    for publisher_id in publishers.keys():
+        if not allowed.get(publisher_id):
+            raise PermissionDenied("%s can't publish on %s." % (auth, publishers[publisher_id], ))
+
+    chains = {}
+    for obj in objects:
+        publisher = obj.publisher = publishers[obj.publisher_id]
+        obj.model_name = obj._meta.object_name
+        obj.app_label = obj._meta.app_label
+        if not obj.owner_id:
+            obj.owner = obj.getDefaultOwner()
+        obj.created_by = obj.modified_by = auth
+        obj._set_permissions()
+        if not obj.slug and obj.__class__._FORCE_SLUG_CREATION:
+            obj.slug = slugify(obj.title or obj.description or obj.model_name)[:40]
+
+        # Validate in memory. Foreign keys and slugs unicity are enforced by the database.
+        obj.clean_fields(exclude = [ f.name for f in obj._meta.fields if isinstance(f, ForeignKey) ])
+        obj.clean()
+
+        obj._access_network = _access_network(obj, publisher, chains)
+        obj._access_token = Twistable.get_access_token(obj._p_can_list, obj._access_network_id, obj.owner_id)
+        obj._is_anonymous_visible = Twistable.get_anonymous_visible(obj._p_can_list, obj._access_network)
+
+    for obj, display in zip(objects, compute_owners_for_display(objects)):
+        obj._owner_for_display_id = display
+    _allocate_slugs([ obj for obj in objects if obj.slug and obj.__class__._FORCE_SLUG_CREATION ])
+
+def _insert(objects):
+    """
+    Insert the given prepared objects, table by table. They must all have the same class.
+    """
+    for model in _model_chain(objects[0].__class__):
+        if model is Twistable:
+            for obj, id in zip(objects, _insert_rows(model, objects, return_ids = True)):
+                obj.id = id
+        else:
+            # Child tables' primary key is the link to their parent
+            for obj in objects:
+                setattr(obj, model._meta.pk.attname, obj.id)
+            _insert_rows(model, objects, return_ids = False)
+
+def bulk_create(objects, batch_size = None):
+    """
+    Create the given content objects on behalf of the authenticated account,
+    batch_size objects per transaction. Return the list of created objects.
+    If a transaction is already managed, batches are not committed.
+    """
+    auth = Twistable.objects._getAuthenticatedAccount()
+    if not auth or auth.is_anonymous:
+        raise PermissionDenied("Anonymous user can't publish anything.")
+    batch_size = batch_size or BULK_BATCH_SIZE
+    objects = list(objects)
+    managed = transaction.is_managed()
+    for i in range(0, len(objects), batch_size):
+        batch = objects[i:i + batch_size]
+        by_class = {}
+        for obj in batch:
+            by_class.setdefault(obj.__class__, []).append(obj)
+            
+        # Each batch is committed, unless the caller manages the transaction itself
+        if not managed:
+            transaction.enter_transaction_management()
+            transaction.managed(True)
+        try:
+            try:
+                with auth_context.as_account(auth):
+                    _prepare(batch, auth)
+                for model, instances in by_class.items():
+                    _insert(instances)
+                if not managed:
+                    transaction.commit()
+            except:
+                if not managed:
+                    transaction.rollback()
+                for obj in batch:
+                    obj.id = None
+                raise
+        finally:
+            if not managed:
+                transaction.leave_transaction_management()
+        for model, instances in by_class.items():
+            twistables_created.send(sender = model, instances = instances)
+    return objects
@@ -8,6 +8,7 @@ from django.conf import settings
 
 from twistranet.twistapp.lib import permissions
 from twistranet.twistapp.signals import join_community, invite_community, request_join_community
+from twistranet.twistapp.signals import join_community_many, invite_community_many
 
 from account import Account, SystemAccount
 from twistable import Twistable
@@ -31,20 +32,30 @@ class Community(Account):
     summary_view = "community/summary.part.html"
     is_community = True
     
+    @property
+    def membership(self):
+        """
+        Relations of the community from Network.graph, kept on the instance:
+        membership.mutual_ids are the members, membership.manager_ids the accounts flagged as managers.
+        join(), invite(), leave(), set_as_manager() and unset_as_manager() update them.
+        """
+        if self.id is None:
+            return Network.graph.get(None)
+        if not hasattr(self, "_c_membership"):
+            self._c_membership = Network.graph.get(self.id)
+        return self._c_membership
+        
+    def _reset_membership(self, ):
+        if hasattr(self, "_c_membership"):
+            del self._c_membership
+        
     @property
     def managers(self):
-        return Account.objects.filter(
-            targeted_network__target__id = self.id,
-            requesting_network__client__id = self.id,
-            targeted_network__is_manager = True,
-        )
+        return Account.objects.filter(id__in = list(Network.graph.manager_ids(self.id)))
         
     @property
     def members(self):
-        return Account.objects.filter(
-            targeted_network__target__id = self.id,
-            requesting_network__client__id = self.id,
-        )
+        return Account.objects.filter(id__in = list(Network.graph.mutual_ids(self.id)))
         
     @property
     def member_ids(self):
@@ -71,6 +82,7 @@ class Community(Account):
         Populate special content information before saving it.
         """
         ret = super(Community, self).save(*args, **kw)
+        self._reset_membership()
         if not self.is_member:
             auth = Twistable.objects._getAuthenticatedAccount()
             if not isinstance(auth, SystemAccount):
@@ -84,6 +96,7 @@ class Community(Account):
                     target = auth,
                     is_manager = False,
                 )
+                self._reset_membership()
         return ret
         
     def delete(self, ):
@@ -113,30 +126,15 @@ class Community(Account):
         """
         Return True if given account is member.
         If account is None, assume it's current authenticated.
-        XXX HAVE TO OPTIMIZE (PRE-LOAD?) THIS!
         """
         if not account:
             account = Community.objects._getAuthenticatedAccount()
             if not account:
                 return False    # Anon user
-                
-        if not is_manager:
-            flt = Account.objects.__booster__.filter(
-                targeted_network__target__id = self.id,
-                targeted_network__client__id = account.id,
-                requesting_network__client__id = self.id,
-                requesting_network__target__id = account.id,
-            )
-        else:
-            flt = Account.objects.__booster__.filter(
-                targeted_network__target__id = self.id,
-                targeted_network__client__id = account.id,
-                requesting_network__client__id = self.id,
-                requesting_network__target__id = account.id,
-                targeted_network__is_manager = True,
-            )
-
-        return flt.exists()
+        membership = self.membership
+        if account.id not in membership.mutual_ids:
+            return False
+        return not is_manager or account.id in membership.manager_ids
 
             
     @property
@@ -166,7 +164,7 @@ class Community(Account):
         # Special check if we're not the last (human) manager inside
         if self.is_manager:
             log.debug("Is manager on %s" % self)
-            if self.managers.count() == 1:
+            if self.counters.managers == 1:
                 return False
         
         # Regular checks
@@ -179,7 +177,8 @@ class Community(Account):
         True if currently auth user has a pending invitation in this community
         """
         auth = Account.objects._getAuthenticatedAccount()
-        if self.id in auth.get_pending_network_request_ids(returned_model = Community):
+        membership = self.membership
+        if auth.id in membership.out_ids and auth.id not in membership.in_ids:
             return True             # Has pending request
         return False                # No request pending
 
@@ -201,6 +200,7 @@ class Community(Account):
             target = account,
             is_manager = False,
         )
+        self._reset_membership()
         
         # Send the invite signal
         invite_community.send(
@@ -246,6 +246,7 @@ class Community(Account):
             )
         except IntegrityError:
             pass
+        self._reset_membership()
         
         # Send the join signal
         join_community.send(
@@ -255,6 +256,65 @@ class Community(Account):
             accepted = True,
             )
         
+    def _new_accounts(self, accounts, skipped_ids):
+        """
+        Return the given accounts, without duplicates and without those whose id is in skipped_ids.
+        """
+        ret = []
+        seen = set()
+        for account in accounts:
+            if account.id in skipped_ids or account.id in seen:
+                continue
+            seen.add(account.id)
+            ret.append(account)
+        return ret
+        
+    def invite_many(self, accounts, batch_size = None):
+        """
+        Invite the given accounts, much faster than invite() for each of them:
+        rights are checked once, members and already invited accounts are skipped, relations are created
+        set-wise (see Network.objects.bulk_add()) and one invite_community_many signal is sent per batch.
+        Return the list of invited accounts.
+        """
+        from network import RELATIONS_BATCH_SIZE
+        if not self.can_join:
+            raise PermissionDenied("You're not allow to invite somebody in a community.")
+        accounts = self._new_accounts(accounts, self.membership.out_ids)
+        batch_size = batch_size or RELATIONS_BATCH_SIZE
+        for i in range(0, len(accounts), batch_size):
+            batch = accounts[i:i + batch_size]
+            Network.objects.bulk_add([ (self.id, account.id, False) for account in batch ], batch_size = len(batch))
+            self._reset_membership()
+            invite_community_many.send(
+                sender = self.__class__,
+                targets = batch,
+                community = self,
+            )
+        return accounts
+        
+    def join_many(self, accounts, is_manager = False, batch_size = None):
+        """
+        Make the given accounts join the community, much faster than join() for each of them:
+        rights are checked once, members are skipped, relations are created set-wise
+        and one join_community_many signal is sent per batch. Return the list of accounts which joined.
+        """
+        from network import RELATIONS_BATCH_SIZE
+        if not self.can_join:
+            raise PermissionDenied("You're not allowed to let somebody join this community.")
+        accounts = self._new_accounts(accounts, self.membership.mutual_ids)
+        batch_size = batch_size or RELATIONS_BATCH_SIZE // 2
+        for i in range(0, len(accounts), batch_size):
+            batch = accounts[i:i + batch_size]
+            edges = [ (account.id, self.id, is_manager) for account in batch ] + [ (self.id, account.id, False) for account in batch ]
+            Network.objects.bulk_add(edges, batch_size = len(edges))
+            self._reset_membership()
+            join_community_many.send(
+                sender = self.__class__,
+                clients = batch,
+                community = self,
+            )
+        return accounts
+        
     def leave(self, account=None):
         """
         Leave the community.
@@ -274,6 +334,72 @@ class Community(Account):
         # We use this here to allow invitations to be declined.
         Network.objects.filter(client__id = self.id, target__id = account.id).delete()
         Network.objects.filter(target__id = self.id, client__id = account.id).delete()
+        self._reset_membership()
+
+    def leave_many(self, accounts):
+        """
+        Make the given accounts leave the community, with the same checks as leave(), done once.
+        Relations are deleted SQL_CHUNK accounts at a time; the Network post_delete signals
+        (access tokens, counters, caches, timelines) are still sent for each of them.
+        Suggestions of the community and of the accounts are marked as stale at once.
+        """
+        from network import _chunks, SQL_CHUNK
+        from suggestion import StaleSuggestion
+        auth = Account.objects._getAuthenticatedAccount()
+        ids = list(set([ account.id for account in accounts ]))
+        if self.is_member:
+            if auth.id in ids and not self.can_leave:
+                raise PermissionDenied("You're not allowed to leave this community")
+            if [ id for id in ids if id != auth.id ] and not self.is_manager:
+                raise PermissionDenied("You're not allowed to oust somebody from this community.")
+        for chunk in _chunks(ids, SQL_CHUNK):
+            Network.objects.filter(client__id = self.id, target__id__in = chunk).delete()
+            Network.objects.filter(target__id = self.id, client__id__in = chunk).delete()
+        StaleSuggestion.objects.mark(self.id, *ids)
+        self._reset_membership()
+        
+    def _set_managers(self, accounts, is_manager):
+        """
+        Flag (or unflag) the given accounts as managers with one UPDATE per SQL_CHUNK accounts.
+        Return the ids of the accounts which changed.
+        """
+        from network import _chunks, SQL_CHUNK
+        from counters import RelationCounters
+        changed_ids = []
+        for chunk in _chunks(list(set([ account.id for account in accounts ])), SQL_CHUNK):
+            relations = Network.objects.filter(client__id__in = chunk, target__id = self.id, is_manager = not is_manager)
+            ids = list(relations.values_list("client", flat = True))
+            if ids:
+                Network.objects.filter(client__id__in = ids, target__id = self.id).update(is_manager = is_manager)
+                changed_ids.extend(ids)
+        for id in changed_ids:
+            Network.graph.changed(id, self.id, is_manager)
+        self._reset_membership()
+        n_members = len([ id for id in changed_ids if id in self.membership.mutual_ids ])
+        if n_members:
+            RelationCounters.objects.bump({self.id: {"managers": is_manager and n_members or -n_members, }, })
+        return changed_ids
+        
+    def set_as_manager_many(self, accounts):
+        """
+        Same as set_as_manager() for each of the given accounts, with rights checked once
+        and relations updated set-wise.
+        """
+        if not self.can_edit:
+            raise PermissionDenied("You can't name somebody as a community manager")
+        self._set_managers(accounts, True)
+        
+    def unset_as_manager_many(self, accounts):
+        """
+        Same as unset_as_manager() for each of the given accounts, with rights checked once
+        and relations updated set-wise.
+        """
+        if not self.can_edit:
+            raise PermissionDenied("You can't bail a community manager")
+        auth = Account.objects._getAuthenticatedAccount()
+        if auth.id in [ account.id for account in accounts ]:
+            raise PermissionDenied("You can't ban yourself from the community managers")
+        self._set_managers(accounts, False)
 
     def set_as_manager(self, account):
         """
@@ -283,7 +409,12 @@ class Community(Account):
         """
         if not self.can_edit:
             raise PermissionDenied("You can't name somebody as a community manager")
-        Network.objects.filter(client__id = account.id, target__id = self.id).update(is_manager = True)
+        from counters import RelationCounters
+        if Network.objects.filter(client__id = account.id, target__id = self.id, is_manager = False).update(is_manager = True):
+            Network.graph.changed(account.id, self.id, True)
+            self._reset_membership()
+            if self.isMember(account):
+                RelationCounters.objects.bump({self.id: {"managers": 1, }, })
 
     def unset_as_manager(self, account):
         """
@@ -294,7 +425,12 @@ class Community(Account):
         auth = Account.objects._getAuthenticatedAccount()
         if auth.id == account.id:
             raise PermissionDenied("You can't ban yourself from the community managers")
-        Network.objects.filter(client__id = account.id, target__id = self.id).update(is_manager = False)
+        from counters import RelationCounters
+        if Network.objects.filter(client__id = account.id, target__id = self.id, is_manager = True).update(is_manager = False):
+            Network.graph.changed(account.id, self.id, False)
+            self._reset_membership()
+            if self.isMember(account):
+                RelationCounters.objects.bump({self.id: {"managers": -1, }, })
 
 
 class GlobalCommunity(Community):
@@ -1,13 +1,55 @@
-from django.db import models
+from django.db import models, connection, transaction
+from django.db.models.sql.datastructures import EmptyResultSet
 from django.db.models import Q
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError, PermissionDenied
 from django.utils import html, translation
+from django.conf import settings
 import twistable
 from account import Account
 from resource import Resource
 from twistranet.twistapp.lib import roles, permissions
 from twistranet.twistapp.signals import *
+from twistranet.core import caches
+
+# Number of comments displayed below each content summary
+LAST_COMMENTS_COUNT = 2
+
+# Number of contents updated in each transaction by update_owners_for_display()
+OWNER_FOR_DISPLAY_CHUNK_SIZE = 500
+
+# Above this number of followed accounts, followed content is fetched with a single query instead of a UNION
+FOLLOW_UNION_MAX_BRANCHES = 200
+
+def compute_owners_for_display(contents):
+    """
+    Return the ids of the authors to display for the given contents, in the same order.
+    See Content.owner_for_display(). Memberships are checked with 2 queries for the whole list.
+    """
+    from community import Community
+    from account import SystemAccount
+    from network import Network
+    pairs = [
+        (content.owner_id, content.publisher_id, ) for content in contents
+        if content.publisher_id and issubclass(content.publisher.model_class, Community)
+    ]
+    members = set()
+    if pairs:
+        owner_ids = list(set([ pair[0] for pair in pairs ]))
+        community_ids = list(set([ pair[1] for pair in pairs ]))
+        joined = Network.objects.filter(client__id__in = owner_ids, target__id__in = community_ids).values_list("client", "target")
+        accepted = Network.objects.filter(client__id__in = community_ids, target__id__in = owner_ids).values_list("target", "client")
+        members = set(joined) & set(accepted)
+    ret = []
+    for content in contents:
+        display = content.owner_id
+        if issubclass(content.owner.model_class, SystemAccount):
+            if content.publisher_id:
+                display = content.publisher_id
+        if (content.owner_id, content.publisher_id, ) in members:
+            display = content.publisher_id
+        ret.append(display)
+    return ret
 
 class ContentManager(twistable.TwistableManager):
     """
@@ -16,14 +58,50 @@ class ContentManager(twistable.TwistableManager):
     
     For performance reasons, it's UP TO YOU to call the distinct() method.
     """            
-    def getActivityFeed(self, account):
+    def _union_ids(self, branches, limit, branch_limit = None):
+        """
+        Return the ids of the union of the given querysets, newest first, up to limit, with a single query.
+        Each branch is ordered by id and limited on its own (to branch_limit, defaults to limit),
+        so that the database answers it with a range scan on a (column, id) index (see indexes.COMPOSITE_INDEXES)
+        instead of sorting a DISTINCT over OR-ed joins.
+        """
+        qn = connection.ops.quote_name
+        # Order on the Twistable table, which holds the indexes. Ordering on "-id" would sort on the child table's pointer.
+        ordering = "-%s.id" % twistable.Twistable._meta.db_table
+        parts = []
+        params = []
+        for i, qs in enumerate(branches):
+            qs = qs.order_by().extra(order_by = [ ordering, ]).values_list("id", flat = True)[:branch_limit or limit]
+            try:
+                sql, branch_params = qs.query.get_compiler(qs.db).as_sql()
+            except EmptyResultSet:
+                continue
+            parts.append("SELECT * FROM (%s) %s" % (sql, qn("b%d" % i)))
+            params.extend(branch_params)
+        if not parts:
+            return []
+        cursor = connection.cursor()
+        # Branches only select the id column, whose name depends on the model: use its position.
+        cursor.execute("SELECT * FROM (%s) %s ORDER BY 1 DESC LIMIT %d" % (" UNION ".join(parts), qn("feed"), limit, ), params)
+        return [ row[0] for row in cursor.fetchall() ]
+
+    def getActivityFeed(self, account, before = None, limit = None):
         """
         Return activity feed content for the given account
         It's content the account follows + content it produced + log messages he's the originator
+        If before is given, only content with a lower id is returned (cursor pagination).
+        If limit is given, only the newest 'limit' contents are returned,
+        fetched with a UNION of the publisher and owner branches (see _union_ids).
         """
-        return self.filter(
-            Q(publisher = account) | Q(owner = account)
-        ).exclude(model_name = "Comment").distinct()
+        qs = self.exclude(model_name = "Comment")
+        if before is not None:
+            qs = qs.filter(id__lt = before)
+        if limit is None:
+            return qs.filter(Q(publisher = account) | Q(owner = account)).distinct()
+        return self.filter(id__in = self._union_ids([
+            qs.filter(publisher__id = account.id),
+            qs.filter(owner__id = account.id),
+        ], limit))
             
     
     def get_follow_filter(self, account = None):
@@ -35,6 +113,11 @@ class ContentManager(twistable.TwistableManager):
         if account is None:
             account = auth
         
+        # Use the (cached) followed ids if they're not too many for an IN clause
+        followed_ids = account.followed_ids
+        if len(followed_ids) < getattr(settings, "TWISTRANET_FOLLOW_FILTER_MAX_IDS", 500):
+            return Q(publisher__id__in = list(followed_ids) + [account.id, ])
+        
         return (Q(
             publisher__requesting_network__client__id = account.id,
         ) | Q(
@@ -49,7 +132,159 @@ class ContentManager(twistable.TwistableManager):
         - that is published on ppl or communities in my network ;
         - my own content ;
         """
-        return self.filter(self.get_follow_filter()).distinct()
+        return self.get_followed()
+
+    def get_followed(self, before = None):
+        """
+        Same as followed, but only with content whose id is lower than before if it's given (cursor pagination).
+        """
+        qs = self.filter(self.get_follow_filter())
+        if before is not None:
+            qs = qs.filter(id__lt = before)
+        return qs.distinct()
+
+    def get_followed_ids(self, account = None, before = None, limit = None, queryset = None):
+        """
+        Return the ids of the content (but comments) followed by account, newest first, up to limit.
+        That's a UNION of one branch per followed publisher (see _union_ids),
+        unless they're more than TWISTRANET_FOLLOW_UNION_MAX_BRANCHES.
+        queryset defaults to the secured one (ie. content visible by the authenticated account).
+        """
+        if account is None:
+            account = self._getAuthenticatedAccount()
+        limit = limit or settings.TWISTRANET_CONTENT_PER_PAGE
+        qs = queryset
+        if qs is None:
+            qs = self.get_query_set()
+        qs = qs.exclude(model_name = "Comment")
+        if before is not None:
+            qs = qs.filter(id__lt = before)
+        publisher_ids = set(account.followed_ids)
+        publisher_ids.add(account.id)
+        if len(publisher_ids) > getattr(settings, "TWISTRANET_FOLLOW_UNION_MAX_BRANCHES", FOLLOW_UNION_MAX_BRANCHES):
+            return list(qs.filter(self.get_follow_filter(account)).distinct().order_by("-id").values_list("id", flat = True)[:limit])
+        return self._union_ids([ qs.filter(publisher__id = id) for id in sorted(publisher_ids) ], limit)
+
+    def prefetch_comments(self, contents, count = None, request = None, ):
+        """
+        Fetch the last comments of all the given contents at once, as seen by the authenticated account,
+        and store them on each content so that last_comments issues no further query.
+        Contents without any comment (see Content.comment_count) are skipped: it's 2 queries at most,
+        the first one being a UNION of one 'count' comments branch per content (see _union_ids).
+        Return the contents as a list.
+        """
+        from twistranet.content_types.models import Comment
+        count = count or LAST_COMMENTS_COUNT
+        contents = list(contents)
+        commented = {}
+        for content in contents:
+            if isinstance(content, Content):
+                content._c_last_comments = []
+                if content.comment_count:
+                    commented[content.id] = content
+        if not commented:
+            return contents
+        
+        # Last visible comments ids of each content
+        qs = Comment.objects.get_query_set(request = request)
+        last_ids = self._union_ids(
+            [ qs.filter(root_content__id = root_id) for root_id in sorted(commented.keys()) ],
+            count * len(commented), branch_limit = count,
+        )
+        
+        # Fetch them (we already know they're visible), oldest first
+        comments = Comment.objects.__booster__.select_related("owner", "publisher", "_owner_for_display").in_bulk(last_ids)
+        self.annotate_permissions(comments.values(), (permissions.can_delete, ), request = request)
+        for id in sorted(comments.keys()):
+            commented[comments[id].root_content_id]._c_last_comments.append(comments[id])
+        return contents
+
+    def summary_keys(self, contents):
+        """
+        Return the summary fragment cache keys of the given contents, as seen by the authenticated account.
+        A summary depends on the content itself, the accounts it displays (see the "summary" versions,
+        bumped whenever a twistable is saved), the language and the viewer's can_edit / can_delete permissions.
+        Annotate permissions first (see annotate_permissions) to avoid one check per content.
+        """
+        contents = list(contents)
+        ids = set()
+        for content in contents:
+            ids.update((content.id, content._owner_for_display_id or content.owner_id, content.publisher_id, ))
+        ids = list(ids)
+        versions = dict(zip(ids, caches.get_versions(*ids, namespace = "summary")))
+        language = translation.get_language()
+        keys = []
+        for content in contents:
+            display_id = content._owner_for_display_id or content.owner_id
+            keys.append((
+                content.id,
+                content.modified_at and content.modified_at.strftime("%Y%m%d%H%M%S") or "",
+                language,
+                "%d%d" % (content.can_edit and 1 or 0, content.can_delete and 1 or 0, ),
+                content._owner_for_display_id,
+                versions[content.id], versions[display_id], versions[content.publisher_id],
+            ))
+        return keys
+
+    def prefetch_summaries(self, contents):
+        """
+        Fetch the cached summary fragments of the given contents at once (see the 'summary_fragment' template tag),
+        and store them on each content. Return the contents as a list.
+        """
+        contents = list(contents)
+        if not getattr(settings, "TWISTRANET_SUMMARY_CACHE", True):
+            return contents
+        cached = [ content for content in contents if isinstance(content, Content) ]
+        keys = self.summary_keys(cached)
+        found = caches.summary_cache.get_many(keys)
+        for content, key in zip(cached, keys):
+            content._c_summary_key = key
+            content._c_summary_html = found.get(key, None)
+        return contents
+
+    def update_owners_for_display(self, chunk_size = None, max_chunks = None, callback = None):
+        """
+        Compute the stored author to display of the contents which don't have one,
+        ie. new contents of an upgraded site or contents whose owner joined or left their publisher community.
+        chunk_size contents are updated per transaction (unless the caller already manages it), at most max_chunks chunks.
+        callback(last_id, n_updated) is called after each chunk. Return the number of updated contents.
+        """
+        chunk_size = chunk_size or OWNER_FOR_DISPLAY_CHUNK_SIZE
+        managed = transaction.is_managed()
+        last_id = 0
+        n_chunks = 0
+        n_updated = 0
+        while max_chunks is None or n_chunks < max_chunks:
+            contents = list(self.__booster__.filter(
+                _owner_for_display__isnull = True, id__gt = last_id,
+            ).select_related("owner", "publisher").order_by("id")[:chunk_size])
+            if not contents:
+                break
+            if not managed:
+                transaction.enter_transaction_management()
+                transaction.managed(True)
+            try:
+                try:
+                    by_display = {}
+                    for content, display in zip(contents, compute_owners_for_display(contents)):
+                        by_display.setdefault(display, []).append(content.id)
+                    for display, ids in by_display.items():
+                        self.__booster__.filter(id__in = ids).update(_owner_for_display = display)
+                    if not managed:
+                        transaction.commit()
+                except:
+                    if not managed:
+                        transaction.rollback()
+                    raise
+            finally:
+                if not managed:
+                    transaction.leave_transaction_management()
+            last_id = contents[-1].id
+            n_chunks += 1
+            n_updated += len(contents)
+            if callback:
+                callback(last_id, n_updated)
+        return n_updated
                         
 
 class _AbstractContent(twistable.Twistable):
@@ -83,6 +318,12 @@ class Content(_AbstractContent):
         blank = True,
         db_index = True
     )
+
+    # Number of comments on this content, whatever their visibility. Maintained by Comment.
+    comment_count = models.IntegerField(default = 0)
+
+    # Author to display, see owner_for_display(). Reset when the owner joins or leaves the publisher community.
+    _owner_for_display = models.ForeignKey(Account, null = True, blank = True, related_name = "+")
     
     # Security models available for the user
     permission_templates = permissions.content_templates
@@ -114,10 +355,25 @@ class Content(_AbstractContent):
 
     @property
     def last_comments(self,):
+        """
+        Last comments visible by the authenticated account, oldest first.
+        Use Content.objects.prefetch_comments() on lists.
+        """
+        if hasattr(self, '_c_last_comments'):
+            return self._c_last_comments
         if hasattr(self, 'comments'):
-            comments = list(self.comments.order_by('-id')[:2])
+            if not self.comment_count:
+                return []
+            comments = list(self.comments.order_by('-id')[:LAST_COMMENTS_COUNT])
             comments.reverse()
             return comments
+
+    @property
+    def n_comments(self,):
+        """
+        Number of comments (see comment_count, maintained by Comment).
+        """
+        return self.comment_count
         
     class Meta:
         app_label = 'twistapp'
@@ -147,6 +403,9 @@ class Content(_AbstractContent):
 
         # Creation or not?
         creation = not self.id
+        if not creation:
+            # comment_count is maintained by Comment: don't overwrite it with a stale value
+            self.comment_count = Content.objects.__booster__.filter(id = self.id).values_list("comment_count", flat = True)[0]
         
         # Check if user has modification rights for existing content
         if creation:
@@ -155,6 +414,13 @@ class Content(_AbstractContent):
                         
         # Actually save stuff
         ret = super(Content, self).save(*args, **kw)
+
+        # Store the author to display, now that owner and publisher are set
+        display = compute_owners_for_display([ self, ])[0]
+        if display != self._owner_for_display_id:
+            self._owner_for_display_id = display
+            self.__dict__.pop("_c_owner_for_display", None)
+            Content.objects.__booster__.filter(id = self.id).update(_owner_for_display = display)
         
         # If we're on a creation mode, send the proper signal and return.
         # Here we determine who has to be notified about this content.
@@ -219,11 +485,14 @@ class Content(_AbstractContent):
         General case: same as self.owner, except for communities,
         where any community member acts for its "spokeperson"
 
-        XXX TODO: Cache most of this at creation-time!
+        It's stored at save time (and reset when memberships change): see compute_owners_for_display().
         """
         _c = getattr(self, '_c_owner_for_display', None)
         if _c:
             return _c
+        if self._owner_for_display_id:
+            setattr(self, '_c_owner_for_display', self._owner_for_display)
+            return self._owner_for_display
         from community import Community
         from account import SystemAccount
         display = self.owner
@@ -236,3 +505,11 @@ class Content(_AbstractContent):
         setattr(self, '_c_owner_for_display', display)
         return display
 
+
+def twistable_saved(sender, instance, **kw):
+    """
+    Cached summaries displaying this object (as a content, its author or publisher) are outdated.
+    """
+    caches.bump_versions(instance.id, namespace = "summary")
+
+twistable_post_save.connect(twistable_saved)
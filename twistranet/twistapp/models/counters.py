@@ -0,0 +1,248 @@
+"""
+Denormalized relationship counters.
+
+Counting an account's network, a community's members or managers is a multi-join over Network.
+Instead, we keep the counts in the RelationCounters table, updated from the Network
+post_save / post_delete signals (ie. in the same transaction) and from Community.set_as_manager() / unset_as_manager().
+
+Those are raw counts: they don't depend on the authenticated account.
+Counters are created lazily. Use the 'twistranet_counters' command to repair drift,
+of those and of Content.comment_count (maintained by Comment).
+"""
+from django.db import models, connection, transaction, IntegrityError
+from django.db.models import F, get_models
+from django.db.models.signals import post_save, post_delete
+
+from twistable import Twistable
+from account import Account
+from network import Network
+
+COUNTER_FIELDS = ("network", "followers", "following", "communities", "members", "managers", "pending_requests", )
+
+def _model_names(base):
+    return [ m._meta.object_name for m in get_models() if issubclass(m, base) ]
+
+class RelationCountersManager(models.Manager):
+    """
+    Compute, maintain and repair counters.
+    """
+    def _compute(self, account_ids = None):
+        """
+        Return a {account_id: {counter: value}} dict computed from the Network table
+        for the given accounts (or for all of them), with a few GROUP BY statements.
+        Accounts without any relation are left out. This must match _relation_deltas().
+        """
+        from account import UserAccount
+        from community import Community
+        qn = connection.ops.quote_name
+        d = {
+            "network":      qn(Network._meta.db_table),
+            "twistable":    qn(Twistable._meta.db_table),
+        }
+        users = _model_names(UserAccount)
+        communities = _model_names(Community)
+        mutual = "INNER JOIN %(network)s r ON (r.client_id = n.target_id AND r.target_id = n.client_id)" % d
+
+        def group(select, key, joins, where, where_params):
+            sql = "SELECT n.%s, %s FROM %s n %s WHERE n.client_id <> n.target_id" % (key, select, d["network"], joins, )
+            params = list(where_params)
+            if where:
+                sql += " AND %s" % where
+            if account_ids is not None:
+                sql += " AND n.%s IN (%s)" % (key, ", ".join([ "%s" ] * len(account_ids)), )
+                params.extend(account_ids)
+            sql += " GROUP BY n.%s" % key
+            cursor = connection.cursor()
+            cursor.execute(sql, params)
+            return cursor.fetchall()
+
+        def placeholders(names):
+            return ", ".join([ "%s" ] * len(names))
+
+        ret = {}
+        def add(rows, *counters):
+            for row in rows:
+                values = ret.setdefault(row[0], dict([ (c, 0, ) for c in COUNTER_FIELDS ]))
+                for counter, value in zip(counters, row[1:]):
+                    values[counter] = int(value or 0)
+
+        join_client = "INNER JOIN %(twistable)s c ON c.id = n.client_id" % d
+        join_target = "INNER JOIN %(twistable)s t ON t.id = n.target_id" % d
+        add(group("COUNT(*)", "target_id", join_client, "c.model_name IN (%s)" % placeholders(users), users), "followers")
+        add(group("COUNT(*)", "client_id", join_target, "t.model_name IN (%s)" % placeholders(users), users), "following")
+        add(group("COUNT(*)", "client_id", "%s %s" % (mutual, join_target), "t.model_name IN (%s)" % placeholders(users), users), "network")
+        add(group("COUNT(*)", "client_id", "%s %s" % (mutual, join_target), "t.model_name IN (%s)" % placeholders(communities), communities), "communities")
+        add(group(
+            "COUNT(*), SUM(CASE WHEN n.is_manager THEN 1 ELSE 0 END)", "target_id",
+            "%s %s" % (mutual, join_target), "t.model_name IN (%s)" % placeholders(communities), communities,
+        ), "members", "managers")
+        add(group(
+            "COUNT(*)", "target_id", join_client,
+            "c.model_name IN (%s) AND NOT EXISTS (SELECT 1 FROM %s r WHERE r.client_id = n.target_id AND r.target_id = n.client_id)" % (
+                placeholders(users), d["network"],
+            ), users,
+        ), "pending_requests")
+        return ret
+
+    def get_for(self, account_id):
+        """
+        Return the counters of the given account, creating them if necessary.
+        """
+        try:
+            return self.get(account__id = account_id)
+        except RelationCounters.DoesNotExist:
+            values = self._compute([ account_id, ]).get(account_id, {})
+            sid = transaction.savepoint()
+            try:
+                ret = self.create(account_id = account_id, **values)
+            except IntegrityError:
+                # Created concurrently
+                transaction.savepoint_rollback(sid)
+                return self.get(account__id = account_id)
+            transaction.savepoint_commit(sid)
+            return ret
+
+    def bump(self, deltas):
+        """
+        Apply the given {account_id: {counter: delta}} changes.
+        Missing counters are created from the database, which already reflects the changes.
+        """
+        for account_id, changes in deltas.items():
+            changes = dict([ (k, F(k) + v) for k, v in changes.items() if v ])
+            if not changes:
+                continue
+            if not self.filter(account__id = account_id).update(**changes):
+                self.get_for(account_id)
+
+    def refresh(self, account_ids):
+        """
+        Compute the counters of the given accounts again, after their relations were changed set-wise
+        (see Network.objects.bulk_add()).
+        """
+        from network import _chunks, SQL_CHUNK
+        zero = dict([ (c, 0, ) for c in COUNTER_FIELDS ])
+        for chunk in _chunks(account_ids, SQL_CHUNK):
+            actual = self._compute(chunk)
+            existing = set(self.filter(account__id__in = chunk).values_list("account", flat = True))
+            for account_id in chunk:
+                values = actual.get(account_id, zero)
+                if account_id in existing:
+                    self.filter(account__id = account_id).update(**values)
+                else:
+                    self.create(account_id = account_id, **values)
+
+    def rebuild(self, check = False):
+        """
+        Compare existing counters with the actual relations and repair them (unless check is True).
+        Return the number of counters which had drifted.
+        """
+        actual = self._compute()
+        zero = dict([ (c, 0, ) for c in COUNTER_FIELDS ])
+        drifted = 0
+        for row in self.values("account", *COUNTER_FIELDS).iterator():
+            account_id = row.pop("account")
+            values = actual.get(account_id, zero)
+            if row != values:
+                drifted += 1
+                if not check:
+                    self.filter(account__id = account_id).update(**values)
+        transaction.commit_unless_managed()
+        return drifted
+
+class RelationCounters(models.Model):
+    """
+    Relationship counts of an account. See Account.counters.
+    """
+    account = models.OneToOneField(Account, primary_key = True, related_name = "+")
+    network = models.IntegerField(default = 0)              # Mutual relations with user accounts
+    followers = models.IntegerField(default = 0)            # User accounts following this one
+    following = models.IntegerField(default = 0)            # User accounts this one follows
+    communities = models.IntegerField(default = 0)          # Communities this account is a member of
+    members = models.IntegerField(default = 0)              # Members of this community
+    managers = models.IntegerField(default = 0)             # Managers of this community
+    pending_requests = models.IntegerField(default = 0)     # Requests from user accounts this one didn't accept
+
+    objects = RelationCountersManager()
+
+    class Meta:
+        app_label = 'twistapp'
+
+    def __unicode__(self):
+        return u"Counters of %s" % (self.account_id, )
+
+def rebuild_comment_counts(check = False):
+    """
+    Recount Content.comment_count from the comments table and repair it (unless check is True).
+    Return the number of contents which had drifted.
+    """
+    from content import Content
+    from twistranet.content_types.models import Comment
+    qn = connection.ops.quote_name
+    d = {
+        "content":      qn(Content._meta.db_table),
+        "comment":      qn(Comment._meta.db_table),
+        "pk":           qn(Content._meta.pk.column),
+        "root":         qn(Comment._meta.get_field("root_content").column),
+        "count":        qn(Content._meta.get_field("comment_count").column),
+    }
+    actual = "(SELECT COUNT(*) FROM %(comment)s WHERE %(comment)s.%(root)s = %(content)s.%(pk)s)" % d
+    cursor = connection.cursor()
+    cursor.execute("SELECT COUNT(*) FROM %s WHERE %s <> %s" % (d["content"], d["count"], actual))
+    drifted = cursor.fetchone()[0]
+    if drifted and not check:
+        cursor.execute("UPDATE %s SET %s = %s WHERE %s <> %s" % (d["content"], d["count"], actual, d["count"], actual))
+    transaction.commit_unless_managed()
+    return drifted
+
+
+def _relation_deltas(relation, sign):
+    """
+    Return counters changes when the given relation is created (sign = 1) or deleted (sign = -1).
+    This must match RelationCountersManager._compute().
+    """
+    from account import UserAccount
+    from community import Community
+    client_id, target_id = relation.client_id, relation.target_id
+    deltas = {client_id: {}, target_id: {}, }
+    if client_id == target_id:
+        return deltas
+    def add(account_id, counter, value):
+        deltas[account_id][counter] = deltas[account_id].get(counter, 0) + sign * value
+
+    model_names = dict(Account.objects.__booster__.filter(id__in = (client_id, target_id, )).values_list("id", "model_name"))
+    users = _model_names(UserAccount)
+    communities = _model_names(Community)
+    client_is_user = model_names.get(client_id) in users and 1 or 0
+    target_is_user = model_names.get(target_id) in users and 1 or 0
+    reverse = Network.objects.filter(client__id = target_id, target__id = client_id).values_list("is_manager", flat = True)
+
+    add(target_id, "followers", client_is_user)
+    add(client_id, "following", target_is_user)
+    if not reverse:
+        add(target_id, "pending_requests", client_is_user)
+    else:
+        # The relation was (or is no more) mutual
+        add(client_id, "pending_requests", -target_is_user)
+        add(client_id, "network", target_is_user)
+        add(target_id, "network", client_is_user)
+        if model_names.get(target_id) in communities:
+            add(target_id, "members", 1)
+            add(target_id, "managers", relation.is_manager and 1 or 0)
+            add(client_id, "communities", 1)
+        if model_names.get(client_id) in communities:
+            add(client_id, "members", 1)
+            add(client_id, "managers", reverse[0] and 1 or 0)
+            add(target_id, "communities", 1)
+            
+    # Relations are also deleted when an account is: forget about it.
+    return dict([ (k, v) for k, v in deltas.items() if model_names.has_key(k) ])
+
+def network_post_save(sender, instance, created, **kw):
+    if created:
+        RelationCounters.objects.bump(_relation_deltas(instance, 1))
+
+def network_post_delete(sender, instance, **kw):
+    RelationCounters.objects.bump(_relation_deltas(instance, -1))
+
+post_save.connect(network_post_save, sender = Network)
+post_delete.connect(network_post_delete, sender = Network)
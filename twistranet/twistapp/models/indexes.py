@@ -0,0 +1,124 @@
+"""
+Composite indexes and packed permissions storage for the Twistable table.
+
+Django can't declare multi-column indexes, so we create them after syncdb (see create_composite_indexes()).
+Listings filter on the access index (_access_token) or, in legacy mode, on (_access_network, _p_can_list),
+and are ordered by id: those indexes let the database answer a page without sorting the whole table.
+Walls and feeds are UNIONs of per-publisher and per-owner branches (see ContentManager._union_ids),
+served by the (publisher_id, id) and (owner_id, id) indexes.
+
+The 'twistranet_pack_permissions' command migrates an existing database:
+it adds the _p_packed column, fills it from the _p_can_* columns and creates the composite indexes.
+"""
+from django.db import connection, transaction, DatabaseError
+from django.db.models.signals import post_syncdb
+from django.conf import settings
+
+from twistranet.twistapp.lib import permissions
+from twistable import Twistable
+
+# (index name, columns)
+COMPOSITE_INDEXES = (
+    ("twistable_access_network_list", ("_access_network_id", "_p_can_list", "id", ), ),
+    ("twistable_access_token", ("_access_token", "id", ), ),
+    ("twistable_anonymous_visible", ("_is_anonymous_visible", "id", ), ),
+    ("twistable_publisher_id", ("publisher_id", "id", ), ),
+    ("twistable_owner_id", ("owner_id", "id", ), ),
+)
+
+# Single-column indexes which are useless in packed permissions mode
+PACKED_UNINDEXED_COLUMNS = ("permissions", ) + tuple([
+    "_p_%s" % p for p in permissions.packed_permissions if p != permissions.can_list
+])
+
+def _execute_ddl(sql):
+    """
+    Execute a DDL statement. Return False if it failed (eg. index already exists).
+    """
+    cursor = connection.cursor()
+    sid = transaction.savepoint()
+    try:
+        cursor.execute(sql)
+    except DatabaseError:
+        transaction.savepoint_rollback(sid)
+        return False
+    transaction.savepoint_commit(sid)
+    return True
+
+def create_composite_indexes():
+    """
+    Create missing composite indexes. Return the names of the created ones.
+    """
+    qn = connection.ops.quote_name
+    table = Twistable._meta.db_table
+    created = []
+    for name, columns in COMPOSITE_INDEXES:
+        if _execute_ddl("CREATE INDEX %s ON %s (%s)" % (qn(name), qn(table), ", ".join([ qn(c) for c in columns ]))):
+            created.append(name)
+    transaction.commit_unless_managed()
+    return created
+
+def drop_unused_indexes():
+    """
+    Drop single-column indexes made useless by the packed permissions mode.
+    Index names are the ones Django gave them at syncdb time. Return the names of the dropped ones.
+    """
+    from django.db.backends.util import truncate_name
+    qn = connection.ops.quote_name
+    table = Twistable._meta.db_table
+    dropped = []
+    for column in PACKED_UNINDEXED_COLUMNS:
+        name = truncate_name("%s_%s" % (table, connection.creation._digest(column)), connection.ops.max_name_length())
+        if "mysql" in settings.DATABASES["default"]["ENGINE"]:
+            sql = "DROP INDEX %s ON %s" % (qn(name), qn(table))
+        else:
+            sql = "DROP INDEX %s" % qn(name)
+        if _execute_ddl(sql):
+            dropped.append(name)
+    transaction.commit_unless_managed()
+    return dropped
+
+def add_column(name, model = Twistable):
+    """
+    Add the given field of model (Twistable by default) to an existing database (we don't have schema migrations).
+    Return False if it's already there.
+    """
+    qn = connection.ops.quote_name
+    field = model._meta.get_field(name)
+    sql = "ALTER TABLE %s ADD COLUMN %s %s" % (qn(model._meta.db_table), qn(field.column), field.db_type(connection = connection))
+    if field.null:
+        sql += " NULL"
+    else:
+        default = field.get_default()
+        if isinstance(default, bool):
+            if "postgresql" in settings.DATABASES["default"]["ENGINE"]:
+                default = default and "true" or "false"
+            else:
+                default = int(default)
+        sql += " NOT NULL DEFAULT %s" % default
+    ret = _execute_ddl(sql)
+    transaction.commit_unless_managed()
+    return ret
+
+def pack_permission_columns():
+    """
+    Compute _p_packed from the _p_can_* columns, in a single UPDATE statement.
+    Must match permissions.pack_roles().
+    """
+    qn = connection.ops.quote_name
+    terms = []
+    for i, permission in enumerate(permissions.packed_permissions):
+        cases = " ".join([
+            "WHEN %d THEN %d" % (role, level + 1) for level, role in enumerate(permissions._role_levels)
+        ])
+        terms.append("(CASE %s %s ELSE 0 END) * %d" % (qn("_p_%s" % permission), cases, 1 << (3 * i)))
+    cursor = connection.cursor()
+    cursor.execute("UPDATE %s SET %s = %s" % (qn(Twistable._meta.db_table), qn("_p_packed"), " + ".join(terms)))
+    transaction.commit_unless_managed()
+    return cursor.rowcount
+
+def _post_syncdb(sender, created_models, **kw):
+    if sender.__name__ == "twistranet.twistapp.models" and Twistable in created_models:
+        create_composite_indexes()
+
+post_syncdb.connect(_post_syncdb)
@@ -74,8 +74,11 @@ class MenuItem(Twistable):
     def children(self):
         """
         You can override this, maybe?
+        Targets are dereferenced at once so that the 'label' property issues no query.
         """
-        return MenuItem.objects.filter(parent = self).order_by('order')
+        children = list(MenuItem.objects.filter(parent = self).order_by('order').select_related("target"))
+        Twistable.objects.dereference([ child.target for child in children if child.target_id ])
+        return children
 
     @property
     def label(self):
@@ -1,16 +1,365 @@
-from django.db import models
+from __future__ import with_statement
+import threading
+from django.db import models, connection, transaction, IntegrityError
+from django.db.models import Q
+from django.db.models.signals import post_save, post_delete
 from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.conf import settings
+from twistranet.twistapp.signals import twistable_post_save
+from twistranet.twistapp.lib import roles
+from twistranet.core import caches
 from twistranet.twistapp.models import Content
 from twistranet.twistapp.models import Account
 
 
+NETWORK_GRAPH_CHUNK = 500          # Number of version stamps fetched at once when building the index
+RELATIONS_CACHE_DELAY = caches.ID_SET_CACHE_DELAY
+RELATIONS_BATCH_SIZE = 500         # Number of relations created per transaction by Network.objects.bulk_add()
+SQL_CHUNK = 400                    # Number of ids in each IN clause (SQLite limits statements to 999 parameters)
+
+def _chunks(seq, size):
+    seq = list(seq)
+    for i in range(0, len(seq), size):
+        yield seq[i:i + size]
+
+class _Relations(object):
+    """
+    Relations of one account, as caches.SortedIds, stamped with the version of the account.
+    - out_ids: accounts it requested (followed, joined communities...) ;
+    - in_ids: accounts which requested it ;
+    - mutual_ids: both of the above (approved network, community members) ;
+    - managed_ids: out_ids flagged is_manager (communities it manages) ;
+    - manager_ids: in_ids flagged is_manager (accounts managing this community).
+    """
+    __slots__ = ("stamp", "out_ids", "in_ids", "mutual_ids", "managed_ids", "manager_ids", )
+    
+    def __init__(self, stamp, out_ids = (), in_ids = (), managed_ids = (), manager_ids = ()):
+        self.stamp = stamp
+        self.out_ids = caches.SortedIds(out_ids)
+        self.in_ids = caches.SortedIds(in_ids)
+        self.managed_ids = caches.SortedIds(managed_ids)
+        self.manager_ids = caches.SortedIds(manager_ids)
+        self.mutual_ids = caches.SortedIds([ i for i in self.out_ids if i in self.in_ids ])
+        
+    def pack(self, ):
+        return (self.stamp, self.out_ids.pack(), self.in_ids.pack(), self.managed_ids.pack(), self.manager_ids.pack(), )
+        
+    @classmethod
+    def unpack(cls, packed):
+        ret = cls(packed[0])
+        ret.out_ids, ret.in_ids, ret.managed_ids, ret.manager_ids = [ caches.SortedIds.unpack(p) for p in packed[1:] ]
+        ret.mutual_ids = caches.SortedIds([ i for i in ret.out_ids if i in ret.in_ids ])
+        return ret
+        
+    def changed(self, stamp, other_id, outgoing, is_manager, deleted):
+        """
+        Return a copy with the relation to other_id added (or removed), stamped with the new version.
+        """
+        out_ids, in_ids = set(self.out_ids), set(self.in_ids)
+        managed_ids, manager_ids = set(self.managed_ids), set(self.manager_ids)
+        ids, flagged = outgoing and (out_ids, managed_ids) or (in_ids, manager_ids)
+        ids.discard(other_id)
+        flagged.discard(other_id)
+        if not deleted:
+            ids.add(other_id)
+            if is_manager:
+                flagged.add(other_id)
+        return _Relations(stamp, out_ids, in_ids, managed_ids, manager_ids)
+
 class NetworkManager(object):
     """
-    Set of methods to handle relations and cache them
-    XXX TODO with pickling and replace Account & Community methods
+    In-memory index of the Network table, to answer relation queries (network, pending requests,
+    followers, community members and managers) without self-joins.
+    
+    The whole table is read at once the first time the index is used, then kept up to date
+    from Network signals. Each account's relations are stamped with its version (see caches.bump_versions(),
+    which changed() calls): relations changed by another process are read again when they're used,
+    from the shared cache or else from the database with one query.
+    The shared cache entries are updated in place by changed() as well.
+    If TWISTRANET_NETWORK_GRAPH is False, or if the cache backend isn't shared between processes
+    (see caches.process_cache_enabled()), nothing is kept in process memory.
+    
+    Ids are NOT secured: filter them through a secured manager before display.
     """
+    def __init__(self, ):
+        self._relations = {}
+        self._built = False
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        
+    @property
+    def enabled(self, ):
+        return getattr(settings, "TWISTRANET_NETWORK_GRAPH", True) and caches.process_cache_enabled()
+        
+    def clear(self, ):
+        """
+        Forget everything. The index is built again when it's used.
+        """
+        with self._lock:
+            self._relations = {}
+            self._built = False
+        
+    def scan(self, ):
+        """
+        Return the _Relations of all accounts as an {account_id: _Relations} dict, with one scan of the Network table.
+        Version stamps are read before the scan, so that changes made meanwhile make the relations stale.
+        """
+        account_ids = list(Account.objects.__booster__.values_list("id", flat = True))
+        stamps = {}
+        for start in range(0, len(account_ids), NETWORK_GRAPH_CHUNK):
+            chunk = account_ids[start:start + NETWORK_GRAPH_CHUNK]
+            stamps.update(zip(chunk, caches.get_versions(*chunk)))
+        edges = dict([ (id, ([], [], [], [])) for id in account_ids ])
+        for client_id, target_id, is_manager in Network.objects.values_list("client", "target", "is_manager").iterator():
+            if client_id in edges:
+                edges[client_id][0].append(target_id)
+                if is_manager:
+                    edges[client_id][2].append(target_id)
+            if target_id in edges:
+                edges[target_id][1].append(client_id)
+                if is_manager:
+                    edges[target_id][3].append(client_id)
+        relations = {}
+        for id, (out_ids, in_ids, managed_ids, manager_ids) in edges.iteritems():
+            relations[id] = _Relations(stamps[id], out_ids, in_ids, managed_ids, manager_ids)
+        return relations
+
+    def build(self, ):
+        """
+        Build the index (see scan()).
+        """
+        relations = self.scan()
+        with self._lock:
+            self._relations = relations
+            self._built = True
+        
+    def _load(self, account_id, stamp):
+        """
+        Read the relations of one account from the database, with one query.
+        """
+        out_ids, in_ids, managed_ids, manager_ids = [], [], [], []
+        rows = Network.objects.filter(Q(client__id = account_id) | Q(target__id = account_id)).values_list("client", "target", "is_manager")
+        for client_id, target_id, is_manager in rows:
+            if client_id == account_id:
+                out_ids.append(target_id)
+                if is_manager:
+                    managed_ids.append(target_id)
+            if target_id == account_id:
+                in_ids.append(client_id)
+                if is_manager:
+                    manager_ids.append(client_id)
+        return _Relations(stamp, out_ids, in_ids, managed_ids, manager_ids)
+        
+    def _get_shared(self, account_id, stamp):
+        packed = cache.get("tn_relations#%s" % account_id, None)
+        if packed is None or packed[0] != stamp:
+            return None
+        return _Relations.unpack(packed)
+        
+    def _set_shared(self, account_id, relations):
+        cache.set("tn_relations#%s" % account_id, relations.pack(), RELATIONS_CACHE_DELAY)
+        
+    def get(self, account_id):
+        """
+        Return the up-to-date _Relations of the given account id.
+        """
+        stamp = caches.get_versions(account_id)[0]
+        if self.enabled:
+            if not self._built:
+                self.build()
+            ret = self._relations.get(account_id, None)
+            if ret is not None and ret.stamp == stamp:
+                self.hits += 1
+                return ret
+        self.misses += 1
+        ret = self._get_shared(account_id, stamp)
+        if ret is None:
+            ret = self._load(account_id, stamp)
+            self._set_shared(account_id, ret)
+        if self.enabled:
+            self._relations[account_id] = ret
+        return ret
+        
+    def changed(self, client_id, target_id, is_manager, deleted = False):
+        """
+        Record a change of the client => target relation: bump the versions of both accounts
+        and update their relations in memory and in the shared cache.
+        Relations which were already stale, or changed concurrently (the version was bumped more than once),
+        are left as is, to be read again from the database.
+        """
+        stamps = caches.get_versions(client_id, target_id)
+        caches.bump_versions(client_id, target_id)
+        new_stamps = caches.get_versions(client_id, target_id)
+        for account_id, other_id, outgoing, stamp, new_stamp in (
+            (client_id, target_id, True, stamps[0], new_stamps[0]),
+            (target_id, client_id, False, stamps[1], new_stamps[1]),
+            ):
+            if new_stamp != stamp + 1:
+                continue
+            relations = self.enabled and self._relations.get(account_id, None) or None
+            if relations is None or relations.stamp != stamp:
+                relations = self._get_shared(account_id, stamp)
+            if relations is None:
+                continue
+            relations = relations.changed(new_stamp, other_id, outgoing, is_manager, deleted)
+            self._set_shared(account_id, relations)
+            if self.enabled and self._built:
+                self._relations[account_id] = relations
+        
+    def invalidate(self, *account_ids):
+        """
+        Make the relations of the given accounts stale, in all processes (after set-wise changes).
+        """
+        caches.bump_versions(*account_ids)
+        
+    # Queries
+    
+    def following_ids(self, account_id):
+        """Ids of the accounts account_id requested (follows, or is a member of)"""
+        return self.get(account_id).out_ids
+        
+    def follower_ids(self, account_id):
+        """Ids of the accounts which requested account_id"""
+        return self.get(account_id).in_ids
+        
+    def mutual_ids(self, account_id):
+        """Ids of the accounts in an approved relation with account_id (network or community members)"""
+        return self.get(account_id).mutual_ids
+        
+    def pending_ids(self, account_id):
+        """Ids of the accounts whose request account_id has yet to approve"""
+        relations = self.get(account_id)
+        return caches.SortedIds([ i for i in relations.in_ids if i not in relations.out_ids and i != account_id ])
+        
+    def manager_ids(self, community_id):
+        """Ids of the members managing the given community"""
+        relations = self.get(community_id)
+        return caches.SortedIds([ i for i in relations.manager_ids if i in relations.mutual_ids ])
+        
+    def is_member(self, community_id, account_id, is_manager = False):
+        """True if account_id is a member (or a manager) of community_id"""
+        relations = self.get(community_id)
+        if is_manager:
+            return account_id in relations.mutual_ids and account_id in relations.manager_ids
+        return account_id in relations.mutual_ids
     
 
+class RelationManager(models.Manager):
+    """
+    Set-wise creation of relations.
+    """
+    def existing_pairs(self, pairs):
+        """
+        Return the set of the given (client_id, target_id) pairs which are already in the table.
+        """
+        ret = set()
+        for chunk in _chunks(pairs, SQL_CHUNK // 2):
+            rows = self.filter(
+                client__id__in = set([ c for c, t in chunk ]),
+                target__id__in = set([ t for c, t in chunk ]),
+            ).values_list("client", "target")
+            ret.update(set(rows) & set(chunk))
+        return ret
+        
+    def _add_batch(self, edges):
+        """
+        Insert one batch of (client_id, target_id, is_manager) relations and do what the Network signals
+        would have done for each of them. Return the created ones.
+        """
+        from bulk import _insert_rows
+        from content import Content
+        from counters import RelationCounters
+        from timeline import Timeline
+        from suggestion import StaleSuggestion
+        
+        flags = {}
+        for client_id, target_id, is_manager in edges:
+            if client_id is not None and target_id is not None:
+                flags.setdefault((client_id, target_id), is_manager)
+        existing = self.existing_pairs(flags.keys())
+        created = [ (c, t, flags[(c, t)]) for c, t in flags.keys() if (c, t) not in existing ]
+        if not created:
+            return []
+        _insert_rows(Network, [ Network(client_id = c, target_id = t, is_manager = m) for c, t, m in created ], return_ids = False)
+        
+        # Access tokens (see _add_token)
+        tokens = set([ (t, c) for c, t, m in created ])
+        for chunk in _chunks(tokens, SQL_CHUNK // 2):
+            tokens.difference_update(AccessToken.objects.filter(
+                principal__id__in = set([ p for p, tk in chunk ]),
+                token__in = set([ tk for p, tk in chunk ]),
+            ).values_list("principal", "token"))
+        if tokens:
+            _insert_rows(AccessToken, [ AccessToken(principal_id = p, token = tk) for p, tk in tokens ], return_ids = False)
+        
+        # Authors to display (see _reset_owners_for_display)
+        client_ids = set([ c for c, t, m in created ])
+        target_ids = set([ t for c, t, m in created ])
+        account_ids = client_ids | target_ids
+        pairs = set([ (c, t) for c, t, m in created ] + [ (t, c) for c, t, m in created ])
+        reset_ids = []
+        for chunk in _chunks(account_ids, SQL_CHUNK):
+            rows = Content.objects.__booster__.filter(publisher__id__in = chunk, _owner_for_display__isnull = False).values_list("id", "owner", "publisher")
+            reset_ids.extend([ id for id, owner_id, publisher_id in rows if (owner_id, publisher_id) in pairs ])
+        for chunk in _chunks(reset_ids, SQL_CHUNK):
+            Content.objects.__booster__.filter(id__in = chunk).update(_owner_for_display = None)
+                
+        RelationCounters.objects.refresh(account_ids)
+        for chunk in _chunks(client_ids, SQL_CHUNK):
+            Timeline.objects.invalidate(*chunk)
+        StaleSuggestion.objects.mark(*account_ids)
+        return created
+        
+    def bulk_add(self, edges, batch_size = None, batch_done = None):
+        """
+        Create the given (client_id, target_id, is_manager) relations, skipping those which already exist,
+        with multi-row INSERT statements, batch_size relations per transaction.
+        edges can be any iterable (eg. a generator reading a file): it's consumed one batch at a time.
+        
+        What the Network post_save signals do for each relation (access tokens, counters, caches, timelines, stale suggestions)
+        is done once per batch instead, and those signals are NOT sent.
+        batch_done(created) is called after each batch with the list of created relations.
+        If a transaction is already managed, batches are not committed.
+        Return the number of created relations.
+        """
+        batch_size = batch_size or RELATIONS_BATCH_SIZE
+        managed = transaction.is_managed()
+        total = 0
+        edges = iter(edges)
+        while True:
+            batch = []
+            for edge in edges:
+                batch.append(edge)
+                if len(batch) >= batch_size:
+                    break
+            if not batch:
+                break
+            if not managed:
+                transaction.enter_transaction_management()
+                transaction.managed(True)
+            try:
+                try:
+                    created = self._add_batch(batch)
+                    if not managed:
+                        transaction.commit()
+                except:
+                    if not managed:
+                        transaction.rollback()
+                    raise
+            finally:
+                if not managed:
+                    transaction.leave_transaction_management()
+            if created:
+                account_ids = set([ c for c, t, m in created ]) | set([ t for c, t, m in created ])
+                Network.graph.invalidate(*account_ids)
+                caches.invalidate_id_sets(*account_ids)
+            total += len(created)
+            if batch_done:
+                batch_done(created)
+        return total
+
 class Network(models.Model):
     """
     A relation describes what happens when two users 'meet'.
@@ -66,6 +415,11 @@ class Network(models.Model):
     target = models.ForeignKey(Account, related_name = "requesting_network")
     is_manager = models.BooleanField(default = False)       # True if the client has acquired a management role on the target. Only for communities.
     
+    objects = RelationManager()
+    
+    # In-memory relations index
+    graph = NetworkManager()
+    
     def __unicode__(self):
         return u"%s => %s (mgr=%s)" % (self.client, self.target, self.is_manager, )
 
@@ -75,3 +429,193 @@ class Network(models.Model):
 
 
 
+
+
+class AccessTokenManager(models.Manager):
+    """
+    Maintenance methods for the access index.
+    """
+    def _sql_dict(self, ):
+        from twistranet.twistapp.models import Twistable
+        from twistranet.twistapp.lib import roles
+        qn = connection.ops.quote_name
+        return {
+            "token":        qn(AccessToken._meta.db_table),
+            "network":      qn(Network._meta.db_table),
+            "account":      qn(Account._meta.db_table),
+            "twistable":    qn(Twistable._meta.db_table),
+            "public_token": AccessToken.PUBLIC_TOKEN,
+            "owner":        roles.owner,
+            "network_role": roles.network,
+            "public":       roles.public,
+        }
+        
+    def rebuild(self, ):
+        """
+        Rebuild the whole access index (principal tokens AND twistables' _access_token) from scratch.
+        This is done in a few set-wise SQL statements, so it's safe to run on large databases.
+        The CASE statement must match Twistable.get_access_token().
+        """
+        d = self._sql_dict()
+        cursor = connection.cursor()
+        cursor.execute("DELETE FROM %(token)s" % d)
+        cursor.execute("""
+            INSERT INTO %(token)s (principal_id, token)
+            SELECT target_id, client_id FROM %(network)s
+        """ % d)
+        cursor.execute("""
+            INSERT INTO %(token)s (principal_id, token)
+            SELECT twistable_ptr_id, -twistable_ptr_id FROM %(account)s
+        """ % d)
+        cursor.execute("""
+            INSERT INTO %(token)s (principal_id, token)
+            SELECT twistable_ptr_id, %(public_token)d FROM %(account)s
+        """ % d)
+        cursor.execute("""
+            UPDATE %(twistable)s SET _access_token = CASE
+                WHEN _p_can_list = %(owner)d THEN -owner_id
+                WHEN _p_can_list IN (%(network_role)d, %(public)d) AND _access_network_id IS NOT NULL THEN _access_network_id
+                WHEN _p_can_list = %(public)d THEN %(public_token)d
+                ELSE NULL
+            END
+        """ % d)
+        transaction.commit_unless_managed()
+        self.rebuild_anonymous_flags()
+        
+    def _anonymous_visible_queryset(self):
+        """
+        Return the twistables listable by AnonymousAccount, computed from their access network.
+        This is the legacy anonymous query and must match Twistable.get_anonymous_visible().
+        """
+        from twistranet.twistapp.models import Twistable
+        free_access_network = Twistable.objects.__booster__.filter(
+            _access_network__isnull = True,
+            _p_can_list = roles.public,
+        )
+        return Twistable.objects.__booster__.filter(
+            Q(_access_network__isnull = True) | Q(_access_network__id__in = free_access_network.values("id")),
+            _p_can_list = roles.public,
+        )
+        
+    def rebuild_anonymous_flags(self, ):
+        """
+        Backfill Twistable._is_anonymous_visible.
+        """
+        from twistranet.twistapp.models import Twistable
+        Twistable.objects.__booster__.update(_is_anonymous_visible = False)
+        self._anonymous_visible_queryset().update(_is_anonymous_visible = True)
+        transaction.commit_unless_managed()
+        
+    def check(self, ):
+        """
+        Return a dict of inconsistencies counts between the access index and the actual data.
+        All values should be 0.
+        """
+        from twistranet.twistapp.models import Twistable
+        d = self._sql_dict()
+        ret = {}
+        ret["missing_network_tokens"] = Network.objects.extra(where = ["""NOT EXISTS (
+            SELECT 1 FROM %(token)s t WHERE t.principal_id = %(network)s.target_id AND t.token = %(network)s.client_id
+        )""" % d]).count()
+        ret["stale_network_tokens"] = self.filter(token__gt = 0).extra(where = ["""NOT EXISTS (
+            SELECT 1 FROM %(network)s n WHERE n.target_id = %(token)s.principal_id AND n.client_id = %(token)s.token
+        )""" % d]).count()
+        ret["missing_account_tokens"] = Account.objects.__booster__.extra(where = ["""(
+            SELECT COUNT(*) FROM %(token)s t WHERE t.principal_id = %(account)s.twistable_ptr_id
+            AND t.token IN (%(public_token)d, -%(account)s.twistable_ptr_id)
+        ) < 2""" % d]).count()
+        stale_twistables = 0
+        for t in Twistable.objects.__booster__.values_list("_p_can_list", "_access_network", "owner", "_access_token").iterator():
+            p_can_list, access_network_id, owner_id, access_token = t
+            if access_token != Twistable.get_access_token(p_can_list, access_network_id, owner_id):
+                stale_twistables += 1
+        ret["stale_twistables"] = stale_twistables
+        visible_ids = set(self._anonymous_visible_queryset().values_list("id", flat = True))
+        flagged_ids = set(Twistable.objects.__booster__.filter(_is_anonymous_visible = True).values_list("id", flat = True))
+        ret["stale_anonymous_flags"] = len(visible_ids ^ flagged_ids)
+        return ret
+
+class AccessToken(models.Model):
+    """
+    Materialized "who can list what" index.
+    
+    A principal (ie. an Account) holds a set of integer tokens,
+    and a Twistable is listable by the principal if its _access_token is one of them.
+    That way, the secured queryset is a single indexed semi-join.
+    
+    Tokens are:
+    - PUBLIC_TOKEN (0): public objects without any access network ;
+    - -account.id: objects restricted to their owner ;
+    - account.id: objects listable by the network of this account, that is
+      a principal holds this token if there's a Network(client = account, target = principal) relation.
+      
+    Principal tokens are maintained from Network post_save / post_delete signals,
+    Twistable tokens are computed by Twistable._update_access_network().
+    Use the 'twistranet_access_index' command to check or rebuild the index.
+    """
+    PUBLIC_TOKEN = 0
+    
+    principal = models.ForeignKey(Account, related_name = "+")
+    token = models.IntegerField()
+    
+    objects = AccessTokenManager()
+    
+    def __unicode__(self):
+        return u"%s: %s" % (self.principal_id, self.token, )
+
+    class Meta:
+        app_label = 'twistapp'
+        unique_together = ("principal", "token", )
+        
+
+def _add_token(principal_id, token):
+    """
+    Idempotently add a token to a principal
+    """
+    if not AccessToken.objects.filter(principal__id = principal_id, token = token).exists():
+        try:
+            sid = transaction.savepoint()
+            AccessToken.objects.create(principal_id = principal_id, token = token)
+            transaction.savepoint_commit(sid)
+        except IntegrityError:
+            transaction.savepoint_rollback(sid)
+    
+def _reset_owners_for_display(client_id, target_id):
+    """
+    Membership changed: the author to display of the content one published on the other must be computed again.
+    Until Content.objects.update_owners_for_display() does so, it's computed when rendered.
+    """
+    Content.objects.__booster__.filter(
+        Q(owner__id = client_id, publisher__id = target_id) | Q(owner__id = target_id, publisher__id = client_id),
+        _owner_for_display__isnull = False,
+    ).update(_owner_for_display = None)
+
+def _relation_changed(instance, deleted):
+    """
+    Invalidate what's cached about both accounts and update the relations index.
+    """
+    Network.graph.changed(instance.client_id, instance.target_id, instance.is_manager, deleted)
+    caches.invalidate_id_sets(instance.client_id, instance.target_id)
+
+def network_post_save(sender, instance, created, **kw):
+    if created:
+        _add_token(instance.target_id, instance.client_id)
+        _reset_owners_for_display(instance.client_id, instance.target_id)
+    _relation_changed(instance, False)
+
+def network_post_delete(sender, instance, **kw):
+    AccessToken.objects.filter(principal__id = instance.target_id, token = instance.client_id).delete()
+    _reset_owners_for_display(instance.client_id, instance.target_id)
+    _relation_changed(instance, True)
+    
+def account_post_save(sender, instance, created, **kw):
+    """
+    Give its owner and public tokens to each new account.
+    """
+    if created and isinstance(instance, Account):
+        _add_token(instance.id, -instance.id)
+        _add_token(instance.id, AccessToken.PUBLIC_TOKEN)
+
+post_save.connect(network_post_save, sender = Network)
+post_delete.connect(network_post_delete, sender = Network)
+twistable_post_save.connect(account_post_save)
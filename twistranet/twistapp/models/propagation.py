@@ -0,0 +1,157 @@
+"""
+Background propagation of _access_network changes.
+
+When an account or a community changes its visibility, all the public objects
+it publishes (and all the objects whose access network it is) must be updated.
+On a large site, that's tens of thousands of rows: way too much for the request
+that saved the object. So Twistable._update_access_network() only updates the
+object itself and queues an AccessPropagation job if there are too many dependants.
+
+Jobs are processed in chunks, each chunk in its own transaction, by the
+'twistranet_propagate' management command (run it from cron).
+Progress (last processed id) is saved after each chunk, so an interrupted job just resumes.
+
+While a job is pending, the secured managers hide the affected objects (fail closed).
+"""
+from django.db import models, transaction, DatabaseError
+from django.db.models import Q
+from django.core.cache import cache
+from django.conf import settings
+
+from twistranet.twistapp.lib import roles
+from twistable import Twistable
+
+PENDING_CACHE_KEY = "tn_access_pending"
+PROPAGATION_CHUNK_SIZE = 500
+PROPAGATION_SYNC_LIMIT = 1000           # Above this number of dependants, propagation is deferred.
+
+def get_dependants(source_id):
+    """
+    Return a queryset of the objects whose _access_network depends on the given source.
+    """
+    return Twistable.objects.__booster__.filter(
+        Q(_access_network__id = source_id) | Q(publisher__id = source_id),
+        _p_can_list = roles.public,
+    ).exclude(id = source_id)
+
+class AccessPropagationManager(models.Manager):
+    """
+    Queue and process _access_network propagation jobs.
+    """
+    def pending_source_ids(self):
+        """
+        Return a tuple of ids of objects with a pending propagation.
+        This is called by each secured query, so it's kept in the shared cache.
+        """
+        ret = cache.get(PENDING_CACHE_KEY, None)
+        if ret is None:
+            try:
+                ret = tuple(self.values_list("source__id", flat = True))
+            except DatabaseError:
+                # No table yet. This is NORMAL during syncdb or bootstrap.
+                return ()
+            cache.set(PENDING_CACHE_KEY, ret)
+        return ret
+
+    def propagate(self, source, access_network):
+        """
+        Set access_network on source's dependants, either immediately (if there are only a few of them)
+        or by queuing a job. A job already queued for source is superseded.
+        """
+        limit = getattr(settings, "TWISTRANET_ACCESS_PROPAGATION_SYNC_LIMIT", PROPAGATION_SYNC_LIMIT)
+        dependants = get_dependants(source.id)
+        access_network_id = access_network and access_network.id
+        if limit is None or len(dependants.values_list("id", flat = True)[:limit + 1]) <= limit:
+            dependants.update(
+                _access_network = access_network_id,
+                _access_token = Twistable.get_access_token(roles.public, access_network_id, None),
+                _is_anonymous_visible = Twistable.get_anonymous_visible(roles.public, access_network),
+            )
+            # Any queued job for this source is now obsolete
+            if source.id in self.pending_source_ids():
+                self.filter(source__id = source.id).delete()
+                cache.delete(PENDING_CACHE_KEY)
+            return None
+
+        # Too many of them: (re)queue the job
+        job, created = self.get_or_create(source = source, defaults = {"access_network": access_network})
+        if not created:
+            self.filter(id = job.id).update(access_network = access_network_id, last_id = 0, processed = 0)
+        cache.delete(PENDING_CACHE_KEY)
+        return job
+
+    def process(self, chunk_size = None, max_chunks = None, callback = None):
+        """
+        Process pending jobs, chunk_size objects per transaction, at most max_chunks chunks.
+        callback(job) is called after each chunk.
+        Return the number of updated objects.
+        """
+        chunk_size = chunk_size or PROPAGATION_CHUNK_SIZE
+        n_chunks = 0
+        n_updated = 0
+        for job_id in self.order_by("id").values_list("id", flat = True):
+            while max_chunks is None or n_chunks < max_chunks:
+                n = self._process_chunk(job_id, chunk_size, callback)
+                if n is None:
+                    break
+                n_chunks += 1
+                n_updated += n
+        return n_updated
+
+    def _process_chunk(self, job_id, chunk_size, callback):
+        """
+        Process the next chunk of the given job in its own transaction.
+        Return the number of updated objects, or None if the job is over.
+        """
+        transaction.enter_transaction_management()
+        transaction.managed(True)
+        try:
+            try:
+                job = self.get(id = job_id)
+            except AccessPropagation.DoesNotExist:
+                return None
+            ids = list(get_dependants(job.source_id).filter(id__gt = job.last_id).order_by("id").values_list("id", flat = True)[:chunk_size])
+            if not ids:
+                self.filter(id = job.id, access_network = job.access_network_id, last_id = job.last_id).delete()
+                transaction.commit()
+                cache.delete(PENDING_CACHE_KEY)
+                return None
+            Twistable.objects.__booster__.filter(id__in = ids).update(
+                _access_network = job.access_network_id,
+                _access_token = Twistable.get_access_token(roles.public, job.access_network_id, None),
+                _is_anonymous_visible = Twistable.get_anonymous_visible(roles.public, job.access_network),
+            )
+            # If the job has been requeued in the meantime, this doesn't match and we start over.
+            self.filter(id = job.id, access_network = job.access_network_id, last_id = job.last_id).update(
+                last_id = ids[-1],
+                processed = job.processed + len(ids),
+            )
+            transaction.commit()
+            job.last_id = ids[-1]
+            job.processed += len(ids)
+            if callback:
+                callback(job)
+            return len(ids)
+        except:
+            transaction.rollback()
+            raise
+        finally:
+            transaction.leave_transaction_management()
+
+class AccessPropagation(models.Model):
+    """
+    A pending _access_network propagation from source to its dependants.
+    """
+    source = models.ForeignKey(Twistable, unique = True, related_name = "+")
+    access_network = models.ForeignKey(Twistable, null = True, related_name = "+")
+    last_id = models.IntegerField(default = 0)
+    processed = models.IntegerField(default = 0)
+    created_at = models.DateTimeField(auto_now_add = True)
+
+    objects = AccessPropagationManager()
+
+    class Meta:
+        app_label = 'twistapp'
+
+    def __unicode__(self,):
+        return u"Propagation from %s (%d objects done)" % (self.source_id, self.processed, )
@@ -0,0 +1,100 @@
+"""
+Slug allocation.
+
+Slugs are unique across all twistables. When a slug is already taken, we append
+a numeric suffix to its root ("meeting_notes", "meeting_notes_1", "meeting_notes_2", ...).
+Instead of probing each suffix in turn, we keep the last allocated suffix of each root
+in the SlugCounter table: allocating a slug costs at most one probe and one UPDATE,
+whatever the number of objects sharing the same title.
+
+The counter is only a hint: slugs given explicitly may be ahead of it, in which case
+allocate() resynchronizes it, and concurrent creators may still collide, in which case
+Twistable.save() retries with a fresh suffix when the database rejects the slug.
+Bulk imports can reserve a block of suffixes at once with SlugCounter.objects.reserve().
+"""
+import re
+from django.db import models, transaction, IntegrityError
+from django.db.models import F
+
+from twistable import Twistable
+
+SUFFIX_REGEX = re.compile(r"_(?P<num>[0-9]+)$")
+
+def split_slug(slug):
+    """
+    Return (root, numeric suffix) of the given slug, eg. ("meeting_notes", 3) for "meeting_notes_3".
+    Suffix is 0 if there's none.
+    """
+    match = SUFFIX_REGEX.search(slug)
+    if match:
+        return slug[:match.start()], int(match.group("num"))
+    return slug, 0
+
+class SlugCounterManager(models.Manager):
+    """
+    Allocate and reserve slugs.
+    """
+    def _max_suffix(self, root):
+        """
+        Return the highest numeric suffix used in the database with the given root.
+        This is a single (indexed) prefix query, only performed the first time a root is duplicated.
+        """
+        prefix = "%s_" % root
+        ret = 0
+        for slug in Twistable.objects.__booster__.filter(slug__startswith = prefix).values_list("slug", flat = True):
+            suffix = slug[len(prefix):]
+            if suffix.isdigit():
+                ret = max(ret, int(suffix))
+        return ret
+
+    def reserve(self, slug, count = 1):
+        """
+        Reserve 'count' consecutive suffixes for the root of the given slug.
+        Return the list of reserved slugs.
+        """
+        root, num = split_slug(slug)
+        while True:
+            if self.filter(root = root).update(last = F("last") + count):
+                break
+            # First duplicate of this root: initialize its counter from the existing slugs.
+            sid = transaction.savepoint()
+            try:
+                self.create(root = root, last = max(self._max_suffix(root), num) + count)
+            except IntegrityError:
+                # Someone else initialized it in the meantime
+                transaction.savepoint_rollback(sid)
+                continue
+            transaction.savepoint_commit(sid)
+            break
+        last = self.filter(root = root).values_list("last", flat = True)[0]
+        return [ "%s_%i" % (root, n, ) for n in range(last - count + 1, last + 1) ]
+
+    def allocate(self, slug):
+        """
+        Return the given slug if it's free, or a fresh suffixed one.
+        """
+        if not Twistable.objects.__booster__.filter(slug = slug).exists():
+            return slug
+        ret = self.reserve(slug)[0]
+        if Twistable.objects.__booster__.filter(slug = ret).exists():
+            # The counter is behind slugs which were given explicitly: catch up.
+            root, num = split_slug(slug)
+            last = self._max_suffix(root)
+            self.filter(root = root, last__lt = last).update(last = last)
+            ret = self.reserve(slug)[0]
+        return ret
+
+class SlugCounter(models.Model):
+    """
+    Last suffix allocated for a slug root.
+    """
+    root = models.CharField(max_length = 255, unique = True)
+    last = models.IntegerField(default = 0)
+
+    objects = SlugCounterManager()
+
+    class Meta:
+        app_label = 'twistapp'
+
+    def __unicode__(self,):
+        return u"%s_%d" % (self.root, self.last, )
@@ -0,0 +1,262 @@
+"""
+Precomputed "people you may know" suggestions.
+
+The candidates suggested to an account are scored from its relations (see Network.graph):
+- SUGGESTION_FRIEND_SCORE for each member of its network they're in the network of (second-degree connections) ;
+- SUGGESTION_COMMUNITY_SCORE for each community they're both members of.
+The global community and communities with more than SUGGESTIONS_MAX_COMMUNITY_SIZE members are not counted:
+about everybody shares them. Accounts it is already related to (requests either way) are not suggested.
+
+Computing that on request means self-joins of the Network table. Instead, Suggestion.objects.rebuild()
+scores every user account from a single scan of the Network table and stores its SUGGESTIONS_TOP_K best candidates
+in the Suggestion table ('./manage.py twistranet_suggestions', eg. from cron). Reading them is one indexed query.
+When one of its relations is saved or deleted, the suggestions of an account are only marked as stale
+(StaleSuggestion table): they're computed again by './manage.py twistranet_suggestions --stale' (eg. from cron),
+or when it reads them if TWISTRANET_SUGGESTIONS_REFRESH_ON_READ is True.
+
+Suggestions are NOT secured: get_for() filters them through the secured manager.
+"""
+import heapq
+from django.db import models, transaction
+from django.db.models.signals import post_save, post_delete
+from django.conf import settings
+
+from account import UserAccount
+from community import Community, GlobalCommunity
+from network import Network, _Relations, _chunks, SQL_CHUNK
+
+SUGGESTIONS_TOP_K = 20                  # Number of suggestions stored per account
+SUGGESTIONS_MAX_COMMUNITY_SIZE = 500    # Larger communities don't make their members suggestions
+SUGGESTIONS_IN_BOXES = 6                # Number of suggestions displayed on the homepage
+SUGGESTION_FRIEND_SCORE = 2
+SUGGESTION_COMMUNITY_SCORE = 1
+SUGGESTIONS_REFRESH_ON_READ = False     # Compute stale suggestions again when they're read
+
+def _setting(name, default):
+    return getattr(settings, "TWISTRANET_%s" % name, default)
+
+def _score(account_id, relations_of, community_ids, skipped_ids):
+    """
+    Return the {candidate_id: score} dict of the given account.
+    relations_of(id) returns the _Relations of an account. community_ids are the ids of the communities
+    (at least of those account_id is a member of), skipped_ids those which are not counted.
+    Candidates are not filtered by type: communities of its network are in there as well.
+    """
+    relations = relations_of(account_id)
+    scores = {}
+    for id in relations.mutual_ids:
+        if id in skipped_ids or id == account_id:
+            continue
+        weight = id in community_ids and SUGGESTION_COMMUNITY_SCORE or SUGGESTION_FRIEND_SCORE
+        for candidate_id in relations_of(id).mutual_ids:
+            scores[candidate_id] = scores.get(candidate_id, 0) + weight
+    scores.pop(account_id, None)
+    for id in relations.out_ids:
+        scores.pop(id, None)
+    for id in relations.in_ids:
+        scores.pop(id, None)
+    return scores
+
+def _best(scores, user_ids, top_k):
+    """
+    Return the top_k (candidate_id, score) tuples of user accounts, best first (lowest id first on ties).
+    """
+    return heapq.nlargest(
+        top_k,
+        [ (id, score) for id, score in scores.iteritems() if id in user_ids ],
+        key = lambda item: (item[1], -item[0]),
+    )
+
+class SuggestionManager(models.Manager):
+    """
+    Compute, store and read suggestions.
+    """
+    def _in_transaction(self, func, *args):
+        """
+        Call func(*args) in its own transaction, unless a transaction is already managed.
+        """
+        managed = transaction.is_managed()
+        if not managed:
+            transaction.enter_transaction_management()
+            transaction.managed(True)
+        try:
+            try:
+                ret = func(*args)
+                if not managed:
+                    transaction.commit()
+            except:
+                if not managed:
+                    transaction.rollback()
+                raise
+        finally:
+            if not managed:
+                transaction.leave_transaction_management()
+        return ret
+        
+    def _store(self, suggestions):
+        """
+        Replace the suggestions of the accounts given as {account_id: [(suggested_id, score), ...]}.
+        """
+        from bulk import _insert_rows
+        self.filter(account_id__in = suggestions.keys()).delete()
+        rows = []
+        for account_id, best in suggestions.iteritems():
+            rows.extend([ Suggestion(account_id = account_id, suggested_id = id, score = score) for id, score in best ])
+        if rows:
+            _insert_rows(Suggestion, rows, return_ids = False)
+        return len(rows)
+
+    def rebuild(self, top_k = None, batch_done = None):
+        """
+        Compute the suggestions of all user accounts from a single scan of the Network table,
+        and store them SQL_CHUNK accounts per transaction. Accounts marked as stale before the scan aren't anymore.
+        batch_done(accounts, stored) is called after each transaction with the running totals.
+        Return the number of stored suggestions.
+        """
+        top_k = top_k or _setting("SUGGESTIONS_TOP_K", SUGGESTIONS_TOP_K)
+        max_size = _setting("SUGGESTIONS_MAX_COMMUNITY_SIZE", SUGGESTIONS_MAX_COMMUNITY_SIZE)
+        last_stale_id = StaleSuggestion.objects.aggregate(models.Max("id"))["id__max"]
+        relations = Network.graph.scan()
+        empty = _Relations(None)
+        relations_of = lambda id: relations.get(id, empty)
+        community_ids = set(Community.objects.__booster__.values_list("id", flat = True))
+        skipped_ids = set(GlobalCommunity.objects.__booster__.values_list("id", flat = True))
+        skipped_ids.update([ id for id in community_ids if len(relations_of(id).mutual_ids) > max_size ])
+        user_ids = list(UserAccount.objects.__booster__.values_list("id", flat = True))
+        users = set(user_ids)
+
+        accounts, stored = 0, 0
+        for chunk in _chunks(user_ids, SQL_CHUNK):
+            suggestions = dict([
+                (id, _best(_score(id, relations_of, community_ids, skipped_ids), users, top_k))
+                for id in chunk
+            ])
+            stored += self._in_transaction(self._store, suggestions)
+            accounts += len(chunk)
+            if batch_done:
+                batch_done(accounts, stored)
+        if last_stale_id is not None:
+            self._in_transaction(StaleSuggestion.objects.filter(id__lte = last_stale_id).delete)
+        return stored
+
+    def _best_for(self, account_id, top_k):
+        """
+        Return the top_k best (candidate_id, score) tuples of one user account, from the relations index.
+        """
+        max_size = _setting("SUGGESTIONS_MAX_COMMUNITY_SIZE", SUGGESTIONS_MAX_COMMUNITY_SIZE)
+        community_ids = set()
+        for chunk in _chunks(Network.graph.mutual_ids(account_id), SQL_CHUNK):
+            community_ids.update(Community.objects.__booster__.filter(id__in = chunk).values_list("id", flat = True))
+        skipped_ids = set(GlobalCommunity.objects.__booster__.values_list("id", flat = True))
+        skipped_ids.update([ id for id in community_ids if len(Network.graph.mutual_ids(id)) > max_size ])
+        scores = _score(account_id, Network.graph.get, community_ids, skipped_ids)
+
+        # Only check the type of the best candidates
+        best = []
+        candidates = sorted(scores.iteritems(), key = lambda item: (-item[1], item[0]))
+        for chunk in _chunks(candidates, SQL_CHUNK):
+            users = set(UserAccount.objects.__booster__.filter(id__in = [ id for id, score in chunk ]).values_list("id", flat = True))
+            best.extend([ (id, score) for id, score in chunk if id in users ])
+            if len(best) >= top_k:
+                break
+        return best[:top_k]
+        
+    def _refresh(self, account_ids, top_k):
+        self._store(dict([ (id, self._best_for(id, top_k)) for id in account_ids ]))
+        StaleSuggestion.objects.filter(account_id__in = account_ids).delete()
+        
+    def refresh(self, account_ids, top_k = None):
+        """
+        Compute the suggestions of the given user account ids again, from the relations index,
+        in one transaction (unless one is already managed).
+        """
+        top_k = top_k or _setting("SUGGESTIONS_TOP_K", SUGGESTIONS_TOP_K)
+        self._in_transaction(self._refresh, list(account_ids), top_k)
+        
+    def refresh_stale(self, top_k = None, batch_done = None):
+        """
+        Compute the suggestions of the user accounts marked as stale again, SQL_CHUNK accounts per transaction.
+        batch_done(accounts) is called after each transaction with the running total.
+        Return the number of refreshed accounts.
+        """
+        stale_ids = sorted(set(StaleSuggestion.objects.values_list("account_id", flat = True)))
+        accounts = 0
+        for chunk in _chunks(stale_ids, SQL_CHUNK):
+            user_ids = list(UserAccount.objects.__booster__.filter(id__in = chunk).values_list("id", flat = True))
+            self.refresh(user_ids, top_k = top_k)
+            self._in_transaction(StaleSuggestion.objects.filter(account_id__in = chunk).delete)
+            accounts += len(user_ids)
+            if batch_done:
+                batch_done(accounts)
+        return accounts
+
+    def get_for(self, account, count = None):
+        """
+        Return the suggested accounts for the given account, best first, as UserAccount objects
+        it can see. Accounts it got related to since suggestions were computed are left out.
+        Stale suggestions are computed again first only if TWISTRANET_SUGGESTIONS_REFRESH_ON_READ is True.
+        """
+        count = count or _setting("SUGGESTIONS_IN_BOXES", SUGGESTIONS_IN_BOXES)
+        if _setting("SUGGESTIONS_REFRESH_ON_READ", SUGGESTIONS_REFRESH_ON_READ):
+            if StaleSuggestion.objects.filter(account_id = account.id).exists():
+                self.refresh([ account.id, ])
+        ids = list(self.filter(account_id = account.id).order_by("-score", "suggested_id").values_list("suggested_id", flat = True)[:2 * count])
+        relations = Network.graph.get(account.id)
+        ids = [ id for id in ids if id not in relations.out_ids and id not in relations.in_ids ]
+        if not ids:
+            return []
+        accounts = dict([ (a.id, a) for a in UserAccount.objects.filter(id__in = ids) ])
+        return [ accounts[id] for id in ids if id in accounts ][:count]
+
+class Suggestion(models.Model):
+    """
+    An account suggested to another one. Those are plain integers: deleted accounts are filtered out when reading.
+    """
+    account_id = models.IntegerField()
+    suggested_id = models.IntegerField()
+    score = models.IntegerField()
+
+    objects = SuggestionManager()
+
+    class Meta:
+        app_label = 'twistapp'
+        unique_together = ("account_id", "suggested_id", )
+
+
+class StaleSuggestionManager(models.Manager):
+    """
+    Mark suggestions as stale.
+    """
+    def mark(self, *account_ids):
+        """
+        Mark the suggestions of the given account ids as stale, unless they already are.
+        This doesn't commit: it's part of the current transaction.
+        """
+        from bulk import _insert_rows
+        account_ids = set(account_ids)
+        for chunk in _chunks(list(account_ids), SQL_CHUNK):
+            account_ids.difference_update(self.filter(account_id__in = chunk).values_list("account_id", flat = True))
+        if account_ids:
+            _insert_rows(StaleSuggestion, [ StaleSuggestion(account_id = id) for id in account_ids ], return_ids = False)
+
+class StaleSuggestion(models.Model):
+    """
+    An account whose suggestions have to be computed again.
+    The same account may be marked twice by concurrent processes: that does no harm.
+    """
+    account_id = models.IntegerField(db_index = True)
+
+    objects = StaleSuggestionManager()
+
+    class Meta:
+        app_label = 'twistapp'
+
+
+def network_changed(sender, instance, **kw):
+    """
+    Mark the suggestions of both accounts of the relation as stale.
+    """
+    StaleSuggestion.objects.mark(instance.client_id, instance.target_id)
+
+post_save.connect(network_changed, sender = Network)
+post_delete.connect(network_changed, sender = Network)
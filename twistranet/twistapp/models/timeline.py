@@ -0,0 +1,225 @@
+"""
+Materialized timelines (fan-out on write).
+
+The homepage timeline of an account is the content published on the accounts it follows.
+Computing it at read time (Content.objects.followed) means a big OR-ed, DISTINCT query
+whose cost grows with the total amount of content.
+
+Instead, when a content is created, its id is pushed to the TimelineEntry table
+for each account following its publisher, with a single INSERT ... SELECT statement.
+Reading a timeline is then an indexed range scan. Entries are trimmed to TIMELINE_DEPTH when read.
+
+- Only active accounts (whose timeline was read in the last TIMELINE_INACTIVE_DAYS) get entries pushed.
+  Other timelines are rebuilt from the regular query when they're read again.
+- Timelines are rebuilt as well when their account follows or unfollows somebody.
+- Publishers with a lot of followers (and the global community) are not fanned out:
+  their content is merged at read time instead (fan-out on read).
+
+Entries are NOT secured: ids must be filtered through a secured manager before display.
+"""
+import datetime
+from django.db import models, connection, transaction
+from django.db.models.signals import post_save, post_delete
+from django.core.cache import cache
+from django.conf import settings
+
+from twistranet.twistapp.signals import twistable_post_save, twistables_created
+from twistable import Twistable
+from account import Account
+from content import Content
+from network import Network
+
+TIMELINE_DEPTH = 200                    # Number of content ids kept in each timeline
+TIMELINE_INACTIVE_DAYS = 7              # Timelines which haven't been read for that long are not fed anymore
+TIMELINE_FANOUT_LIMIT = 1000            # Publishers with more followers than this are read on demand
+CELEBRITIES_CACHE_KEY = "tn_timeline_celebrities"
+CELEBRITIES_CACHE_DELAY = 60 * 5
+
+def _setting(name, default):
+    return getattr(settings, "TWISTRANET_%s" % name, default)
+
+class TimelineManager(models.Manager):
+    """
+    Feed and read materialized timelines.
+    """
+    def _inactive_delay(self, ):
+        return datetime.timedelta(days = _setting("TIMELINE_INACTIVE_DAYS", TIMELINE_INACTIVE_DAYS))
+
+    def celebrity_ids(self, fanout_limit = None):
+        """
+        Return the ids of the publishers whose content is merged at read time, as a set.
+        That's the global community plus the accounts having more than half the fan-out limit followers:
+        the margin makes sure that publishers around the limit are merged on read, whatever side they were at write time.
+        """
+        from community import GlobalCommunity
+        from counters import RelationCounters
+        if fanout_limit is None:
+            ret = cache.get(CELEBRITIES_CACHE_KEY, None)
+            if ret is not None:
+                return ret
+        limit = fanout_limit or _setting("TIMELINE_FANOUT_LIMIT", TIMELINE_FANOUT_LIMIT)
+        ret = set(RelationCounters.objects.filter(followers__gt = limit // 2).values_list("account", flat = True))
+        ret.update(GlobalCommunity.objects.__booster__.values_list("id", flat = True))
+        if fanout_limit is None:
+            cache.set(CELEBRITIES_CACHE_KEY, ret, CELEBRITIES_CACHE_DELAY)
+        return ret
+
+    def fan_out(self, contents):
+        """
+        Push the given (new) contents to the active timelines of their publishers' followers.
+        """
+        from community import GlobalCommunity
+        from counters import RelationCounters
+        limit = _setting("TIMELINE_FANOUT_LIMIT", TIMELINE_FANOUT_LIMIT)
+        publisher_ids = list(set([ c.publisher_id for c in contents if c.publisher_id ]))
+        if not publisher_ids:
+            return
+        skipped = set(RelationCounters.objects.filter(account__id__in = publisher_ids, followers__gt = limit).values_list("account", flat = True))
+        skipped.update(GlobalCommunity.objects.__booster__.filter(id__in = publisher_ids).values_list("id", flat = True))
+        content_ids = [ c.id for c in contents if c.publisher_id and c.publisher_id not in skipped ]
+        if not content_ids:
+            return
+
+        qn = connection.ops.quote_name
+        d = {
+            "entry":        qn(TimelineEntry._meta.db_table),
+            "timeline":     qn(Timeline._meta.db_table),
+            "twistable":    qn(Twistable._meta.db_table),
+            "network":      qn(Network._meta.db_table),
+            "ids":          ", ".join([ "%s" ] * len(content_ids)),
+        }
+        # Followers of the publisher, plus the publisher itself. UNION removes duplicates (accounts following themselves).
+        active_since = connection.ops.value_to_db_datetime(datetime.datetime.now() - self._inactive_delay())
+        cursor = connection.cursor()
+        cursor.execute("""
+            INSERT INTO %(entry)s (account_id, content_id)
+            SELECT n.client_id, c.id FROM %(twistable)s c
+            INNER JOIN %(network)s n ON n.target_id = c.publisher_id
+            INNER JOIN %(timeline)s t ON t.account_id = n.client_id
+            WHERE c.id IN (%(ids)s) AND t.last_read >= %%s
+            UNION
+            SELECT t.account_id, c.id FROM %(twistable)s c
+            INNER JOIN %(timeline)s t ON t.account_id = c.publisher_id
+            WHERE c.id IN (%(ids)s) AND t.last_read >= %%s
+            """ % d, content_ids + [ active_since, ] + content_ids + [ active_since, ])
+        transaction.commit_unless_managed()
+
+    def _delete_entries(self, account_id, before = None):
+        """
+        Delete the entries of the given account (older than the 'before' content id if given).
+        """
+        sql = "DELETE FROM %s WHERE account_id = %%s" % connection.ops.quote_name(TimelineEntry._meta.db_table)
+        params = [ account_id, ]
+        if before is not None:
+            sql += " AND content_id < %s"
+            params.append(before)
+        cursor = connection.cursor()
+        cursor.execute(sql, params)
+
+    def rebuild(self, account):
+        """
+        Compute the timeline of the given account from scratch (see Content.objects.get_followed_ids()).
+        """
+        from bulk import _insert_rows
+        depth = _setting("TIMELINE_DEPTH", TIMELINE_DEPTH)
+        ids = Content.objects.get_followed_ids(account, limit = depth, queryset = Content.objects.__booster__)
+        self._delete_entries(account.id)
+        if ids:
+            _insert_rows(TimelineEntry, [ TimelineEntry(account_id = account.id, content_id = id) for id in ids ], return_ids = False)
+        if not self.filter(account__id = account.id).update(last_read = datetime.datetime.now()):
+            self.create(account = account, last_read = datetime.datetime.now())
+        transaction.commit_unless_managed()
+
+    def invalidate(self, *account_ids):
+        """
+        Mark the timelines of the given accounts as stale: they'll be rebuilt when read.
+        """
+        self.filter(account__id__in = account_ids).update(last_read = datetime.datetime(1970, 1, 1))
+
+    def get_content_ids(self, account, before = None, count = None):
+        """
+        Return the ids of the content on account's timeline, newest first, up to TIMELINE_DEPTH (or count).
+        If before is given, only ids lower than it are returned (cursor pagination).
+        The timeline is rebuilt if it's missing or stale, and trimmed.
+        Return None if the page goes past the oldest entry of a trimmed timeline:
+        the caller has to use the regular query (Content.objects.get_followed_ids()) instead.
+        Ids are NOT secured. Comments are not included.
+        """
+        depth = _setting("TIMELINE_DEPTH", TIMELINE_DEPTH)
+        count = min(count or depth, depth)
+        now = datetime.datetime.now()
+        last_read = self.filter(account__id = account.id).values_list("last_read", flat = True)
+        if not last_read or last_read[0] < now - self._inactive_delay():
+            self.rebuild(account)
+        elif last_read[0] < now - self._inactive_delay() / 2:
+            # Keep it active
+            self.filter(account__id = account.id).update(last_read = now)
+            transaction.commit_unless_managed()
+
+        # Read and trim
+        entries = TimelineEntry.objects.filter(account_id = account.id)
+        if before is None:
+            ids = list(entries.order_by("-content_id").values_list("content_id", flat = True)[:depth + 1])
+            if len(ids) > depth:
+                self._delete_entries(account.id, before = ids[depth - 1])
+                ids = ids[:depth]
+                transaction.commit_unless_managed()
+            ids = ids[:count]
+        else:
+            ids = list(entries.filter(content_id__lt = before).order_by("-content_id").values_list("content_id", flat = True)[:count])
+            if len(ids) < count and entries.count() >= depth:
+                return None
+
+        # Merge content from the publishers we didn't fan out
+        celebrities = [ id for id in self.celebrity_ids() if id in account.followed_ids or id == account.id ]
+        if celebrities:
+            merged = Content.objects.__booster__.filter(publisher__id__in = celebrities).exclude(model_name = "Comment")
+            if before is not None:
+                merged = merged.filter(id__lt = before)
+            ids = set(ids)
+            ids.update(merged.order_by("-id").values_list("id", flat = True)[:count])
+            ids = sorted(ids, reverse = True)[:count]
+        return ids
+
+class Timeline(models.Model):
+    """
+    A materialized timeline. last_read tells if it's active.
+    """
+    account = models.OneToOneField(Account, primary_key = True, related_name = "+")
+    last_read = models.DateTimeField()
+
+    objects = TimelineManager()
+
+    class Meta:
+        app_label = 'twistapp'
+
+    def __unicode__(self):
+        return u"Timeline of %s" % (self.account_id, )
+
+class TimelineEntry(models.Model):
+    """
+    A content id on a timeline. Those are plain integers: deleted content is filtered out when reading.
+    """
+    account_id = models.IntegerField()
+    content_id = models.IntegerField()
+
+    class Meta:
+        app_label = 'twistapp'
+        unique_together = ("account_id", "content_id", )
+
+
+def content_post_save(sender, instance, created, **kw):
+    if created and isinstance(instance, Content) and not instance.is_comment:
+        Timeline.objects.fan_out([ instance, ])
+
+def contents_created(sender, instances, **kw):
+    if issubclass(sender, Content):
+        Timeline.objects.fan_out([ instance for instance in instances if not instance.is_comment ])
+
+def network_changed(sender, instance, **kw):
+    Timeline.objects.invalidate(instance.client_id)
+
+twistable_post_save.connect(content_post_save)
+twistables_created.connect(contents_created)
+post_save.connect(network_changed, sender = Network)
+post_delete.connect(network_changed, sender = Network)
@@ -9,30 +9,42 @@ Content, Accounts, MenuItems, ... are all Twistable objects.
 This abstract class provides a lot of little tricks to handle view/model articulation,
 such as the slug management, prepares translation management and so on.
 """
-
+from __future__ import with_statement
 import re
 import inspect
 import logging
 import traceback
-from django.db import models
+from django.db import models, transaction, IntegrityError
 from django.db.models import Q, loading
+from django.db.models.signals import post_delete
 from django.db.utils import DatabaseError
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError, PermissionDenied, ObjectDoesNotExist
 from django.utils.safestring import mark_safe
+from django.conf import settings
 
 from  twistranet.twistapp.lib.log import log
-from twistranet.twistapp.lib import roles, permissions
+from twistranet.twistapp.lib import roles, permissions, auth_context
 from twistranet.twistapp.lib.slugify import slugify
-from twistranet.twistapp.signals import twistable_post_save
+from twistranet.twistapp.signals import twistable_post_save, twistables_created
+from twistranet.core import caches
 from fields import ResourceField, PermissionField, TwistableSlugField
 
+# Alternative storage mode for permissions. This is read at startup as it changes the DB schema.
+PACKED_PERMISSIONS = getattr(settings, "TWISTRANET_PACKED_PERMISSIONS", False)
+
+# Number of times we try another slug when a concurrent creator took ours
+SLUG_ALLOCATION_RETRIES = 5
+
 class TwistableManager(models.Manager):
     """
     It's the base of the security model!!
     """
     # Disabled for performance reasons.
     # use_for_related_fields = True
+    
+    # Places where the authenticated account was found by digging the stack
+    _warned_locations = set()
 
     def get_query_set(self, __account__ = None, request = None, ):
         """
@@ -70,8 +82,17 @@ class TwistableManager(models.Manager):
             return base_query_set
 
         # Regular check. Works for anonymous as well...
-        # network_ids = __account__.network_ids
-        if not __account__.is_anonymous:
+        # With the access index, that's a single semi-join on the AccessToken table.
+        if not __account__.is_anonymous and getattr(settings, "TWISTRANET_ACCESS_INDEX", True):
+            from network import AccessToken
+            qs = base_query_set.filter(
+                _access_token__in = AccessToken.objects.filter(principal = __account__.id).values("token"),
+            )
+        elif getattr(settings, "TWISTRANET_ACCESS_INDEX", True):
+            # Anonymous query, using the precomputed flag.
+            qs = base_query_set.filter(_is_anonymous_visible = True)
+        elif not __account__.is_anonymous:
+            # network_ids = __account__.network_ids
             qs = base_query_set.filter(
                 Q(
                     owner__id = __account__.id,
@@ -89,8 +110,8 @@ class TwistableManager(models.Manager):
                 )
             )
         else:
-            # Anon query. Easy: We just return public stuff.
-            # Warning: nested query is surely inefficient...
+            # Legacy anon query. Easy: We just return public stuff.
+            # Warning: nested query is surely inefficient... That's why we use _is_anonymous_visible instead.
             free_access_network = Twistable.objects.__booster__.filter(
                 _access_network__isnull = True,
                 _p_can_list = roles.public,
@@ -107,6 +128,15 @@ class TwistableManager(models.Manager):
                     _p_can_list = roles.public,
                 )
             )
+            
+        # Fail closed: hide objects which may have a stale access network
+        from propagation import AccessPropagation
+        pending = AccessPropagation.objects.pending_source_ids()
+        if pending:
+            qs = qs.exclude(
+                (Q(_access_network__id__in = pending) | Q(publisher__id__in = pending)) & ~Q(id__in = pending),
+                _p_can_list = roles.public,
+            )
         return qs
                 
     def getCurrentAccount(self, request):
@@ -129,11 +159,15 @@ class TwistableManager(models.Manager):
                 
     def _getAuthenticatedAccount(self, __account__ = None, request = None):
         """
-        Dig the stack to find the authenticated account object.
-        Return either a (possibly generic) account object or None.
+        Return the authenticated account object, either a (possibly generic) account object or AnonymousAccount.
         
-        Views with a "request" parameter magically works with that.
-        If you want to use a system account, declare a '__account__' variable in your caller function.
+        Resolution order is:
+        - the __account__ or request parameter, if given ;
+        - the account bound with auth_context.as_account() ;
+        - the request bound by AuthContextMiddleware.
+        
+        If nothing is bound and TWISTRANET_AUTH_STACK_FALLBACK is set, we dig the stack
+        to find a 'request' or '__account__' local variable (and log a warning, as this is slow).
         """
         from account import Account, AnonymousAccount, UserAccount
 
@@ -144,43 +178,132 @@ class TwistableManager(models.Manager):
         # If we have the request object, then we just can use getCurrentAccount() instead
         if request:
             return self.getCurrentAccount(request)
+            
+        # Explicitly bound account or request
+        account = auth_context.get_account()
+        if account is not None:
+            return account
+        request = auth_context.get_request()
+        if request is not None:
+            return self.getCurrentAccount(request)
+            
+        # Opt-in legacy behaviour
+        if getattr(settings, "TWISTRANET_AUTH_STACK_FALLBACK", False):
+            account = self._digAuthenticatedAccount()
+            if account is not None:
+                return account
+
+        # Didn't find anything. We must be anonymous.
+        return AnonymousAccount()
+        
+    def _digAuthenticatedAccount(self, ):
+        """
+        Dig the stack to find the authenticated account object.
+        Return either a (possibly generic) account object or None.
+        
+        Views with a "request" parameter magically works with that.
+        If you want to use a system account, declare a '__account__' variable in your caller function.
+        This is SLOW, use auth_context.as_account() instead.
+        """
+        from account import Account
 
-        # We dig into the stack frame to find the request object.
         frame = inspect.currentframe()
         try:
             while frame:
-                frame_members = dict(inspect.getmembers(frame))
-                
                 # Inspect 'locals' variables to get the request or __account__
-                _locals = frame_members.get('f_locals', None)
-                if _locals:
-                    # Check for an __acount__ variable holding a generic Account object. It always has precedence over 'request'
-                    if _locals.has_key('__account__') and isinstance(_locals['__account__'], Account):
-                        return _locals['__account__']
+                _locals = frame.f_locals
+                account = None
+                
+                # Check for an __acount__ variable holding a generic Account object. It always has precedence over 'request'
+                if isinstance(_locals.get('__account__', None), Account):
+                    account = _locals['__account__']
                 
-                    # Check for a request.user User object
-                    if _locals.has_key('request'):
-                        u = getattr(_locals['request'], 'user', None)
-                        if isinstance(u, User):
-                            # We use this instead of the get_profile() method to avoid an infinite recursion here.
-                            # We mimic the _profile_cache behavior of django/contrib/auth/models.py to avoid doing a lot of requests on the same object
-                            if not hasattr(u, '_account_cache'):
-                                u._account_cache = UserAccount.objects.__booster__.get(user__id__exact = u.id)
-                                u._account_cache.user = u
-                            return u._account_cache
+                # Check for a request.user User object
+                elif isinstance(getattr(_locals.get('request', None), 'user', None), User):
+                    account = self.getCurrentAccount(_locals['request'])
+                    
+                if account is not None:
+                    # Warn only once per calling place to avoid flooding the logs
+                    location = (frame.f_code.co_filename, frame.f_lineno, )
+                    if location not in self._warned_locations:
+                        self._warned_locations.add(location)
+                        log.warning(
+                            "Authenticated account found by digging the stack (%s:%s). Use auth_context.as_account() instead." % location
+                        )
+                    return account
             
                 # Get back to the upper frame
-                frame = frame_members.get('f_back', None)
-                        
-            # Didn't find anything. We must be anonymous.
-            return AnonymousAccount()
+                frame = frame.f_back
+            return None
 
         finally:
             # Avoid circular refs
             frame = None
-            stack = None
-            del _locals
+            _locals = None
+
+    def annotate_permissions(self, objects, permissions, __account__ = None, request = None, ):
+        """
+        Compute the given permissions for the authenticated account on all objects at once
+        (see Account.has_permission_many) and store them on each object, keyed by account,
+        so that can_view, can_edit, etc. issue no further check for that account.
+        Use this on lists before rendering them. Return the objects as a list.
+        """
+        objects = list(objects)
+        auth = self._getAuthenticatedAccount(__account__, request)
+        for permission in permissions:
+            granted = auth.has_permission_many(permission, objects)
+            for obj in objects:
+                if obj.id in granted:
+                    if not hasattr(obj, "_c_permissions"):
+                        obj._c_permissions = {}
+                    obj._c_permissions[(auth.id, permission, )] = granted[obj.id]
+        return objects
+
+    def dereference(self, objects, chunk_size = 500):
+        """
+        Return the exact subclass instances of the given twistables, in the same order,
+        with one query per concrete model (instead of one per object with the 'object' property).
+        Results are also kept on the given instances, so that their 'object' property issues no query.
+        Objects which don't exist anymore are left out.
+        
+        Like the 'object' property, this doesn't perform any security check.
+        """
+        objects = list(objects)
+        by_model = {}
+        for obj in objects:
+            if getattr(obj, "_c_object", None) is not None:
+                continue
+            model = obj.model_class
+            if isinstance(obj, model):
+                obj._c_object = obj
+            else:
+                by_model.setdefault(model, []).append(obj)
+                
+        for model, instances in by_model.items():
+            ids = [ obj.id for obj in instances ]
+            fetched = {}
+            for i in range(0, len(ids), chunk_size):
+                fetched.update(model.objects.__booster__.in_bulk(ids[i:i + chunk_size]))
+            for obj in instances:
+                obj._c_object = fetched.get(obj.id)
+                
+        return [ obj._c_object for obj in objects if obj._c_object is not None ]
 
+    def bulk_create_secured(self, objects, as_account = None, batch_size = None):
+        """
+        Create the given (unsaved) content objects, much faster than saving them one by one:
+        checks, slugs, permissions and access networks are computed for a whole batch at once,
+        rows are inserted with multi-row statements, and one twistables_created signal is sent per batch.
+        Publishing rights are checked once per distinct publisher.
+        
+        Objects are created on behalf of as_account, or of the authenticated account.
+        Per-object signals (twistable_post_save, content_created) are NOT sent. See models/bulk.py.
+        """
+        import bulk
+        if as_account is None:
+            return bulk.bulk_create(objects, batch_size)
+        with auth_context.as_account(as_account):
+            return bulk.bulk_create(objects, batch_size)
 
     # Backdoor for performance purposes. Use it at your own risk as it breaks security.
     @property
@@ -249,19 +372,24 @@ class Twistable(_AbstractTwistable):
     owner = models.ForeignKey("Account", related_name = "by", db_index = True, )                               
     
     # Our security model.
+    # With TWISTRANET_PACKED_PERMISSIONS, only _p_can_list (used by listings) is indexed,
+    # and permission checks read roles from _p_packed. See models/indexes.py for composite indexes.
     permission_templates = ()       # Define this in your subclasses
-    permissions = PermissionField(db_index = True)
+    permissions = PermissionField(db_index = not PACKED_PERMISSIONS)
     _access_network = models.ForeignKey("Account", null = True, blank = True, related_name = "+", db_index = True, )
+    _access_token = models.IntegerField(null = True, blank = True, db_index = True)     # See network.AccessToken
+    _is_anonymous_visible = models.BooleanField(default = False)        # Listable by AnonymousAccount. Indexed with id, see models/indexes.py
         
     # The permissions. It's strongly forbidden to edit those roles by hand, use the 'permissions' property instead.
-    _p_can_view = models.IntegerField(default = 16, db_index = True)
-    _p_can_edit = models.IntegerField(default = 16, db_index = True)
+    _p_can_view = models.IntegerField(default = 16, db_index = not PACKED_PERMISSIONS)
+    _p_can_edit = models.IntegerField(default = 16, db_index = not PACKED_PERMISSIONS)
     _p_can_list = models.IntegerField(default = 16, db_index = True)
-    _p_can_list_members = models.IntegerField(default = 16, db_index = True)
-    _p_can_publish = models.IntegerField(default = 16, db_index = True)
-    _p_can_join = models.IntegerField(default = 16, db_index = True)
-    _p_can_leave = models.IntegerField(default = 16, db_index = True)
-    _p_can_create = models.IntegerField(default = 16, db_index = True)
+    _p_can_list_members = models.IntegerField(default = 16, db_index = not PACKED_PERMISSIONS)
+    _p_can_publish = models.IntegerField(default = 16, db_index = not PACKED_PERMISSIONS)
+    _p_can_join = models.IntegerField(default = 16, db_index = not PACKED_PERMISSIONS)
+    _p_can_leave = models.IntegerField(default = 16, db_index = not PACKED_PERMISSIONS)
+    _p_can_create = models.IntegerField(default = 16, db_index = not PACKED_PERMISSIONS)
+    _p_packed = models.IntegerField(default = 0)       # All the above roles, see permissions.pack_roles()
     
     # Other configuration stuff (class-wise)
     _ALLOW_NO_PUBLISHER = False         # Prohibit creation of an object of this class with publisher = None.
@@ -372,6 +500,7 @@ class Twistable(_AbstractTwistable):
         """
         import account
         import community
+        import slug
         
         auth = Twistable.objects._getAuthenticatedAccount()
 
@@ -380,6 +509,11 @@ class Twistable(_AbstractTwistable):
         if self.__class__.__name__ == Twistable.__name__:
             raise ValidationError("You cannot save a raw content object. Use a derived class instead.")
             
+        # Permissions may change: forget the ones precomputed by annotate_permissions()
+        # and the subclass instance found by dereference().
+        self.__dict__.pop("_c_permissions", None)
+        self.__dict__.pop("_c_object", None)
+            
         # Set information used to retreive the actual subobject
         self.model_name = self._meta.object_name
         self.app_label = self._meta.app_label
@@ -414,27 +548,9 @@ class Twistable(_AbstractTwistable):
                 raise ValueError("Only the Global Community can have no publisher, not %s" % self)
     
         # Set permissions; we will apply them last to ensure we have an id.
-        # We also ensure that the right permissions are set on the right object
-        if not self.permissions:
-            perm_template = self.model_class.permission_templates
-            if not perm_template:
-                raise ValueError("permission_templates not defined on class %s" % self.__class__.__name__)
-            self.permissions = perm_template.get_default()
-        tpl = [ t for t in self.permission_templates.permissions() if t["id"] == self.permissions ]
-        if not tpl:
-            # Didn't find? We restore default setting. XXX Should log/alert something here!
-            tpl = [ t for t in self.permission_templates.permissions() if t["id"] == self.model_class.permission_templates.get_default() ]
-            log.warning("Restoring default permissions. Problem here.")
-            log.warning("Unable to find %s permission template %s in %s" % (self, self.permissions, self.permission_templates.perm_dict))
-        if tpl[0].get("disabled_for_community") and issubclass(self.publisher.model_class, community.Community):
-            raise ValueError("Invalid permission setting %s for this object (%s/%s)" % (tpl, self, self.title_or_description))
-        elif tpl[0].get("disabled_for_useraccount") and issubclass(self.publisher.model_class, account.UserAccount):
-            raise ValueError("Invalid permission setting %s for this object (%s/%s)" % (tpl, self, self.title_or_description))
-        for perm, role in tpl[0].items():
-            if perm.startswith("can_"):
-                if callable(role):
-                    role = role(self)
-                setattr(self, "_p_%s" % perm, role)
+        # Remember if the object was public before, for caches of public pages.
+        self._c_was_public = self.id is not None and self._p_can_list == roles.public
+        self._set_permissions()
 
         # Check if we're creating or not
         created = not self.id
@@ -448,28 +564,66 @@ class Twistable(_AbstractTwistable):
             else:
                 self.slug = slugify(self.model_name)
             self.slug = self.slug[:40]
-        if created and self.__class__._FORCE_SLUG_CREATION:
-            while Twistable.objects.__booster__.filter(slug = self.slug).exists():
-                match = re.search("_(?P<num>[0-9]+)$", self.slug)
-                if match:
-                    root = self.slug[:match.start()]
-                    num = int(match.groupdict()['num']) + 1
-                else:
-                    root = self.slug
-                    num = 1
-                self.slug = "%s_%i" % (root, num, )
+        allocate_slug = created and self.__class__._FORCE_SLUG_CREATION
+        if allocate_slug:
+            self.slug = slug.SlugCounter.objects.allocate(self.slug)
         
         # Perform a full_clean on the model just to be sure it validates correctly
         self.full_clean()
             
-        # Save and update access network information
-        ret = super(Twistable, self).save(*args, **kw)
+        # Save and update access network information.
+        # A concurrent creator may have taken our slug in the meantime: in that case, we just take the next one.
+        attempt = 0
+        while True:
+            sid = transaction.savepoint()
+            try:
+                ret = super(Twistable, self).save(*args, **kw)
+            except IntegrityError:
+                transaction.savepoint_rollback(sid)
+                attempt += 1
+                if not allocate_slug or attempt >= SLUG_ALLOCATION_RETRIES or \
+                    not Twistable.objects.__booster__.filter(slug = self.slug).exists():
+                    raise
+                self.slug = slug.SlugCounter.objects.reserve(self.slug)[0]
+                continue
+            transaction.savepoint_commit(sid)
+            break
         self._update_access_network()
 
         # Send TN's post-save signal
         twistable_post_save.send(sender = self.__class__, instance = self, created = created)
         return ret
 
+    def _set_permissions(self,):
+        """
+        Set the _p_* role attributes from the permissions template (or the default one).
+        We also ensure that the right permissions are set on the right object.
+        """
+        import account, community
+        if not self.permissions:
+            perm_template = self.model_class.permission_templates
+            if not perm_template:
+                raise ValueError("permission_templates not defined on class %s" % self.__class__.__name__)
+            self.permissions = perm_template.get_default()
+        tpl = [ t for t in self.permission_templates.permissions() if t["id"] == self.permissions ]
+        if not tpl:
+            # Didn't find? We restore default setting. XXX Should log/alert something here!
+            tpl = [ t for t in self.permission_templates.permissions() if t["id"] == self.model_class.permission_templates.get_default() ]
+            log.warning("Restoring default permissions. Problem here.")
+            log.warning("Unable to find %s permission template %s in %s" % (self, self.permissions, self.permission_templates.perm_dict))
+        if tpl[0].get("disabled_for_community") and issubclass(self.publisher.model_class, community.Community):
+            raise ValueError("Invalid permission setting %s for this object (%s/%s)" % (tpl, self, self.title_or_description))
+        elif tpl[0].get("disabled_for_useraccount") and issubclass(self.publisher.model_class, account.UserAccount):
+            raise ValueError("Invalid permission setting %s for this object (%s/%s)" % (tpl, self, self.title_or_description))
+        for perm, role in tpl[0].items():
+            if perm.startswith("can_"):
+                if callable(role):
+                    role = role(self)
+                setattr(self, "_p_%s" % perm, role)
+        self._p_packed = permissions.pack_roles(dict([
+            (perm, getattr(self, "_p_%s" % perm), ) for perm in permissions.packed_permissions
+        ]))
+
     def _update_access_network(self, ):
         """
         Update hierarchy of driven objects.
@@ -525,13 +679,21 @@ class Twistable(_AbstractTwistable):
             raise ValueError("Unexpected can_list role found: %d on object %s" % (obj._p_can_list, obj))
 
         # Update this object itself without calling the save() method again
-        Twistable.objects.__booster__.filter(id = self.id).update(_access_network = self._access_network)
+        self._access_token = self.get_access_token(self._p_can_list, self._access_network_id, self.owner_id)
+        self._is_anonymous_visible = self.get_anonymous_visible(self._p_can_list, self._access_network)
+        Twistable.objects.__booster__.filter(id = self.id).update(
+            _access_network = self._access_network,
+            _access_token = self._access_token,
+            _is_anonymous_visible = self._is_anonymous_visible,
+        )
+        
+        # Permissions, owner or publisher may have changed: forget cached roles on this object.
+        caches.bump_versions(self.id)
 
-        # Update dependant objects if current object's network changed for public role
-        Twistable.objects.__booster__.filter(
-            Q(_access_network__id = self.id) | Q(publisher = self.id),
-            _p_can_list = roles.public,
-        ).exclude(id = self.id).update(_access_network = obj)
+        # Update dependant objects if current object's network changed for public role.
+        # If there are many of them, this is deferred to a background job.
+        from propagation import AccessPropagation
+        AccessPropagation.objects.propagate(self, obj)
         
         # This is an additional check to ensure that no _access_network = None object with _p_can_list|_p_can_view = public still remains
         # glob = community.GlobalCommunity.get()
@@ -540,6 +702,34 @@ class Twistable(_AbstractTwistable):
         #     _p_can_list = roles.public
         # ).update(_access_network = glob)
             
+    @staticmethod
+    def get_access_token(p_can_list, access_network_id, owner_id):
+        """
+        Return the access token a principal must hold to list an object.
+        See network.AccessToken for an explanation. This must match AccessTokenManager.rebuild().
+        """
+        from network import AccessToken
+        if p_can_list == roles.owner:
+            return -owner_id
+        if p_can_list in (roles.network, roles.public, ) and access_network_id:
+            return access_network_id
+        if p_can_list == roles.public:
+            return AccessToken.PUBLIC_TOKEN
+        return None         # Only listable by admins
+        
+    @staticmethod
+    def get_anonymous_visible(p_can_list, access_network):
+        """
+        Return True if an object with the given _p_can_list and _access_network objects can be listed by anonymous users,
+        that is if it's public and its access network (if any) is public without an access network itself.
+        This must match AccessTokenManager.rebuild_anonymous_flags().
+        """
+        if p_can_list != roles.public:
+            return False
+        if access_network is None:
+            return True
+        return access_network._p_can_list == roles.public and access_network._access_network_id is None
+            
     def delete(self,):
         """
         Here we avoid deleting related object for nullabled ForeignKeys.
@@ -576,14 +766,16 @@ class Twistable(_AbstractTwistable):
         Return the exact subclass this object belongs to.
         
         IT MAY ISSUE DB QUERY, so you should always consider using model_class instead if you can.
-        This is quite complex actually: since we want like to minimize database overhead,
-        we can't allow a "Model.objects.get(id = x)" call.
-        So, instead, we walk through object inheritance to fetch the right attributes.
+        If you have to dereference several objects, use Twistable.objects.dereference() instead:
+        it issues one query per model and remembers the result on each object.
         
         XXX TODO: This is where I can implement the can_view or can_list filter. See search results to understand why.
         """
         if self.id is None:
             raise RuntimeError("You can't get subclass until your object is saved in database.")
+        cached = getattr(self, "_c_object", None)
+        if cached is not None:
+            return cached
 
         # Get model class directly
         model = loading.get_model(self.app_label, self.model_name)
@@ -641,23 +833,31 @@ class Twistable(_AbstractTwistable):
         """
         return Twistable.objects._getAuthenticatedAccount()
 
+    def _has_permission(self, permission):
+        """
+        Return True if the authenticated account has the given permission on self.
+        Use the value precomputed for this account by Twistable.objects.annotate_permissions() if any.
+        """
+        auth = Twistable.objects._getAuthenticatedAccount()
+        precomputed = getattr(self, "_c_permissions", None)
+        if precomputed and (auth.id, permission, ) in precomputed:
+            return precomputed[(auth.id, permission, )]
+        return auth.has_permission(permission, self)
+
     @property
     def can_view(self):
         if not self.id: return  True        # Can always view an unsaved object
-        auth = Twistable.objects._getAuthenticatedAccount()
-        return auth.has_permission(permissions.can_view, self)
+        return self._has_permission(permissions.can_view)
 
     @property
     def can_delete(self):
         if not self.id: return  True        # Can always delete an unsaved object
-        auth = Twistable.objects._getAuthenticatedAccount()
-        return auth.has_permission(permissions.can_delete, self)
+        return self._has_permission(permissions.can_delete)
 
     @property
     def can_edit(self):
         if not self.id: return  True        # Can always edit an unsaved object
-        auth = Twistable.objects._getAuthenticatedAccount()
-        return auth.has_permission(permissions.can_edit, self)
+        return self._has_permission(permissions.can_edit)
 
     @property
     def can_publish(self):
@@ -665,8 +865,7 @@ class Twistable(_AbstractTwistable):
         True if authenticated account can publish on the current account object
         """
         if not self.id: return  False        # Can NEVER publish an unsaved object
-        auth = Twistable.objects._getAuthenticatedAccount()
-        return auth.has_permission(permissions.can_publish, self)
+        return self._has_permission(permissions.can_publish)
 
     @property
     def can_list(self):
@@ -674,8 +873,7 @@ class Twistable(_AbstractTwistable):
         Return true if the current account can list the current object.
         """
         if not self.id: return  True        # Can always list an unsaved object
-        auth = Twistable.objects._getAuthenticatedAccount()
-        return auth.has_permission(permissions.can_list, self)
+        return self._has_permission(permissions.can_list)
 
     #                                                                   #
     #                           Views relations                         #
@@ -690,3 +888,24 @@ class Twistable(_AbstractTwistable):
         return self.model_class.type_detail_view
 
 
+def twistable_saved(sender, instance, **kw):
+    """
+    Anonymous visitors may see a public object: cached anonymous pages are outdated
+    (also when it stops being public).
+    """
+    if instance._p_can_list == roles.public or getattr(instance, "_c_was_public", False):
+        caches.anonymous_page_cache.invalidate()
+
+def twistables_bulk_created(sender, instances, **kw):
+    for instance in instances:
+        if instance._p_can_list == roles.public:
+            caches.anonymous_page_cache.invalidate()
+            return
+
+def twistable_deleted(sender, instance, **kw):
+    if isinstance(instance, Twistable) and instance._p_can_list == roles.public:
+        caches.anonymous_page_cache.invalidate()
+
+twistable_post_save.connect(twistable_saved)
+twistables_created.connect(twistables_bulk_created)
+post_delete.connect(twistable_deleted)
@@ -10,6 +10,12 @@ twistable_post_save = django.dispatch.Signal(
     providing_args = ["instance", "created", ],
 )
 
+# This signal is sent once per batch by Twistable.objects.bulk_create_secured(),
+# instead of twistable_post_save and content_created. Sender is the model class.
+twistables_created = django.dispatch.Signal(
+    providing_args = ["instances", ],
+)
+
 # This one is sent when a content (whichever it is) is created.
 # It's many used to send notification emails on new content.
 content_created = django.dispatch.Signal(
@@ -53,6 +59,15 @@ join_community = django.dispatch.Signal(
     providing_args = ["client", "community", ]
 )
 
+# Batch versions of invite_community and join_community, sent once per batch
+# by Community.invite_many() and join_many(). targets / clients are lists of accounts.
+invite_community_many = django.dispatch.Signal(
+    providing_args = ["targets", "community", ]
+)
+join_community_many = django.dispatch.Signal(
+    providing_args = ["clients", "community", ]
+)
+
 # This is when a user ASKS to join a community but is not immediately accepted.
 request_join_community = django.dispatch.Signal(
     providing_args = ["client", "community", ]
@@ -0,0 +1,54 @@
+"""
+Cached content summaries.
+
+    {% load summaries %}
+    {% summary_fragment content %}
+        ... expensive, viewer-independent part of the summary ...
+    {% endsummary_fragment %}
+
+The enclosed output is stored in the shared cache (see twistranet.core.caches.summary_cache),
+keyed by ContentManager.summary_keys(). Use ContentManager.prefetch_summaries() on lists
+to fetch all fragments of a page at once.
+Only put there what depends on the content, its accounts, the language and the viewer's can_edit / can_delete.
+Not what depends on what else the viewer can see, like wiki-rendered text (links are resolved with the secured
+managers) or the community manager badge (account/manager.badge.html): render those outside of the fragment.
+"""
+from django import template
+from django.conf import settings
+from twistranet.twistapp.models import Content
+from twistranet.core import caches
+
+register = template.Library()
+
+class SummaryFragmentNode(template.Node):
+    def __init__(self, nodelist, content):
+        self.nodelist = nodelist
+        self.content = content
+
+    def render(self, context):
+        content = self.content.resolve(context)
+        if not isinstance(content, Content) or not getattr(settings, "TWISTRANET_SUMMARY_CACHE", True):
+            return self.nodelist.render(context)
+        if hasattr(content, "_c_summary_key"):
+            key, html = content._c_summary_key, content._c_summary_html
+        else:
+            key = Content.objects.summary_keys([ content, ])[0]
+            html = caches.summary_cache.get(key)
+        if html is None:
+            html = self.nodelist.render(context)
+            caches.summary_cache.set(key, html)
+            content._c_summary_key, content._c_summary_html = key, html
+        return html
+
+def summary_fragment(parser, token):
+    """
+    {% summary_fragment content %} ... {% endsummary_fragment %}
+    """
+    bits = token.split_contents()
+    if len(bits) != 2:
+        raise template.TemplateSyntaxError, "%r tag requires exactly one argument" % bits[0]
+    nodelist = parser.parse(("endsummary_fragment", ))
+    parser.delete_first_token()
+    return SummaryFragmentNode(nodelist, parser.compile_filter(bits[1]))
+
+register.tag("summary_fragment", summary_fragment)
@@ -5,6 +5,12 @@ from wall import WallTest
 from resources import ResourcesTest
 from account_security import AccountSecurityTest
 from menu import MenuTest
+from authentication import AuthContextTest
+from access_index import AccessIndexTest
+from suggestions import SuggestionsTest
+from relation_import import RelationImportTest
+from membership import MembershipTest
+from network_graph import NetworkGraphTest
 # all brokens i think we can remove it
 # from views_test import ViewsTest
 
@@ -0,0 +1,113 @@
+"""
+Access index tests.
+"""
+from django.conf import settings
+from twistranet.twistapp.tests.base import TNBaseTest
+from twistranet.twistapp.models import *
+from twistranet.content_types import *
+
+class AccessIndexTest(TNBaseTest):
+    """
+    Check that the access index gives the same results as the legacy query.
+    """
+    def tearDown(self):
+        settings.TWISTRANET_ACCESS_INDEX = True
+        settings.TWISTRANET_ACCESS_PROPAGATION_SYNC_LIMIT = 1000
+        super(AccessIndexTest, self).tearDown()
+        
+    def _listed_ids(self, account, use_index):
+        settings.TWISTRANET_ACCESS_INDEX = use_index
+        return set(Twistable.objects.get_query_set(__account__ = account).values_list("id", flat = True))
+        
+    def _check_same_as_legacy(self):
+        for account in (self.A, self.B, self.C, ):
+            indexed = self._listed_ids(account, True)
+            legacy = self._listed_ids(account, False)
+            self.failUnless(indexed, "%s should list something" % account)
+            self.failUnlessEqual(indexed, legacy, "Access index differs for %s: %s" % (account, indexed ^ legacy, ))
+            
+    def test_index_is_consistent(self):
+        self.failIf(sum(AccessToken.objects.check().values()), AccessToken.objects.check())
+        
+    def test_same_as_legacy(self):
+        self.login(self.A)
+        StatusUpdate(description = "Hello", permissions = "public").save()
+        StatusUpdate(description = "Hello", permissions = "network").save()
+        Document(text = "Hello", permissions = "private").save()
+        self._check_same_as_legacy()
+        
+    def test_network_changes(self):
+        self.login(self.C)
+        private = StatusUpdate(description = "For my network", permissions = "network")
+        private.save()
+        self.failIf(private.id in self._listed_ids(self.B, True))
+        self.C.object.follow(self.B)
+        self.failUnless(private.id in self._listed_ids(self.B, True))
+        self.C.object.unfollow(self.B)
+        self.failIf(private.id in self._listed_ids(self.B, True))
+        self._check_same_as_legacy()
+        
+    def test_rebuild(self):
+        before = self._listed_ids(self.B, True)
+        AccessToken.objects.rebuild()
+        self.failUnlessEqual(before, self._listed_ids(self.B, True))
+        self.failIf(sum(AccessToken.objects.check().values()))
+        
+    def test_deferred_propagation(self):
+        self.login(self.A)
+        c = Community.objects.create(title = "Propagation", permissions = "workgroup")
+        c.save()
+        status = StatusUpdate(description = "On the community", permissions = "public", publisher = c)
+        status.save()
+        self.failUnless(status.id in self._listed_ids(self.A, True))
+        
+        # Make the community private. Dependants are updated by a background job.
+        settings.TWISTRANET_ACCESS_PROPAGATION_SYNC_LIMIT = 0
+        c.permissions = "private"
+        c.save()
+        self.failUnlessEqual(AccessPropagation.objects.count(), 1)
+        self.failIf(status.id in self._listed_ids(self.C, True), "Pending propagation must fail closed")
+        self.failIf(status.id in self._listed_ids(self.A, True), "Pending propagation must fail closed")
+        
+        # Process it one object at a time
+        self.failUnless(AccessPropagation.objects.process(chunk_size = 1))
+        self.failIf(AccessPropagation.objects.count())
+        self.failUnlessEqual(Twistable.objects.__booster__.get(id = status.id)._access_network_id, c.id)
+        self.failIf(status.id in self._listed_ids(self.C, True))
+        self.failUnless(status.id in self._listed_ids(self.A, True))
+        self.failIf(sum(AccessToken.objects.check().values()), AccessToken.objects.check())
+        self._check_same_as_legacy()
+        
+    def _anonymous_ids(self, use_index):
+        settings.TWISTRANET_ACCESS_INDEX = use_index
+        return set(Twistable.objects.get_query_set(__account__ = AnonymousAccount()).values_list("id", flat = True))
+        
+    def test_anonymous_visible(self):
+        self.login(self.system)
+        glob = GlobalCommunity.objects.get()
+        glob.permissions = "internet"
+        glob.save()
+        
+        self.login(self.A)
+        StatusUpdate(description = "Hello", permissions = "public").save()
+        Document(text = "Hello", permissions = "private").save()
+        c = Community.objects.create(title = "Open", permissions = "workgroup")
+        c.save()
+        status = StatusUpdate(description = "On the community", permissions = "public", publisher = c)
+        status.save()
+        indexed = self._anonymous_ids(True)
+        self.failUnless(glob.id in indexed)
+        self.failUnlessEqual(indexed, self._anonymous_ids(False))
+        
+        # Going private hides the community content as well
+        c.permissions = "private"
+        c.save()
+        self.failIf(status.id in self._anonymous_ids(True))
+        self.failUnlessEqual(self._anonymous_ids(True), self._anonymous_ids(False))
+        
+        # Backfill
+        Twistable.objects.__booster__.update(_is_anonymous_visible = False)
+        self.failUnless(AccessToken.objects.check()["stale_anonymous_flags"])
+        AccessToken.objects.rebuild_anonymous_flags()
+        self.failIf(AccessToken.objects.check()["stale_anonymous_flags"])
+        self.failUnlessEqual(self._anonymous_ids(True), self._anonymous_ids(False))
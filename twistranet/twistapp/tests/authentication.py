@@ -0,0 +1,96 @@
+"""
+Authentication context tests.
+"""
+from __future__ import with_statement
+from django.conf import settings
+from twistranet.twistapp.tests.base import TNBaseTest
+from twistranet.twistapp.models import *
+from twistranet.twistapp.lib import auth_context
+from twistranet.twistapp.lib.auth_context import as_account
+
+class AuthContextTest(TNBaseTest):
+    """
+    Check how the authenticated account is resolved.
+    """
+    def tearDown(self):
+        settings.TWISTRANET_AUTH_STACK_FALLBACK = False
+        super(AuthContextTest, self).tearDown()
+        
+    def test_as_account(self):
+        """
+        as_account() binds the account, innermost one wins.
+        """
+        mgr = Twistable.objects
+        self.failUnless(mgr._getAuthenticatedAccount().is_anonymous)
+        with as_account(self.A):
+            self.failUnlessEqual(mgr._getAuthenticatedAccount().id, self.A.id)
+            with as_account(self.system):
+                self.failUnlessEqual(mgr._getAuthenticatedAccount().id, self.system.id)
+            self.failUnlessEqual(mgr._getAuthenticatedAccount().id, self.A.id)
+        self.failUnless(mgr._getAuthenticatedAccount().is_anonymous)
+        
+    def test_as_account_with_exception(self):
+        """
+        The account must be unbound even if an exception is raised.
+        """
+        try:
+            with as_account(self.A):
+                raise ValueError()
+        except ValueError:
+            pass
+        self.failUnless(auth_context.get_account() is None)
+        
+    def test_bound_account_has_precedence(self):
+        """
+        as_account() has precedence over explicitly passed __account__ variables (as they're only used as a fallback).
+        """
+        settings.TWISTRANET_AUTH_STACK_FALLBACK = True
+        __account__ = self.B
+        with as_account(self.A):
+            self.failUnlessEqual(Twistable.objects._getAuthenticatedAccount().id, self.A.id)
+        self.failUnlessEqual(Twistable.objects._getAuthenticatedAccount().id, self.B.id)
+        settings.TWISTRANET_AUTH_STACK_FALLBACK = False
+        self.failUnless(Twistable.objects._getAuthenticatedAccount().is_anonymous)
+        
+    def test_secured_queryset(self):
+        """
+        Secured querysets honor the bound account.
+        """
+        with as_account(self.A):
+            a_content = Content.objects.count()
+        anon_content = Content.objects.count()
+        self.failUnless(a_content > anon_content)
+        
+    def test_request_without_middleware(self):
+        """
+        Views bind their request even if AuthContextMiddleware is missing (eg. in older projects), and it's logged.
+        """
+        import logging
+        from django.test.client import Client
+        from twistranet.core import middleware
+        from twistranet.twistapp.lib.log import log
+        classes = settings.MIDDLEWARE_CLASSES
+        settings.MIDDLEWARE_CLASSES = [ c for c in classes if c != middleware.AUTH_CONTEXT_MIDDLEWARE ]
+        errors = []
+        class Handler(logging.Handler):
+            def emit(self, record):
+                errors.append(record.getMessage())
+        handler = Handler(logging.ERROR)
+        log.addHandler(handler)
+        try:
+            middleware._auth_context_checked = False
+            middleware.check_auth_context_middleware()
+            middleware.check_auth_context_middleware()
+            self.failUnlessEqual(len(errors), 1)
+            self.failUnless(middleware.AUTH_CONTEXT_MIDDLEWARE in errors[0])
+            
+            client = Client()
+            self.failUnlessEqual(client.get("/").status_code, 302)
+            client.post("/login/", {'username': 'A', 'password': 'dummy'})
+            response = client.get("/")
+            self.failUnlessEqual(response.status_code, 200)
+            self.failUnlessEqual(response.context["account"].id, self.A.id)
+            self.failUnless(auth_context.get_request() is None)
+        finally:
+            log.removeHandler(handler)
+            settings.MIDDLEWARE_CLASSES = classes
@@ -1,7 +1,10 @@
+from __future__ import with_statement
 from django.test import TestCase
 from django.conf import settings
+from django.core.cache import cache
 from twistranet.twistapp.models import *
 from twistranet.core import bootstrap
+from twistranet.twistapp.lib.auth_context import as_account
 
 class TNBaseTest(TestCase):
     def setUp(self):
@@ -11,12 +14,38 @@ class TNBaseTest(TestCase):
         settings.TWISTRANET_IMPORT_SAMPLE_DATA = True
         # do not import cogip samples
         settings.TWISTRANET_IMPORT_COGIP = False
+        # Tests run in a single process: in-process caches are safe with the locmem backend
+        settings.TWISTRANET_PROCESS_CACHE = True
+        # Shared caches outlive the rolled-back test transactions
+        cache.clear()
+        Account._role_cache.clear()
+        Network.graph.clear()
         bootstrap.bootstrap()
         bootstrap.repair()
         
-        __account__ = SystemAccount.get()
-        self.system = __account__
-        self.A = UserAccount.objects.get(user__username = "A").account_ptr
-        self.B = UserAccount.objects.get(user__username = "B").account_ptr
-        self.C = UserAccount.objects.get(user__username = "C").account_ptr
-        self.admin = UserAccount.objects.get(user__username = "admin").account_ptr
\ No newline at end of file
+        self._logged_in = None
+        self.system = SystemAccount.get()
+        with as_account(self.system):
+            self.A = UserAccount.objects.get(user__username = "A").account_ptr
+            self.B = UserAccount.objects.get(user__username = "B").account_ptr
+            self.C = UserAccount.objects.get(user__username = "C").account_ptr
+            self.admin = UserAccount.objects.get(user__username = "admin").account_ptr
+        
+    def tearDown(self):
+        self.logout()
+        
+    def login(self, account):
+        """
+        Act as the given account (see as_account()) until logout() or the end of the test.
+        """
+        self.logout()
+        self._logged_in = as_account(account)
+        self._logged_in.__enter__()
+        
+    def logout(self):
+        """
+        Get back to anonymous.
+        """
+        logged_in, self._logged_in = self._logged_in, None
+        if logged_in is not None:
+            logged_in.__exit__(None, None, None)
@@ -17,4 +17,317 @@ class ContentTest(TNBaseTest):
     B  => admin
     """
 
+    def test_dereference(self):
+        """
+        Bulk fetch actual objects, with one query per model
+        """
+        from django.conf import settings
+        from django.db import connection
+        self.login(self.A)
+        objects = [
+            StatusUpdate.objects.create(description = "Hello"),
+            Document.objects.create(text = "Hello"),
+            StatusUpdate.objects.create(description = "World"),
+        ]
+        ids = [ obj.id for obj in objects ] + [ self.B.id, ]
+        bases = dict([ (obj.id, obj) for obj in Twistable.objects.__booster__.filter(id__in = ids) ])
+        bases = [ bases[id] for id in ids ]
+        debug = settings.DEBUG
+        settings.DEBUG = True
+        try:
+            n_queries = len(connection.queries)
+            concrete = Twistable.objects.dereference(bases)
+            self.failUnlessEqual(len(connection.queries) - n_queries, 3)
+            n_queries = len(connection.queries)
+            self.failUnless(bases[1].object is concrete[1])
+            self.failUnlessEqual(len(connection.queries), n_queries)
+        finally:
+            settings.DEBUG = debug
+        self.failUnlessEqual([ obj.id for obj in concrete ], ids)
+        self.failUnlessEqual(
+            [ obj.__class__ for obj in concrete ],
+            [ StatusUpdate, Document, StatusUpdate, UserAccount, ],
+        )
 
+    def test_slug_allocation(self):
+        """
+        Duplicate titles get numbered slugs without probing each suffix
+        """
+        self.login(self.A)
+        slugs = [ Document.objects.create(title = "Meeting notes", text = "Hello").slug for i in range(4) ]
+        self.failUnlessEqual(slugs, ["meeting_notes", "meeting_notes_1", "meeting_notes_2", "meeting_notes_3", ])
+        
+        # Explicit slugs ahead of the counter
+        Document.objects.create(text = "Hello", slug = "meeting_notes_5")
+        self.failUnlessEqual(Document.objects.create(title = "Meeting notes", text = "Hello").slug, "meeting_notes_4")
+        self.failUnlessEqual(Document.objects.create(title = "Meeting notes", text = "Hello").slug, "meeting_notes_6")
+        
+        # Block reservation
+        self.failUnlessEqual(
+            SlugCounter.objects.reserve("meeting_notes", 3),
+            ["meeting_notes_7", "meeting_notes_8", "meeting_notes_9", ],
+        )
+        self.failUnlessEqual(Document.objects.create(title = "Meeting notes", text = "Hello").slug, "meeting_notes_10")
+        
+        # A concurrent creator took our slug after it's been checked: we retry with the next one
+        doc = Document(title = "Meeting notes", text = "Hello")
+        full_clean = doc.full_clean
+        def racy_full_clean(*args, **kw):
+            full_clean(*args, **kw)
+            Document.objects.create(text = "Concurrent", slug = doc.slug)
+        doc.full_clean = racy_full_clean
+        doc.save()
+        self.failUnlessEqual(doc.slug, "meeting_notes_12")
+        self.failUnless(Document.objects.filter(slug = "meeting_notes_11").exists())
+
+    def test_bulk_create(self):
+        """
+        Bulk-created content must look exactly like saved content
+        """
+        from twistranet.twistapp.signals import twistables_created
+        self.login(self.A)
+        c = Community(slug = "wkg", permissions = "workgroup")
+        c.save()
+        reference = Document(title = "Imported", text = "Saved", permissions = "public", publisher = c)
+        reference.save()
+        
+        received = []
+        def listener(sender, instances, **kw):
+            received.append((sender, len(instances), ))
+        twistables_created.connect(listener)
+        try:
+            objects = Twistable.objects.bulk_create_secured([
+                Document(title = "Imported", text = "Hello #%d" % i, permissions = "public", publisher = c)
+                for i in range(3)
+            ] + [ StatusUpdate(description = "Imported"), ], as_account = self.A)
+        finally:
+            twistables_created.disconnect(listener)
+        self.failUnlessEqual(dict(received), {Document: 3, StatusUpdate: 1, })
+        self.failUnlessEqual([ obj.slug for obj in objects ], ["imported_1", "imported_2", "imported_3", None, ])
+        
+        for obj in objects[:3]:
+            doc = Document.objects.get(id = obj.id)
+            self.failUnlessEqual(doc.text, obj.text)
+            self.failUnlessEqual(doc.owner_id, self.A.id)
+            for attr in ("_access_network_id", "_access_token", "_is_anonymous_visible", "_p_can_list", "_p_can_view", "_p_packed", ):
+                self.failUnlessEqual(getattr(doc, attr), getattr(reference, attr))
+        status = StatusUpdate.objects.get(id = objects[3].id)
+        reference = StatusUpdate.objects.create(description = "Saved")
+        for attr in ("publisher_id", "_access_network_id", "_access_token", "_is_anonymous_visible", "_p_packed", ):
+            self.failUnlessEqual(getattr(status, attr), getattr(reference, attr))
+        
+        # Publishing rights are still enforced
+        self.failUnlessRaises(
+            PermissionDenied,
+            Twistable.objects.bulk_create_secured,
+            [ StatusUpdate(description = "On B's wall", publisher = self.B), ],
+        )
+        self.failIf(StatusUpdate.objects.filter(description = "On B's wall").exists())
+
+    def test_fixture_loader(self):
+        """
+        Apply fixtures in a batch
+        """
+        from twistranet.twistapp.lib.python_fixture import Fixture, FixtureLoader
+        self.login(self.system)
+        existing = Document.objects.create(slug = "existing_doc", title = "Existing", text = "Hello", publisher = self.A)
+        fixtures = [
+            Fixture(Document, slug = "fixture_doc_%d" % i, logged_account = "a", text = "Fixture %d" % i)
+            for i in range(3)
+        ] + [
+            Fixture(Document, slug = "existing_doc", text = "Not updated"),
+            Fixture(Menu, slug = "menu_main", title = "Main Menu", publisher = GlobalCommunity.objects.filter(), force_update = True),
+            Fixture(Document, slug = "fixture_doc_0", text = "Applied twice"),
+        ]
+        loader = FixtureLoader(chunk_size = 2)
+        objects = loader.load(fixtures)
+        
+        self.failUnlessEqual(
+            [ obj.slug for obj in objects ],
+            ["fixture_doc_0", "fixture_doc_1", "fixture_doc_2", "existing_doc", "menu_main", "fixture_doc_0", ],
+        )
+        self.failUnlessEqual(objects[0].owner_id, self.A.id)
+        self.failUnless(objects[0] is objects[5])
+        self.failUnlessEqual(objects[3].id, existing.id)
+        self.failUnlessEqual(Document.objects.get(id = existing.id).text, "Hello")
+        self.failUnless(isinstance(objects[4], Menu))
+        self.failUnlessEqual(loader.timings["Document"][0], 5)
+        self.failUnlessEqual(loader.timings["Menu"][0], 1)
+        self.failUnlessEqual(loader._accounts.keys(), ["a", ])
+
+    def test_comments_prefetch(self):
+        """
+        Maintain comment counts and fetch the last comments of a list of contents at once
+        """
+        from django.conf import settings
+        from django.db import connection
+        from twistranet.twistapp.models.counters import rebuild_comment_counts
+        self.login(self.A)
+        quiet = StatusUpdate.objects.create(description = "Nobody cares")
+        status = Document.objects.create(title = "Hello", text = "Hello")
+        comments = [ Comment.objects.create(in_reply_to = status, description = "Comment %d" % i) for i in range(3) ]
+        Comment.objects.create(in_reply_to = comments[0], description = "Indirect")
+        self.failUnlessEqual(Content.objects.get(id = status.id).comment_count, 4)
+        self.failUnlessEqual(Content.objects.get(id = quiet.id).comment_count, 0)
+        comments[1].delete()
+        
+        # Editing a content doesn't overwrite its count
+        status.text = "Hello, again"
+        status.save()
+        contents = list(Content.objects.filter(id__in = (status.id, quiet.id, )).order_by("id"))
+        self.failUnlessEqual(contents[1].comment_count, 3)
+        
+        debug = settings.DEBUG
+        settings.DEBUG = True
+        try:
+            n_queries = len(connection.queries)
+            Content.objects.prefetch_comments(contents, count = 2)
+            self.failUnlessEqual(len(connection.queries) - n_queries, 2)
+            n_queries = len(connection.queries)
+            self.failUnlessEqual(contents[1].n_comments, 3)
+            self.failUnlessEqual([ c.description for c in contents[1].last_comments ], ["Comment 2", "Indirect", ])
+            self.failUnless(contents[1].last_comments[0].can_delete)
+            self.failUnlessEqual(contents[0].n_comments, 0)
+            self.failUnlessEqual(contents[0].last_comments, [])
+            self.failUnlessEqual(len(connection.queries), n_queries)
+        finally:
+            settings.DEBUG = debug
+        
+        # Without prefetching
+        content = Content.objects.get(id = status.id)
+        self.failUnlessEqual(content.n_comments, 3)
+        self.failUnlessEqual(len(content.last_comments), 2)
+        self.failUnlessEqual(rebuild_comment_counts(check = True), 0)
+        Content.objects.__booster__.filter(id = status.id).update(comment_count = 0)
+        self.failUnlessEqual(rebuild_comment_counts(), 1)
+        self.failUnlessEqual(Content.objects.get(id = status.id).comment_count, 3)
+        
+        # Each content gets its own last comments
+        other = StatusUpdate.objects.create(description = "Other")
+        for i in range(3):
+            Comment.objects.create(in_reply_to = other, description = "Other %d" % i)
+        contents = Content.objects.prefetch_comments(Content.objects.filter(id__in = (status.id, other.id, )).order_by("id"), count = 2)
+        self.failUnlessEqual(
+            [ [ c.description for c in content.last_comments ] for content in contents ],
+            [ ["Comment 2", "Indirect", ], ["Other 1", "Other 2", ], ],
+        )
+
+    def test_owner_for_display(self):
+        """
+        The author to display is stored, reset when memberships change and computed again in batch
+        """
+        self.login(self.A)
+        c = Community.objects.create(slug = "spokepersons", permissions = "workgroup")
+        c.join(self.B)
+        own = StatusUpdate.objects.create(description = "Mine")
+        self.failUnlessEqual(own._owner_for_display_id, self.A.id)
+        self.login(self.B)
+        doc = Document.objects.create(title = "Spoken", text = "Hello", publisher = c)
+        bulk = Twistable.objects.bulk_create_secured([ StatusUpdate(description = "Bulk", publisher = c), ])[0]
+        self.failUnlessEqual(Content.objects.get(id = doc.id)._owner_for_display_id, c.id)
+        self.failUnlessEqual(Content.objects.get(id = bulk.id)._owner_for_display_id, c.id)
+        
+        # B leaves: its contents are signed by B again
+        self.login(self.A)
+        Community.objects.get(id = c.id).leave(self.B)
+        content = Content.objects.__booster__.get(id = doc.id)
+        self.failUnlessEqual(content._owner_for_display_id, None)
+        self.failUnlessEqual(content.owner_for_display().id, self.B.id)
+        self.failUnless(Content.objects.update_owners_for_display(chunk_size = 1) >= 2)
+        self.failUnlessEqual(Content.objects.__booster__.get(id = doc.id)._owner_for_display_id, self.B.id)
+        self.failUnlessEqual(Content.objects.__booster__.get(id = own.id)._owner_for_display_id, self.A.id)
+        self.failUnlessEqual(Content.objects.__booster__.filter(_owner_for_display__isnull = True).count(), 0)
+
+    def test_timeline(self):
+        """
+        Content is pushed to the materialized timelines of active followers
+        """
+        import datetime
+        from django.conf import settings
+        from django.core.cache import cache
+        from twistranet.twistapp.models import timeline
+        self.login(self.B)
+        UserAccount.objects.get(id = self.B.id).follow(self.C)
+        before = StatusUpdate.objects.create(description = "Before")
+        self.failUnless(before.id in Timeline.objects.get_content_ids(self.B))
+        
+        # Fan out on write
+        self.login(self.C)
+        status = StatusUpdate.objects.create(description = "Fanned out")
+        comment = Comment.objects.create(in_reply_to = status, description = "Not on timelines")
+        self.failUnless(TimelineEntry.objects.filter(account_id = self.B.id, content_id = status.id).exists())
+        self.failIf(TimelineEntry.objects.filter(content_id = comment.id).exists())
+        ids = Timeline.objects.get_content_ids(self.B)
+        self.failUnlessEqual(ids[:2], [status.id, before.id, ])
+        
+        # Inactive timelines are not fed, but rebuilt
+        Timeline.objects.filter(account__id = self.B.id).update(last_read = datetime.datetime.now() - datetime.timedelta(days = 30))
+        late = StatusUpdate.objects.create(description = "Late")
+        self.failIf(TimelineEntry.objects.filter(account_id = self.B.id, content_id = late.id).exists())
+        self.failUnlessEqual(Timeline.objects.get_content_ids(self.B)[0], late.id)
+        self.failUnless(TimelineEntry.objects.filter(account_id = self.B.id, content_id = late.id).exists())
+        
+        # Popular publishers are merged on read
+        saved = dict([ (k, getattr(settings, k)) for k in ("TWISTRANET_TIMELINE_FANOUT_LIMIT", "TWISTRANET_TIMELINE_DEPTH", ) if hasattr(settings, k) ])
+        settings.TWISTRANET_TIMELINE_FANOUT_LIMIT = 0
+        settings.TWISTRANET_TIMELINE_DEPTH = 2
+        cache.delete(timeline.CELEBRITIES_CACHE_KEY)
+        try:
+            popular = StatusUpdate.objects.create(description = "Popular")
+            self.failIf(TimelineEntry.objects.filter(content_id = popular.id).exists())
+            self.failUnlessEqual(Timeline.objects.get_content_ids(self.B), [popular.id, late.id, ])
+            self.failUnlessEqual(TimelineEntry.objects.filter(account_id = self.B.id).count(), 2)
+        finally:
+            for k in ("TWISTRANET_TIMELINE_FANOUT_LIMIT", "TWISTRANET_TIMELINE_DEPTH", ):
+                if saved.has_key(k):
+                    setattr(settings, k, saved[k])
+                else:
+                    delattr(settings._wrapped, k)
+            cache.delete(timeline.CELEBRITIES_CACHE_KEY)
+
+    def test_summary_cache(self):
+        """
+        Rendered summaries are cached until the content or its accounts change
+        """
+        from django.template.loader import render_to_string
+        from twistranet.core import caches
+        self.login(self.A)
+        doc = Document.objects.create(title = "Cached", description = "First version", text = "Text")
+        def render():
+            content = Content.objects.prefetch_summaries(Content.objects.filter(id = doc.id))[0]
+            return content, render_to_string("content/summary.part.html", {"content": content, })
+        caches.summary_cache.reset_stats()
+        content, html = render()
+        self.failUnless("First version" in html)
+        content, html_again = render()
+        self.failUnless(content._c_summary_html)
+        self.failUnlessEqual(html, html_again)
+        self.failUnlessEqual((caches.summary_cache.hits, caches.summary_cache.misses), (1, 1))
+        self.failUnlessEqual(caches.summary_cache.stats()["hit_rate"], 0.5)
+        
+        # Another viewer doesn't have the same rights
+        self.login(self.B)
+        content = Content.objects.prefetch_summaries(Content.objects.filter(id = doc.id))[0]
+        self.failIf(getattr(content, "_c_summary_html", None))
+        
+        # Saving the content or its author invalidates it
+        self.login(self.A)
+        doc.description = "Second version"
+        doc.save()
+        content, html = render()
+        self.failUnless("Second version" in html)
+        account = UserAccount.objects.get(id = self.A.id)
+        account.title = "A renamed"
+        account.save()
+        content, html = render()
+        self.failUnless("A renamed" in html)
+        
+        # What depends on what the viewer can see (manager badge, wiki text) is not in the shared fragment
+        club = Community.objects.create(slug = "badge_club", permissions = "workgroup")
+        status = StatusUpdate.objects.create(publisher = club, description = "Ask @badge_club")
+        content = Content.objects.prefetch_summaries(Content.objects.filter(id = status.id))[0]
+        html = render_to_string("content/summary.part.html", {"content": content, })
+        self.failUnless("community_manager_badge" in html)
+        self.failUnless("Ask" in html)
+        self.failIf("community_manager_badge" in content._c_summary_html)
+        self.failIf("Ask" in content._c_summary_html)
@@ -0,0 +1,119 @@
+"""
+Community membership tests.
+"""
+from django.core.exceptions import PermissionDenied
+from twistranet.twistapp.tests.base import TNBaseTest
+from twistranet.twistapp.models import *
+
+class MembershipTest(TNBaseTest):
+    """
+    Check community membership caching and set-wise membership changes.
+    """
+    def test_membership_cache(self):
+        """
+        Check that membership tests don't hit the database once the community relations are loaded
+        """
+        from django.conf import settings
+        from django.db import connection
+        from django.core.cache import cache
+        self.login(self.A)
+        c = Community.objects.create(slug = "cached_members", permissions = "workgroup")
+        c.join(self.B)
+        debug = settings.DEBUG
+        settings.DEBUG = True
+        try:
+            # Relations are loaded once per instance...
+            c = Community.objects.get(id = c.id)
+            n_queries = len(connection.queries)
+            for i in range(5):
+                self.failUnless(c.isMember(self.A, is_manager = True))
+                self.failUnless(c.isMember(self.B))
+                self.failIf(c.isMember(self.B, is_manager = True))
+                self.failIf(c.isMember(self.C))
+                self.failUnless(c.is_member)
+                self.failUnless(c.is_manager)
+            self.failUnlessEqual(len(connection.queries), n_queries)
+            
+            # ...from the shared cache if another process loaded them...
+            Network.graph.clear()
+            settings.TWISTRANET_NETWORK_GRAPH = False
+            c = Community.objects.get(id = c.id)
+            n_queries = len(connection.queries)
+            self.failUnless(c.isMember(self.B))
+            self.failUnlessEqual(len(connection.queries), n_queries)
+            
+            # ...else with one query
+            cache.delete("tn_relations#%s" % c.id)
+            c = Community.objects.get(id = c.id)
+            n_queries = len(connection.queries)
+            self.failUnless(c.isMember(self.B))
+            self.failIf(c.isMember(self.C))
+            self.failUnlessEqual(len(connection.queries), n_queries + 1)
+            
+            # Changes update the shared relations instead of dropping them
+            c.set_as_manager(self.B)
+            self.failUnless(c.isMember(self.B, is_manager = True))
+            c.leave(self.B)
+            self.failIf(c.isMember(self.B))
+            c = Community.objects.get(id = c.id)
+            n_queries = len(connection.queries)
+            self.failIf(c.isMember(self.B))
+            self.failUnless(c.isMember(self.A))
+            self.failUnlessEqual(len(connection.queries), n_queries)
+        finally:
+            settings.DEBUG = debug
+            settings.TWISTRANET_NETWORK_GRAPH = True
+
+    def test_bulk_membership(self):
+        """
+        Check that join_many() / invite_many() give the same relations as join() / invite()
+        """
+        from twistranet.notifier.models import Notification
+        self.login(self.A)
+        c = Community.objects.create(slug = "bulk_members", permissions = "workgroup")
+        invitations = Notification.objects.__booster__.filter(publisher__id = self.C.id).count()
+        joined = c.join_many([ self.B, self.B, self.A, ])
+        self.failUnlessEqual([ a.id for a in joined ], [ self.B.id, ])
+        self.failUnless(c.isMember(self.B))
+        self.failUnlessEqual(c.join_many([ self.B, ]), [])
+        invited = c.invite_many([ self.B, self.C, ])
+        self.failUnlessEqual([ a.id for a in invited ], [ self.C.id, ])
+        self.failIf(c.isMember(self.C))
+        self.failUnless(c.id in UserAccount.objects.get(id = self.C.id).get_pending_network_request_ids(returned_model = Community))
+        self.failUnlessEqual(Notification.objects.__booster__.filter(publisher__id = self.C.id).count(), invitations + 1)
+        
+        # Invited accounts can join afterwards
+        c.join_many([ self.C, ])
+        c = Community.objects.get(id = c.id)
+        self.failUnless(c.isMember(self.C))
+        self.failUnlessEqual(RelationCounters.objects.get_for(c.id).members, 3)
+        self.failUnlessEqual(RelationCounters.objects.rebuild(check = True), 0)
+        check = AccessToken.objects.check()
+        self.failUnlessEqual(check["missing_network_tokens"], 0)
+        self.failUnlessEqual(check["stale_network_tokens"], 0)
+        
+        # Rights are checked once, for the whole batch
+        self.login(self.admin)
+        p = Community.objects.create(slug = "bulk_private", permissions = "private")
+        self.login(self.B)
+        p = Community.objects.__booster__.get(id = p.id)
+        self.failUnlessRaises(PermissionDenied, p.join_many, [ self.B, self.C, ])
+        
+        # Managing members set-wise
+        self.login(self.A)
+        c = Community.objects.get(id = c.id)
+        c.set_as_manager_many([ self.B, self.C, ])
+        self.failUnless(c.isMember(self.B, is_manager = True) and c.isMember(self.C, is_manager = True))
+        self.failUnlessEqual(RelationCounters.objects.get_for(c.id).managers, 3)
+        self.failUnlessRaises(PermissionDenied, c.unset_as_manager_many, [ self.A, self.B, ])
+        c.unset_as_manager_many([ self.B, ])
+        self.failIf(c.isMember(self.B, is_manager = True))
+        c.leave_many([ self.B, self.C, ])
+        c = Community.objects.get(id = c.id)
+        self.failIf(c.isMember(self.B) or c.isMember(self.C))
+        self.failUnless(c.isMember(self.A, is_manager = True))
+        self.failUnlessEqual(RelationCounters.objects.rebuild(check = True), 0)
+        self.failIf(sum(AccessToken.objects.check().values()), AccessToken.objects.check())
+        self.login(self.B)
+        c = Community.objects.get(id = c.id)
+        self.failUnlessRaises(PermissionDenied, c.set_as_manager_many, [ self.B, ])
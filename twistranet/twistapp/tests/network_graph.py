@@ -0,0 +1,69 @@
+"""
+Relations index tests.
+"""
+from twistranet.twistapp.tests.base import TNBaseTest
+from twistranet.twistapp.models import *
+
+class NetworkGraphTest(TNBaseTest):
+    """
+    Check that Network.graph answers relation queries like the Network table does.
+    """
+    def test_network_graph(self):
+        """
+        Check that the in-memory relations index matches the Network table
+        """
+        from twistranet.core import caches
+        from django.conf import settings
+        graph = Network.graph
+        def check(account):
+            self.failUnlessEqual(list(graph.following_ids(account.id)), sorted(Network.objects.filter(client__id = account.id).values_list("target", flat = True)))
+            self.failUnlessEqual(list(graph.follower_ids(account.id)), sorted(Network.objects.filter(target__id = account.id).values_list("client", flat = True)))
+            mutual = Account.objects.__booster__.filter(targeted_network__target__id = account.id, requesting_network__client__id = account.id)
+            self.failUnlessEqual(list(graph.mutual_ids(account.id)), sorted(mutual.values_list("id", flat = True)))
+        
+        self.login(self.A)
+        check(self.A)
+        check(self.C)
+        hits = graph.hits
+        check(self.A)
+        self.failUnless(graph.hits > hits)
+        
+        # Follow requests are updated in place
+        misses = graph.misses
+        UserAccount.objects.get(id = self.A.id).follow(self.C)
+        check(self.A)
+        check(self.C)
+        self.failUnlessEqual(graph.misses, misses)
+        self.failUnless(self.A.id in graph.pending_ids(self.C.id))
+        self.failUnless(self.A.id in UserAccount.objects.get(id = self.C.id).get_pending_network_request_ids())
+        self.failIf(self.C.id in graph.pending_ids(self.A.id))
+        
+        # Communities: members and managers, including flags updated without signals
+        c = Community.objects.create(slug = "graphed", permissions = "workgroup")
+        c.join(self.B)
+        self.failUnless(c.isMember(self.B))
+        self.failIf(c.isMember(self.B, is_manager = True))
+        self.failIf(c.isMember(self.C))
+        c.set_as_manager(self.B)
+        self.failUnless(c.isMember(self.B, is_manager = True))
+        self.failUnless(self.B.id in c.managers.values_list("id", flat = True))
+        check(c)
+        c.leave(self.B)
+        self.failIf(c.isMember(self.B))
+        check(c)
+        check(self.B)
+        
+        # Relations changed behind our back (eg. by another process) are read again
+        Network.objects.filter(client__id = self.A.id, target__id = self.C.id).update(is_manager = True)
+        caches.bump_versions(self.A.id, self.C.id)
+        self.failUnless(self.A.id in graph.get(self.C.id).manager_ids)
+        
+        # SQL fallback
+        settings.TWISTRANET_NETWORK_GRAPH = False
+        try:
+            graph.clear()
+            check(self.A)
+            self.failUnless(self.A.id in graph.pending_ids(self.C.id))
+            self.failIf(graph._relations)
+        finally:
+            settings.TWISTRANET_NETWORK_GRAPH = True
@@ -0,0 +1,61 @@
+"""
+Relation import tests.
+"""
+from twistranet.twistapp.tests.base import TNBaseTest
+from twistranet.twistapp.models import *
+
+class RelationImportTest(TNBaseTest):
+    """
+    Check that relations imported set-wise are the same as created ones.
+    """
+    def test_relation_import(self):
+        """
+        Check that imported relations are the same as created ones, and that existing ones are skipped
+        """
+        from StringIO import StringIO
+        from twistranet.twistapp.lib.relation_import import RelationImporter, read_edges
+        from twistranet.notifier.models import Notification
+        self.login(self.A)
+        c = Community.objects.create(slug = "imported", permissions = "workgroup")
+        A, B, C = [ UserAccount.objects.__booster__.get(id = a.id) for a in (self.A, self.B, self.C, ) ]
+        notifications = Notification.objects.__booster__.count()
+        edges = StringIO("""# client,target,is_manager
+%s,%s
+%s,%s
+%s,imported,1
+imported,%s
+%s,%s
+nobody,%s
+""" % (A.slug, C.slug, A.slug, C.slug, B.slug, B.slug, A.slug, c.id, B.slug, ))
+        importer = RelationImporter(chunk_size = 2)
+        self.failUnlessEqual(importer.load(read_edges(edges)), 3)
+        self.failUnlessEqual((importer.read, importer.created, importer.unknown, ), (6, 3, 1, ))
+        self.failUnlessEqual(Notification.objects.__booster__.count(), notifications)
+        
+        self.failUnless(C.id in A.followed_ids)
+        self.failUnless(A.id in UserAccount.objects.get(id = C.id).get_pending_network_request_ids())
+        c = Community.objects.get(id = c.id)
+        self.failUnless(c.isMember(B, is_manager = True))
+        self.failUnlessEqual(RelationCounters.objects.rebuild(check = True), 0)
+        self.failUnlessEqual(AccessToken.objects.check()["missing_network_tokens"], 0)
+        
+        # Signals can be sent as well
+        importer = RelationImporter(send_signals = True)
+        self.failUnlessEqual(importer.load([ (C.slug, A.slug, ), (C.slug, A.slug, ), ]), 1)
+        self.failUnless(A.id in UserAccount.objects.get(id = C.id).network.values_list("id", flat = True))
+        self.failUnlessEqual(Notification.objects.__booster__.count(), notifications + 1)
+        
+        # String flags are parsed, not tested for emptiness
+        # Unknown ids are not imported, all-digit slugs (from legacy data) are not taken for ids
+        digits = Community.objects.create(slug = "digits", permissions = "workgroup")
+        unknown_id = digits.id + 5000
+        Account.objects.__booster__.filter(id = digits.id).update(slug = "%d" % (unknown_id + 1, ))
+        digits = Account.objects.__booster__.get(id = digits.id)
+        importer = RelationImporter()
+        edges = list(importer.edges([ (A.id, unknown_id, ), ("%d" % unknown_id, A.slug, ), (C.slug, digits.slug, ), (C.id, "%d" % digits.id, ), ]))
+        self.failUnlessEqual(edges, [ (C.id, digits.id, False, ), (C.id, digits.id, False, ), ])
+        self.failUnlessEqual((importer.read, importer.unknown, ), (4, 2, ))
+        
+        flags = ("0", "false", " No ", "", False, "1", " True", "YES", True, )
+        edges = RelationImporter().edges([ (A.id, B.id, flag, ) for flag in flags ])
+        self.failUnlessEqual([ is_manager for client_id, target_id, is_manager in edges ], [ False ] * 5 + [ True ] * 4)
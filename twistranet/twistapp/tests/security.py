@@ -22,7 +22,7 @@ class SecurityTest(TNBaseTest):
         """
         Test various has_role conditions
         """
-        __account__ = self.system
+        self.login(self.system)
         #import sys;sys.stdout=sys.__stdout__;sys.stderr=sys.__stderr__;import ipdb; ipdb.set_trace()
         obj = GlobalCommunity.objects.get()
         self.failUnless(self.system.has_role(roles.system, obj))
@@ -30,9 +30,9 @@ class SecurityTest(TNBaseTest):
         self.failIf(self.admin.has_role(roles.system, obj))
         # self.failUnless(self.admin.has_role(roles.owner, obj))    XXX TODO: re-enable when mgr role is ok
         self.failUnless(self.admin.has_role(roles.network, obj))
-        __account__ = self.A
+        self.login(self.A)
         obj = GlobalCommunity.objects.get()
-        self.failIf(__account__.has_role(roles.owner, obj))
+        self.failIf(self.A.has_role(roles.owner, obj))
         
 
     # XXX PJ test is failing > renamed twist
@@ -40,11 +40,11 @@ class SecurityTest(TNBaseTest):
         """
         Check if can_join permissions seem ok.
         """
-        __account__ = self.A
+        self.login(self.A)
         adm = Community.objects.get(slug = "administrators")
         self.failIf(adm.can_join)
         self.failIf(adm.can_leave)
-        __account__ = self.admin
+        self.login(self.admin)
         self.failUnless(adm.can_join)        
         self.failIf(adm.can_leave, "Administrator is the last account on this community, it shouldn't be able to leave")
 
@@ -53,13 +53,13 @@ class SecurityTest(TNBaseTest):
         """
         Check some basic edition rights
         """
-        __account__ = self.A
+        self.login(self.A)
         adm = Community.objects.get(slug = "administrators")
         self.failIf(adm.can_edit)
-        __account__ = self.A
+        self.login(self.A)
         self.failIf(adm.is_manager)
         self.failIf(adm.can_edit)
-        __account__ = self.admin
+        self.login(self.admin)
         # self.failUnless(adm.is_manager)     #   XXX REMOVED THAT because Administrator is not (yet) 100% admin
         # The two following may be true or false depending wether admin is a community manager on administrators.
         self.failIf(self.admin.has_role(roles.owner, adm))
@@ -70,7 +70,7 @@ class SecurityTest(TNBaseTest):
         Check private content behavior
         """
         # A creates a private object
-        __account__ = self.A
+        self.login(self.A)
         s = Document.objects.create(
             text = "Hello, World!",
             permissions = "private"
@@ -80,43 +80,43 @@ class SecurityTest(TNBaseTest):
         
         # twistranet must not see it?
         # XXX TODO: Re-enable this test if we decide to have really private content
-        # __account__ = self.admin
+        # self.login(self.admin)
         # self.failUnless(s.content_ptr not in Content.objects.all())
         
         # B must not see it
-        __account__ = self.B
+        self.login(self.B)
         self.failUnless(s.content_ptr not in Content.objects.all())
         
         # B creates a private object, same kind of tests
-        __account__ = self.B
+        self.login(self.B)
         s = Document.objects.create(text = "Hello", permissions = "private")
         s.save()
         self.failUnless(s.content_ptr in Content.objects.all())
-        __account__ = self.admin
+        self.login(self.admin)
         # XXX TODO: Re-enable this test if we decide to have really private content
         # self.failUnless(s.content_ptr not in Content.objects.all())
-        __account__ = self.A
+        self.login(self.A)
         self.failUnless(s.content_ptr not in Content.objects.all())
-        __account__ = self.B
+        self.login(self.B)
         self.failUnless(s.content_ptr in Content.objects.all())
         
         # Oh, by the way, the system account must see 'em !
-        __account__ = self.system
+        self.login(self.system)
         self.failUnless(s.content_ptr in Content.objects.all())
         
     def test_network_content(self):
         """
         Check if network-protected content is accessible to NW only
         """
-        __account__ = self.A
+        self.login(self.A)
         s = Document(text = "Hello, World!", permissions = "network")
         s.save()
         
         # Check if 'view' permission is ok in permissionmapping
         self.failUnless(Content.objects.filter(id = s.id))
-        __account__ = self.admin       # admin is in A's network
+        self.login(self.admin)       # admin is in A's network
         self.failUnless(s.content_ptr in Content.objects.all())
-        __account__ = self.B        # B is not
+        self.login(self.B)        # B is not
         self.failUnless(s.content_ptr not in Content.objects.all())
             
     # def test_silent_permissions(self):
@@ -124,24 +124,124 @@ class SecurityTest(TNBaseTest):
     #     Ensure permissions are not easily visible.
     #     XXX Disabled by now for simplicity reasons.
     #     """
-    #     __account__ = self.A
+    #     self.login(self.A)
     #     s = StatusUpdate(text = "Hello, World!", permissions = "network")
     #     s.save()
     #     self.failIf(s._permissions.filter(name = 'can_view').all())
     #     self.failIf(s._permissions.all())
         
             
+    def test_role_cache(self):
+        """
+        Check that cached roles are invalidated when the network changes
+        """
+        self.login(self.A)
+        s = Document(text = "Hello, World!", permissions = "network")
+        s.save()
+        b = UserAccount.objects.get(id = self.B.id)
+        self.failIf(b.has_role(roles.network, s))
+        hits = Account._role_cache.hits
+        self.failIf(b.has_role(roles.network, s))
+        self.failUnlessEqual(Account._role_cache.hits, hits + 1)
+        
+        # A adds B to its network
+        self.A.object.follow(self.B)
+        b = UserAccount.objects.get(id = self.B.id)
+        self.failUnless(b.has_role(roles.network, s))
+        
+    def test_process_cache(self):
+        """
+        Nothing is kept in process memory unless the cache backend is shared between processes
+        """
+        from django.conf import settings
+        from twistranet.core import caches
+        self.failUnless(settings.CACHE_BACKEND.startswith("locmem:"))
+        settings.TWISTRANET_PROCESS_CACHE = None
+        self.failIf(caches.process_cache_enabled())
+        self.failIf(Network.graph.enabled)
+        self.login(self.A)
+        s = Document(text = "Hello, World!", permissions = "network")
+        s.save()
+        Account._role_cache.clear()
+        b = UserAccount.objects.get(id = self.B.id)
+        self.failIf(b.has_role(roles.network, s))
+        self.failIf(b.has_role(roles.network, s))
+        self.failIf(Account._role_cache.hits)
+        self.failIf(Account._role_cache._data)
+        
+        backend = settings.CACHE_BACKEND
+        settings.CACHE_BACKEND = "memcached://127.0.0.1:11211/"
+        try:
+            self.failUnless(caches.process_cache_enabled())
+        finally:
+            settings.CACHE_BACKEND = backend
+        
+    def test_has_permission_many(self):
+        """
+        Check that batch permission checks give the same results as individual checks
+        """
+        self.login(self.A)
+        objects = [
+            Document(text = "Public", permissions = "public"),
+            StatusUpdate(description = "Network", permissions = "network"),
+            Document(text = "Private", permissions = "private"),
+        ]
+        for obj in objects:
+            obj.save()
+        objects.extend(Account.objects.__booster__.all())
+        for account in (self.A, self.B, self.admin, SystemAccount.get(), ):
+            for permission in (permissions.can_list, permissions.can_view, permissions.can_edit, permissions.can_delete, ):
+                granted = account.has_permission_many(permission, objects)
+                for obj in objects:
+                    self.failUnlessEqual(
+                        granted[obj.id], account.has_permission(permission, obj),
+                        "%s / %s / %s" % (account, permission, obj, )
+                    )
+        
+        # Annotated objects keep the permissions computed for each account, and only give them to that account
+        annotated = Twistable.objects.annotate_permissions(objects[:3], (permissions.can_edit, ))
+        self.failUnless(annotated[0].can_edit)
+        self.failUnless(annotated[2].can_edit)
+        self.login(self.B)
+        self.failIf(annotated[0].can_edit)
+        self.failIf(annotated[2].can_edit)
+        Twistable.objects.annotate_permissions(annotated, (permissions.can_edit, ))
+        self.failIf(annotated[0].can_edit)
+        self.login(self.A)
+        self.failUnless(annotated[0].can_edit)
+        
+    def test_packed_permissions(self):
+        """
+        Check the packed roles storage and its SQL migration
+        """
+        from twistranet.twistapp.models import indexes
+        for role in (roles.public, roles.network, roles.manager, roles.owner, roles.system, ):
+            packed = permissions.pack_roles({permissions.can_view: role, permissions.can_list: roles.owner, })
+            self.failUnlessEqual(permissions.unpack_role(packed, permissions.can_view), role)
+            self.failUnlessEqual(permissions.unpack_role(packed, permissions.can_list), roles.owner)
+            self.failUnlessEqual(permissions.unpack_role(packed, permissions.can_edit), None)
+        
+        self.login(self.A)
+        Document(text = "Private", permissions = "private").save()
+        saved = dict(Twistable.objects.__booster__.values_list("id", "_p_packed"))
+        self.failIf(0 in saved.values())
+        indexes.pack_permission_columns()
+        self.failUnlessEqual(saved, dict(Twistable.objects.__booster__.values_list("id", "_p_packed")))
+        
+        # Composite indexes are created by syncdb
+        self.failUnlessEqual(indexes.create_composite_indexes(), [])
+        
     def test_public_content(self):
         """
         Check if public content on an account is visible by anyone
         """
-        __account__ = self.A
+        self.login(self.A)
         s = StatusUpdate(description = "Hello, World!", permissions = "public")
         s.save()
         self.failUnless(s.content_ptr in Content.objects.all())
-        __account__ = self.admin       # admin is in A's network
+        self.login(self.admin)       # admin is in A's network
         self.failUnless(s.content_ptr in Content.objects.all())
-        __account__ = self.B        # B is not
+        self.login(self.B)        # B is not
         self.failUnless(s.content_ptr in Content.objects.all())
         
     # XXX PJ test is failing > renamed twist
@@ -150,7 +250,7 @@ class SecurityTest(TNBaseTest):
         Check if I can delete my own content
         """
         # I should be able to delete a content I wrote
-        __account__ = self.A
+        self.login(self.A)
         StatusUpdate(description = "Hi, there.").save()
         c = StatusUpdate.objects.filter(owner = self.A)[0]
         _id = c.id
@@ -173,26 +273,26 @@ class SecurityTest(TNBaseTest):
         self.failUnlessEqual(StatusUpdate.objects.count(), 0)
         
         # Become an internet. There should be some content available
-        __account__ = self.system
+        self.login(self.system)
         glob = GlobalCommunity.objects.get()
         glob.permissions = "internet"
         glob.save()
-        del __account__
+        self.logout()
         self.failUnlessEqual(StatusUpdate.objects.count(), 0)
 
         # Get back to intranet. No more content please.
-        __account__ = self.system
+        self.login(self.system)
         glob = GlobalCommunity.objects.get()
         glob.permissions = "intranet"
         glob.save()
-        del __account__
+        self.logout()
         self.failUnlessEqual(list(StatusUpdate.objects.all()), [])
         
     def test_hassystem_account(self):
         """
         Is system account created and working?
         """
-        __account__ = self.system
+        self.login(self.system)
         system_accounts = SystemAccount.objects.all()
         self.failUnlessEqual(len(system_accounts), 1)
     
@@ -201,7 +301,7 @@ class SecurityTest(TNBaseTest):
         """
         Check if system account can access all communities
         """
-        __account__ = self.system
+        self.login(self.system)
         self.failUnlessEqual(len(Community.objects.all()), 2)
         
     def test_default_communities(self):
@@ -209,7 +309,7 @@ class SecurityTest(TNBaseTest):
         There should be one global com. and one member-only com.
         AND the system account must see them all.
         """
-        __account__ = self.system
+        self.login(self.system)
         self.failUnlessEqual(len(AdminCommunity.objects.filter(model_name = "AdminCommunity")), 1)
         self.failUnlessEqual(len(GlobalCommunity.objects.filter(model_name = "GlobalCommunity")), 1)
         self.failUnlessEqual(AdminCommunity.objects.get().model_name, "AdminCommunity")
@@ -219,12 +319,12 @@ class SecurityTest(TNBaseTest):
         """
         Check if system is NOT in the community.
         """
-        __account__ = self.system
+        self.login(self.system)
         self.failUnlessEqual(len(self.system.communities), 0)
         self.failUnlessEqual(len(Community.objects.all()), 2)
         
     def test_membership(self):
-        __account__ = self.system
+        self.login(self.system)
         self.failUnlessEqual(len(self.A.communities), 1)
         c = Community.objects.create(title = "Test Community", permissions = "ou")
         c.save()
@@ -237,7 +337,7 @@ class SecurityTest(TNBaseTest):
         """
         Check if can_view permission works as expected
         """
-        __account__ = self.B
+        self.login(self.B)
         self.B.permissions = "private"
         self.B.object.save()
         hello = StatusUpdate(description = "Hello there", permissions = "public")
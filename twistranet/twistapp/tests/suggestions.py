@@ -0,0 +1,89 @@
+"""
+"People you may know" suggestions tests.
+"""
+from twistranet.twistapp.tests.base import TNBaseTest
+from twistranet.twistapp.models import *
+
+class SuggestionsTest(TNBaseTest):
+    """
+    Check how suggestions are scored, stored and kept up to date.
+    """
+    def test_suggestions(self):
+        """
+        Check that suggestions are scored from shared network members and communities, and refreshed after changes
+        """
+        def suggested(account):
+            return dict(Suggestion.objects.filter(account_id = account.id).values_list("suggested_id", "score"))
+        self.login(self.A)
+        A, C = [ UserAccount.objects.__booster__.get(id = a.id) for a in (self.A, self.C, ) ]
+        c = Community.objects.create(slug = "suggested", permissions = "workgroup")
+        c.join(self.B)
+        A.follow(C)
+        Suggestion.objects.rebuild()
+        self.failUnlessEqual(suggested(self.B).get(self.A.id), 1)
+        self.failIf(self.C.id in suggested(self.A))
+        
+        # Network members of network members count more than shared communities
+        c.join(self.C)
+        admin = UserAccount.objects.__booster__.get(id = self.admin.id)
+        A.follow(admin)
+        self.login(self.admin)
+        admin.follow(A)
+        self.login(self.C)
+        C.follow(A)
+        stale_ids = set(StaleSuggestion.objects.values_list("account_id", flat = True))
+        self.failUnlessEqual(stale_ids, set([ self.A.id, self.C.id, self.admin.id, c.id, ]))
+        self.failUnlessEqual(StaleSuggestion.objects.count(), len(stale_ids))
+        self.failIf(self.admin.id in suggested(self.C))
+        self.failUnlessEqual(Suggestion.objects.refresh_stale(), 3)
+        self.failIf(StaleSuggestion.objects.count())
+        scores = suggested(self.C)
+        self.failUnlessEqual(scores.get(self.admin.id), 2)
+        self.failUnlessEqual(scores.get(self.B.id), 1)
+        self.failIf(self.A.id in scores)
+        self.failUnlessEqual([ a.id for a in Suggestion.objects.get_for(C, count = 2) ], [ self.admin.id, self.B.id, ])
+        
+        # Refreshed suggestions are the same as rebuilt ones (B's are not stale when C joins: that's not its relation)
+        refreshed = dict([ (a.id, suggested(a)) for a in (self.A, self.C, ) ])
+        Suggestion.objects.rebuild()
+        self.failUnlessEqual(dict([ (a.id, suggested(a)) for a in (self.A, self.C, ) ]), refreshed)
+        self.failUnlessEqual(suggested(self.B).get(self.C.id), 1)
+        
+        # Stale suggestions are served as stored (filtered), unless they're to be refreshed when read
+        from django.conf import settings
+        from django.db import connection
+        self.login(self.admin)
+        admin.follow(C)
+        self.failUnlessEqual(StaleSuggestion.objects.filter(account_id = self.admin.id).count(), 1)
+        self.failUnless(self.C.id in suggested(self.admin))
+        debug = settings.DEBUG
+        settings.DEBUG = True
+        try:
+            n_queries = len(connection.queries)
+            self.failIf(self.C.id in [ a.id for a in Suggestion.objects.get_for(admin) ])
+            self.failUnless(len(connection.queries) - n_queries <= 2)
+        finally:
+            settings.DEBUG = debug
+        self.failUnless(self.C.id in suggested(self.admin))
+        settings.TWISTRANET_SUGGESTIONS_REFRESH_ON_READ = True
+        try:
+            Suggestion.objects.get_for(admin)
+        finally:
+            settings.TWISTRANET_SUGGESTIONS_REFRESH_ON_READ = False
+        self.failIf(self.C.id in suggested(self.admin))
+        self.failIf(StaleSuggestion.objects.filter(account_id = self.admin.id).count())
+        self.login(self.C)
+        
+        # Relations added or removed set-wise mark suggestions as stale as well
+        StaleSuggestion.objects.all().delete()
+        Network.objects.bulk_add([ (self.C.id, self.admin.id, False, ), ])
+        self.failUnlessEqual(set(StaleSuggestion.objects.values_list("account_id", flat = True)), set([ self.C.id, self.admin.id, ]))
+        self.login(self.A)
+        c = Community.objects.get(id = c.id)
+        c.leave_many([ self.B, ])
+        c.join_many([ self.B, ])
+        self.failUnlessEqual(
+            set(StaleSuggestion.objects.values_list("account_id", flat = True)),
+            set([ self.B.id, self.C.id, self.admin.id, c.id, ]),
+        )
+        self.failUnlessEqual(StaleSuggestion.objects.count(), 4)
@@ -14,7 +14,7 @@ class WallTest(TNBaseTest):
         A and admin are in the same network.
         If A creates a private, it must not be visible in admin's wall (even with A account)
         """
-        __account__ = self.A
+        self.login(self.A)
         s = Document(text = "Private", permissions = "private")
         s.save()
         self.failUnless(s.content_ptr in Content.objects.all())
@@ -29,7 +29,7 @@ class WallTest(TNBaseTest):
         We check everything from A's eyes
         """
         # Check networked content availability
-        __account__ = self.A
+        self.login(self.A)
         s = StatusUpdate(description = "NWK", permissions = "network")
         s.save()
         self.failUnless(s.content_ptr in Content.objects.all())
@@ -55,12 +55,12 @@ class WallTest(TNBaseTest):
         self.failUnlessEqual(self.B.useraccount.user.username, "B")
         
         # Check public objects. Must be empty (unless I put truly public objects in the fixture?)
-        __account__ = None
+        self.logout()
         public_list = Content.objects.all()
         self.failUnlessEqual(len(public_list), 0)
 
         # Check wall objects. First one should be older than, say, the third one.
-        __account__ = self.B
+        self.login(self.B)
         latest = self.B.content.all().order_by('-created_at')[:5]
         self.failUnlessEqual(len(latest), 5)
         self.failUnless(latest[0].created_at >= latest[3].created_at, "Invalid date order for the wall")
@@ -72,12 +72,12 @@ class WallTest(TNBaseTest):
         """
         # A creates a private content. B shouldn't see it.
         from twistranet.content_types import StatusUpdate
-        __account__ = self.B
+        self.login(self.B)
         b_initial_list = self.B.content.all()
         b_initial_followed = self.B.followed_content.all()
         
         # Test content creation
-        __account__ = self.A
+        self.login(self.A)
         s = Document.objects.create()
         s.text = "Hello, this is A speaking"
         s.permissions = "private"
@@ -86,15 +86,15 @@ class WallTest(TNBaseTest):
         self.failUnlessEqual(s.publisher, self.A)
         
         # Check if B can see A's content (it shouldn't, as it's private
-        __account__ = self.B
+        self.login(self.B)
         b_final_list = self.B.content.all()
         self.failUnlessEqual(len(b_initial_list), len(b_final_list))
         
         # A creates / edits public content. B should see it even if he doesn't follow A
-        __account__ = self.A
+        self.login(self.A)
         s.permissions = "public"
         s.save()
-        __account__ = self.B
+        self.login(self.B)
         b_final_list = self.B.content.all()
         self.failUnlessEqual(len(b_initial_list) + 1, len(b_final_list))
 
@@ -108,7 +108,7 @@ class WallTest(TNBaseTest):
         Check if content I write is displayed
         """
         from twistranet.content_types import StatusUpdate
-        __account__ = self.A
+        self.login(self.A)
         s = Document.objects.create()
         s.text = "Hello, this is A speaking"
         s.permissions = "private"
@@ -119,3 +119,169 @@ class WallTest(TNBaseTest):
         
         
         
+
+    def test_05_cursor_pagination(self):
+        """
+        Walls are paginated on content ids, and stay stable when new content arrives.
+        """
+        from django.conf import settings
+        from django.test.client import Client
+        self.login(self.B)
+        statuses = [ StatusUpdate.objects.create(description = "Page %d" % i) for i in range(5) ]
+        ids = [ s.id for s in statuses ]
+        
+        # Managers
+        feed = Content.objects.getActivityFeed(self.B, before = ids[3]).values_list("id", flat = True)
+        self.failUnless(ids[2] in feed)
+        self.failIf(ids[3] in feed or ids[4] in feed)
+        followed = Content.objects.get_followed(before = ids[3]).values_list("id", flat = True)
+        self.failUnless(ids[2] in followed)
+        self.failIf(ids[3] in followed)
+        self.failUnlessEqual(Timeline.objects.get_content_ids(self.B, before = ids[4], count = 2), [ids[3], ids[2], ])
+        
+        # Load more, even if some content has been published in between
+        client = Client()
+        client.post("/login/", {'username': 'B', 'password': 'dummy'})
+        per_page = settings.TWISTRANET_CONTENT_PER_PAGE
+        settings.TWISTRANET_CONTENT_PER_PAGE = 2
+        try:
+            response = client.get("/")
+            self.failUnlessEqual(response.status_code, 200)
+            self.failUnlessEqual([ c.id for c in response.context["latest_content_list"] ], [ids[4], ids[3], ])
+            self.failUnlessEqual(response.context["next_cursor"], ids[3])
+            StatusUpdate.objects.create(description = "Newer")
+            response = client.get("/", {"before": ids[3]}, HTTP_X_REQUESTED_WITH = "XMLHttpRequest")
+            self.failUnlessEqual(response.status_code, 200)
+            self.failUnlessEqual([ c.id for c in response.context["latest_content_list"] ], [ids[2], ids[1], ])
+            self.failUnless("?before=%d" % ids[1] in response.content)
+            self.failIf("<html" in response.content)
+        finally:
+            settings.TWISTRANET_CONTENT_PER_PAGE = per_page
+
+    def test_06_union_feeds(self):
+        """
+        Feeds read with a UNION of indexed branches return the same content as the OR-ed queries
+        """
+        self.login(self.B)
+        UserAccount.objects.get(id = self.B.id).follow(self.A)
+        StatusUpdate.objects.create(description = "B's")
+        self.login(self.A)
+        StatusUpdate.objects.create(description = "A's")
+        self.login(self.B)
+        expected = list(Content.objects.getActivityFeed(self.B).order_by("-id").values_list("id", flat = True)[:3])
+        feed = Content.objects.getActivityFeed(self.B, limit = 3)
+        self.failUnlessEqual(list(feed.order_by("-id").values_list("id", flat = True)), expected)
+        feed = Content.objects.getActivityFeed(self.B, before = expected[0], limit = 3)
+        self.failUnlessEqual(list(feed.order_by("-id").values_list("id", flat = True))[:2], expected[1:])
+        expected = list(Content.objects.followed.exclude(model_name = "Comment").order_by("-id").values_list("id", flat = True)[:5])
+        self.failUnlessEqual(Content.objects.get_followed_ids(limit = 5), expected)
+        self.failUnlessEqual(Content.objects.get_followed_ids(before = expected[0], limit = 4), expected[1:])
+
+    def test_07_anonymous_pages(self):
+        """
+        Anonymous pages are served stale to all but one visitor when a public object changes
+        """
+        from twistranet.core import caches
+        pages = caches.PageCache("test")
+        page, stamp = pages.get("/")
+        self.failUnlessEqual(page, None)
+        pages.set("/", stamp, "First")
+        self.failUnlessEqual(pages.get("/"), ("First", None, ))
+        
+        # Only the first visitor recomputes the page
+        pages.invalidate()
+        page, stamp = pages.get("/")
+        self.failUnlessEqual(page, "First")
+        self.failIf(stamp is None)
+        self.failUnlessEqual(pages.get("/"), ("First", None, ))
+        pages.set("/", stamp, "Second")
+        self.failUnlessEqual(pages.get("/"), ("Second", None, ))
+        
+        # Public objects invalidate anonymous pages, private ones don't
+        self.login(self.A)
+        page, stamp = caches.anonymous_page_cache.get("/")
+        caches.anonymous_page_cache.set("/", stamp, "Anonymous")
+        Document.objects.create(title = "Private", text = "Private", permissions = "private")
+        self.failUnlessEqual(caches.anonymous_page_cache.get("/"), ("Anonymous", None, ))
+        doc = Document.objects.create(title = "Public", text = "Public", permissions = "public")
+        page, stamp = caches.anonymous_page_cache.get("/")
+        self.failIf(stamp is None)
+        caches.anonymous_page_cache.set("/", stamp, "Anonymous")
+        
+        # ...even when they're not public anymore
+        doc.permissions = "private"
+        doc.save()
+        self.failIf(caches.anonymous_page_cache.get("/")[1] is None)
+
+    def test_08_relation_counts(self):
+        """
+        Relation counts only include what the viewer can list, unless it can list everything
+        """
+        from django.test.client import Client
+        self.login(self.admin)
+        club = Community.objects.create(slug = "quiet_club", permissions = "private")
+        club.join(self.B)
+        B = UserAccount.objects.get(id = self.B.id)
+        n_communities = RelationCounters.objects.get_for(self.B.id).communities
+        self.logout()
+        
+        client = Client()
+        client.post("/login/", {'username': 'C', 'password': 'dummy'})
+        response = client.get("/account/%d/" % self.B.id)
+        self.failUnlessEqual(response.status_code, 200)
+        self.login(self.C)
+        self.failUnlessEqual(response.context["n_communities"], B.communities.count())
+        self.failUnless(response.context["n_communities"] < n_communities)
+        self.logout()
+        
+        client.post("/login/", {'username': 'B', 'password': 'dummy'})
+        response = client.get("/account/%d/" % self.B.id)
+        self.failUnlessEqual(response.context["n_communities"], n_communities)
+        response = client.get("/community/%d" % club.id)
+        self.failUnlessEqual(response.status_code, 200)
+        self.failUnlessEqual((response.context["n_members"], response.context["n_managers"], ), (2, 1, ))
+
+    def test_09_timeline_pages(self):
+        """
+        Homepage pages skip the deleted or invisible content of the timeline and still link to older content
+        """
+        from django.conf import settings
+        from django.test.client import Client
+        self.login(self.B)
+        Timeline.objects.get_content_ids(self.B)
+        statuses = [ StatusUpdate.objects.create(description = "Page %d" % i) for i in range(5) ]
+        ids = [ s.id for s in statuses ]
+        statuses[3].delete()
+        self.failUnless(ids[3] in Timeline.objects.get_content_ids(self.B))
+        self.logout()
+        
+        client = Client()
+        client.post("/login/", {'username': 'B', 'password': 'dummy'})
+        per_page = settings.TWISTRANET_CONTENT_PER_PAGE
+        settings.TWISTRANET_CONTENT_PER_PAGE = 2
+        try:
+            response = client.get("/")
+            self.failUnlessEqual([ c.id for c in response.context["latest_content_list"] ], [ids[4], ids[2], ])
+            self.failUnlessEqual(response.context["next_cursor"], ids[2])
+            response = client.get("/", {"before": ids[2]}, HTTP_X_REQUESTED_WITH = "XMLHttpRequest")
+            self.failUnlessEqual([ c.id for c in response.context["latest_content_list"] ], [ids[1], ids[0], ])
+        finally:
+            settings.TWISTRANET_CONTENT_PER_PAGE = per_page
+
+    def test_10_search_results(self):
+        """
+        Search results get their actual objects
+        """
+        from django.test.client import Client
+        self.login(self.B)
+        objects = [ StatusUpdate.objects.create(description = "Zorglub %d" % i) for i in range(3) ]
+        objects.append(Document.objects.create(title = "Zorglub", text = "Zorglub"))
+        self.logout()
+        client = Client()
+        client.post("/login/", {'username': 'B', 'password': 'dummy'})
+        response = client.get("/search/", {"q": "zorglub"})
+        self.failUnlessEqual(response.status_code, 200)
+        self.failUnlessEqual(
+            sorted([ (result._object.__class__, result._object.id) for result in response.context["page"].object_list ]),
+            sorted([ (obj.__class__, obj.id) for obj in objects ]),
+        )
@@ -1,3 +1,4 @@
+from __future__ import with_statement
 import hashlib
 import urllib
 import time
@@ -20,6 +21,7 @@ from twistranet.twistapp.signals import invite_user, reset_password
 from twistranet.twistapp.models import *
 from twistranet.twistapp.forms import account_forms, registration_forms
 from twistranet.twistapp.lib.slugify import slugify
+from twistranet.twistapp.lib.auth_context import as_account
 from twistranet.actions import *
 from twistranet.core.views import *
 
@@ -27,6 +29,7 @@ class UserAccountView(BaseWallView):
     """
     This is what is used as a base view for accounts
     """
+    anonymous_cache = True
     context_boxes = [
         'account/profile.box.html',
         'actions/context.box.html',
@@ -44,6 +47,22 @@ class UserAccountView(BaseWallView):
     title = None
     name = "account_by_id"
     
+    def sees_all_relations(self, account):
+        """
+        True if the authenticated account can list all the relations of the given account (its own ones,
+        or any as an admin). Raw counters (see RelationCounters) may only be displayed then:
+        they include relations other viewers can't list.
+        """
+        return self.auth.is_admin or self.auth.id == account.id
+        
+    def count_visible(self, model, ids):
+        """
+        Count the accounts among ids which the authenticated account can list,
+        with one secured query per SQL_CHUNK ids (SQLite limits statements to 999 parameters).
+        """
+        from twistranet.twistapp.models.network import _chunks, SQL_CHUNK
+        return sum([ model.objects.filter(id__in = chunk).count() for chunk in _chunks(ids, SQL_CHUNK) ])
+        
     def prepare_view(self, *args, **kw):
         """
         Add a few parameters for the view
@@ -53,11 +72,17 @@ class UserAccountView(BaseWallView):
         if not hasattr(self, "useraccount"):
             self.useraccount = self.auth
         self.account = self.useraccount
-        self.n_communities = self.account and self.account.communities.count() or False
-        self.n_network_members = self.account and self.account.network.count() or False
+        if self.account and self.sees_all_relations(self.account):
+            self.n_communities = self.account.counters.communities or False
+            self.n_network_members = self.account.counters.network or False
+        else:
+            self.n_communities = self.account and self.account.communities.count() or False
+            self.n_network_members = self.account and self.count_visible(
+                UserAccount, [ id for id in Network.graph.mutual_ids(self.account.id) if id != self.account.id ],
+            ) or False
         
         # Add a message for ppl who have no content
-        if self.template == UserAccountView.template:
+        if self.cursor is None and self.template == UserAccountView.template:
             if self.account and self.auth and self.account.id == self.auth.id:
                 if not Content.objects.filter(publisher = self.auth).exists():
                     messages.info(self.request, _("""<p>
@@ -77,10 +102,7 @@ class UserAccountView(BaseWallView):
         XXX TODO: Optimize this by adding a (first_twistable_on_home, last_twistable_on_home) values pair on the Account object.
         This way we can just query objects with id > last_twistable_on_home
         """
-        latest_ids = Content.objects.getActivityFeed(self.object)
-        latest_ids = latest_ids.order_by("-id").values_list('id', flat = True)[:settings.TWISTRANET_CONTENT_PER_PAGE]
-        latest_list = Content.objects.__booster__.filter(id__in = tuple(latest_ids)).select_related(*self.select_related_summary_fields).order_by("-created_at")
-        return latest_list
+        return self.get_page(Content.objects.getActivityFeed(self.object, before = self.cursor, limit = settings.TWISTRANET_CONTENT_PER_PAGE + 1))
 
     def get_title(self,):
         """
@@ -98,22 +120,49 @@ class HomepageView(UserAccountView):
     """
     name = "twistranet_home"
     title = _("Timeline")
+    context_boxes = UserAccountView.context_boxes + [
+        'account/suggestions.box.html',
+    ]
+    template_variables = UserAccountView.template_variables + [
+        "suggestions",
+    ]
+        
+    def get_timeline_ids(self):
+        """
+        Return the ids of the visible content of the current page from the materialized timeline, plus one
+        (to know if there's a next page). Timeline ids are not secured and may be deleted content:
+        we read further until we have enough visible ones or the timeline is exhausted,
+        then go on with the regular query if it was trimmed (see Timeline.objects.get_content_ids()).
+        """
+        wanted = settings.TWISTRANET_CONTENT_PER_PAGE + 1
+        ids = []
+        before = self.cursor
+        while len(ids) < wanted:
+            timeline_ids = Timeline.objects.get_content_ids(self.auth, before = before, count = wanted)
+            if timeline_ids is None:
+                # Older than the materialized timeline
+                ids.extend(Content.objects.get_followed_ids(before = before, limit = wanted - len(ids)))
+                break
+            visible = set(Content.objects.filter(id__in = timeline_ids).values_list("id", flat = True))
+            ids.extend([ id for id in timeline_ids if id in visible ])
+            if len(timeline_ids) < wanted:
+                break
+            before = timeline_ids[-1]
+        return ids[:wanted]
         
     def get_recent_content_list(self):
         """
-        Retrieve recent content list for the given account.
-        XXX TODO: Optimize this by adding a (first_twistable_on_home, last_twistable_on_home) values pair on the Account object.
-        This way we can just query objects with id > last_twistable_on_home
+        Retrieve recent content list for the given account, from its materialized timeline (see models/timeline.py).
         """
         latest_ids = None
         if not self.auth.is_anonymous:
             if Content.objects.filter(publisher = self.auth).exists():
-                latest_ids = Content.objects.followed.exclude(model_name = "Comment")
+                latest_ids = Content.objects.filter(id__in = self.get_timeline_ids())
         if latest_ids is None:
             latest_ids = Content.objects.exclude(model_name = "Comment")
-        latest_ids = latest_ids.order_by("-id").values_list('id', flat = True)[:settings.TWISTRANET_CONTENT_PER_PAGE]
-        latest_list = Content.objects.__booster__.filter(id__in = tuple(latest_ids)).select_related(*self.select_related_summary_fields).order_by("-created_at")
-        return latest_list
+            if self.cursor is not None:
+                latest_ids = latest_ids.filter(id__lt = self.cursor)
+        return self.get_page(latest_ids)
     
     def prepare_view(self, ):
         """
@@ -125,6 +174,7 @@ class HomepageView(UserAccountView):
         else:
             prep_id = None
         super(HomepageView, self).prepare_view(prep_id)
+        self.suggestions = not self.auth.is_anonymous and Suggestion.objects.get_for(self.auth) or []
 
 class PublicTimelineView(UserAccountView):
     name = "timeline"
@@ -134,9 +184,10 @@ class PublicTimelineView(UserAccountView):
         """
         Just return all public / available content
         """
-        latest_ids = Content.objects.order_by("-id").exclude(model_name = "Comment").values_list('id', flat = True)[:settings.TWISTRANET_CONTENT_PER_PAGE]
-        latest_list = Content.objects.__booster__.filter(id__in = tuple(latest_ids)).select_related(*self.select_related_summary_fields).order_by("-created_at")
-        return latest_list
+        latest_ids = Content.objects.exclude(model_name = "Comment")
+        if self.cursor is not None:
+            latest_ids = latest_ids.filter(id__lt = self.cursor)
+        return self.get_page(latest_ids)
 
 
 #                                                                               #
@@ -271,10 +322,9 @@ class AccountDelete(BaseObjectActionView):
             raise ValueError("You're not allowed to delete this account")
         name = self.useraccount.title
         underlying_user = self.useraccount.user
-        __account__ = SystemAccount.get()
-        # self.useraccount.delete()
-        underlying_user.delete()
-        del __account__
+        with as_account(SystemAccount.get()):
+            # self.useraccount.delete()
+            underlying_user.delete()
         messages.info(
             self.request, 
             _("'%(name)s' account has been deleted.") % {'name': name},
@@ -394,6 +444,7 @@ class UserAccountEdit(UserAccountView):
     content_forms = []
     latest_content_list = []
     name = "user_account_edit"
+    anonymous_cache = False
     category = LOCAL_ACTIONS
     
     def as_action(self,):
@@ -527,25 +578,24 @@ class AccountJoin(UserAccountEdit):
                 messages.warning(self.request, _("A user with this name already exists."))
             else:
                 # Create user and set information
-                __account__ = SystemAccount.get()
-                u = User.objects.create(
-                    username = cleaned_data["username"],
-                    first_name = cleaned_data["first_name"],
-                    last_name = cleaned_data["last_name"],
-                    email = cleaned_data["email"],
-                    is_superuser = is_admin,
-                    is_active = True,
-                )
-                u.set_password(cleaned_data["password"])
-                u.save()
-                useraccount = UserAccount.objects.get(user = u)
-                useraccount.title = u"%s %s" % (cleaned_data["first_name"], cleaned_data["last_name"])
-                useraccount.save()
-                if is_admin:
-                    admin_community = AdminCommunity.objects.get()
-                    if not admin_community in useraccount.communities:
-                        admin_community.join(useraccount, is_manager = True)
-                del __account__
+                with as_account(SystemAccount.get()):
+                    u = User.objects.create(
+                        username = cleaned_data["username"],
+                        first_name = cleaned_data["first_name"],
+                        last_name = cleaned_data["last_name"],
+                        email = cleaned_data["email"],
+                        is_superuser = is_admin,
+                        is_active = True,
+                    )
+                    u.set_password(cleaned_data["password"])
+                    u.save()
+                    useraccount = UserAccount.objects.get(user = u)
+                    useraccount.title = u"%s %s" % (cleaned_data["first_name"], cleaned_data["last_name"])
+                    useraccount.save()
+                    if is_admin:
+                        admin_community = AdminCommunity.objects.get()
+                        if not admin_community in useraccount.communities:
+                            admin_community.join(useraccount, is_manager = True)
                 
                 # Display a nice success message and redirect to login page
                 messages.success(self.request, _("Your account is now created. You can login to twistranet."))
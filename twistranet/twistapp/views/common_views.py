@@ -42,6 +42,7 @@ class ErrorBaseView(PublicTimelineView):
     name = "error"
     title = _("Error")
     error_description = _("<p>Error on page <strong>%(requested_url)s</strong></p>")
+    anonymous_cache = False
 
     def prepare_view(self, *args, **kw):
         """
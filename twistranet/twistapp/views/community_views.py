@@ -54,16 +54,30 @@ class CommunityView(UserAccountView):
         else:
             return super(CommunityView, self).get_title()
         
+    def get_accounts(self, ids):
+        """
+        Return the (visible) user accounts of the given ids, SQL_CHUNK ids per query.
+        """
+        from twistranet.twistapp.models.network import _chunks, SQL_CHUNK
+        ret = []
+        for chunk in _chunks([ int(id) for id in ids ], SQL_CHUNK):
+            ret.extend(UserAccount.objects.filter(id__in = chunk))
+        return ret
+        
     def set_community_vars(self):
         """
         set community template vars 
         """
         self.account = self.object
-        self.n_members = self.community and self.community.members.count() or 0
         self.is_member = self.community and self.community.is_member or False
         self.members = self.community and self.community.members_for_display[:settings.TWISTRANET_DISPLAYED_COMMUNITY_MEMBERS] or []
         self.managers = self.community and self.community.managers_for_display[:settings.TWISTRANET_DISPLAYED_COMMUNITY_MEMBERS] or []  
-        self.n_managers = self.community and self.community.managers.count() or 0
+        if self.community and self.sees_all_relations(self.community):
+            self.n_members = self.community.counters.members or 0
+            self.n_managers = self.community.counters.managers or 0
+        else:
+            self.n_members = self.community and self.count_visible(Account, Network.graph.mutual_ids(self.community.id)) or 0
+            self.n_managers = self.community and self.count_visible(Account, Network.graph.manager_ids(self.community.id)) or 0
 
         
     def prepare_view(self, *args, **kw):
@@ -73,7 +87,7 @@ class CommunityView(UserAccountView):
         super(CommunityView, self).prepare_view(*args, **kw)
         self.set_community_vars()
         # Check if there is content, display a pretty message if there's not
-        if not len(self.latest_content_list):
+        if self.cursor is None and not len(self.latest_content_list):
             msg = _("""
         <p>There is not much content on this community. But it's up to YOU to create some!</p>
         <p>Feel free to add content with the simple form on this page.</p>
@@ -138,6 +152,7 @@ class CommunityInvitations(CommunityListingView, UserAccountView):
     template_variables = UserAccountView.template_variables + CommunityListingView.template_variables
     title = _("Community invitations")
     name = "community_invitations"
+    anonymous_cache = False
     category = ACCOUNT_ACTIONS
     
     def as_action(self,):
@@ -200,6 +215,7 @@ class CommunityEdit(CommunityView):
     content_forms = []
     latest_content_list = []
     name = "community_edit"
+    anonymous_cache = False
     category = LOCAL_ACTIONS
     title = None
     form_class = community_forms.CommunityForm
@@ -308,6 +324,7 @@ class CommunityManageMembers(CommunityView):
     title = _("Manage members")
     template = "community/manage.html"
     name = "manage_members"
+    anonymous_cache = False
     template_variables = CommunityView.template_variables + [
         "selectable",
         "manager_ids",
@@ -330,25 +347,23 @@ class CommunityManageMembers(CommunityView):
             # Select action kind
             action_kind = self.request.POST.get('action_kind', None)
             if action_kind == 'remove':
-                method = self.community.leave
+                method = self.community.leave_many
             elif action_kind == 'set_as_manager':
-                method = self.community.set_as_manager
+                method = self.community.set_as_manager_many
             elif action_kind == 'unset_as_manager':
-                method = self.community.unset_as_manager
+                method = self.community.unset_as_manager_many
             else:
                 raise ValueError("Unknown or unset community management action kind: %s" % action_kind)
                 
-            # Execute on each selected account
-            for id in self.account_ids:
-                account = UserAccount.objects.get(id = int(id))
-                method(account)
+            # Execute on all selected accounts at once
+            method(self.get_accounts(self.account_ids))
 
             # Redirect to the community page with a nice message
             if self.account_ids:
                 messages.success(self.request, _("Users updated successfuly."))
                 raise MustRedirect(self.community.get_absolute_url())
             else:
-                message.error(self.request, _("Please select a user to operate on."))
+                messages.error(self.request, _("Please select a user to operate on."))
 
     def as_action(self):
         if not isinstance(getattr(self, "object", None), self.model_lookup):
@@ -365,6 +380,7 @@ class CommunityInvite(CommunityView):
     # Various parameters
     model_lookup = Community
     title = _("Invite people in this community")
+    anonymous_cache = False
     
     # Action rendering
     action_label = "Invite"
@@ -421,22 +437,17 @@ class CommunityInvite(CommunityView):
                 requesting_network__client__id = self.community.id,
             )
             
-        # XXX SUBOPTIMAL PART
-        self.selectable = flt[:RESULTS_PER_PAGE]
-        member_ids = self.community.members.values_list('id', flat = True).order_by("title")
-        self.selectable = [ u for u in self.selectable if u.id not in member_ids ]
+        member_ids = self.community.membership.mutual_ids
+        self.selectable = [ u for u in flt[:RESULTS_PER_PAGE] if u.id not in member_ids ]
             
-        # Invite or join?
+        # Invite or join all of them at once
         join_immediately = self.request.POST.get("join_immediately", False)
-        if join_immediately:
-            method = self.community.join
-        else:
-            method = self.community.invite
-
-        # If we have some people to invite, just prepare invitations
-        for id in self.account_ids:
-            account = UserAccount.objects.get(id = int(id))
-            method(account)
+        if self.account_ids:
+            accounts = self.get_accounts(self.account_ids)
+            if join_immediately:
+                self.community.join_many(accounts)
+            else:
+                self.community.invite_many(accounts)
             
         # Redirect to the community page with a nice message
         if self.account_ids: